@@ -1,6 +1,21 @@
 import os
 from concurrent.futures import ProcessPoolExecutor
 
+from lib.cache import DiskCache, RasterCache
+from lib.config import (
+    BM_DATA_DIR,
+    JOBS_CONCURRENCY,
+    JOBS_MAX_QUEUED,
+    JOBS_TTL,
+    LJ_DATA_DIR,
+    RASTER_CACHE_MAX_BYTES,
+    RASTER_HOT_CACHE_MAX_BYTES,
+    RASTER_HOT_CACHE_MAX_ITEM_BYTES,
+    TILE_CACHE_DIR,
+    TILE_CACHE_MAX_BYTES,
+)
+from lib.jobs import JobManager
+
 # Create shared resources, then define dependencies to get access to them. This avoids having e.g. a Redis client per
 # active connection. This is especially crucial for the ProcessPoolExecutor, that needs to share workers across threads.
 
@@ -14,3 +29,27 @@ def get_executor():
         yield executor
     finally:
         pass
+
+
+# Rendered map tiles, shared by all workers. Least recently used tiles are evicted once the budget is exceeded.
+tile_cache = DiskCache(TILE_CACHE_DIR, TILE_CACHE_MAX_BYTES)
+
+# Rasters of /compare, one entry per region and date, shared by all workers
+raster_cache = RasterCache(
+    [BM_DATA_DIR / "cache", LJ_DATA_DIR / "cache"],
+    RASTER_CACHE_MAX_BYTES,
+    RASTER_HOT_CACHE_MAX_BYTES,
+    RASTER_HOT_CACHE_MAX_ITEM_BYTES,
+)
+
+
+def get_raster_cache():
+    return raster_cache
+
+
+# Background jobs of /jobs, kept in memory of this process
+job_manager = JobManager(JOBS_CONCURRENCY, JOBS_MAX_QUEUED, JOBS_TTL)
+
+
+def get_job_manager():
+    return job_manager
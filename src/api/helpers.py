@@ -1,27 +1,100 @@
 import gzip
-import json
-from typing import Any
+import os
+import re
+from email.utils import formatdate, parsedate_to_datetime
 
+from fastapi import Request, Response
 from fastapi.exceptions import HTTPException
 
-from lib.config import ADMIN_AREA_FILE_MAPPING, GEOJSON_ADMIN_KEY
+from lib.admin_area_store import GzippedJson, load_admin_areas
 from lib.types import Resolution
 
 
-def get_admin_area_by_id(id: str, resolution: Resolution = "50m") -> dict[str, Any]:
-    file_path = ADMIN_AREA_FILE_MAPPING[resolution]
-    # Need to filter admin areas and get correct feature out
+def file_validators(stat: os.stat_result) -> dict[str, str]:
+    """Strong ETag and Last-Modified of a file that is only ever replaced as a whole (renamed into place)."""
+    return {
+        "ETag": f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"',
+        "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+    }
 
-    with gzip.open(file_path, "rt", encoding="utf-8") as f:
-        geojson_data = json.load(f)
 
-    filtered_features = [
-        feature for feature in geojson_data["features"] if feature["properties"].get(GEOJSON_ADMIN_KEY) == id
-    ]
+def is_not_modified(request: Request, etag: str, last_modified: float | None = None) -> bool:
+    """Evaluate `If-None-Match`, or `If-Modified-Since` if there is no `If-None-Match`, of a GET request.
 
-    if len(filtered_features) == 0:
+    :param etag: Current ETag, quoted
+    :param last_modified: Current modification time as timestamp, None if unknown
+    :return: True if the client has the current version, i.e. a 304 should be sent
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # Weak comparison, as required for If-None-Match
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None and last_modified is not None:
+        try:
+            return int(last_modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def bytes_response(request: Request, data: bytes, media_type: str, headers: dict[str, str]) -> Response:
+    """Send bytes held in memory, answering a single-range `Range` request with 206 like `FileResponse` does for files.
+
+    Multiple ranges are answered with the whole content, which clients have to accept.
+
+    :param headers: Response headers, should include the `ETag` and `Last-Modified` that `If-Range` is checked against
+    """
+    headers = {**headers, "Accept-Ranges": "bytes"}
+    size = len(data)
+    http_range = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    # A range of another version of the content is useless, send all of it
+    stale = if_range is not None and if_range not in (headers.get("ETag"), headers.get("Last-Modified"))
+    if http_range is None or stale:
+        return Response(content=data, media_type=media_type, headers=headers)
+
+    match = re.fullmatch(r"\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*", http_range)
+    if match is None or match.group(1) == match.group(2) == "":
+        return Response(content=data, media_type=media_type, headers=headers)
+    if match.group(1) == "":
+        # Suffix range, the last n bytes
+        start, end = max(0, size - int(match.group(2))), size
+    else:
+        start = int(match.group(1))
+        end = min(size, int(match.group(2)) + 1) if match.group(2) else size
+    if start >= size or start >= end:
+        return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+    return Response(
+        content=data[start:end],
+        status_code=206,
+        media_type=media_type,
+        headers={**headers, "Content-Range": f"bytes {start}-{end - 1}/{size}"},
+    )
+
+
+def get_admin_area_json_by_id(id: str, resolution: Resolution = "50m") -> GzippedJson:
+    store = load_admin_areas(resolution)
+    if id not in store:
         raise HTTPException(status_code=404, detail=f"Admin area with ID `{id}` not found.")
-    if len(filtered_features) > 1:
+    feature_json = store.get_feature_json(id)
+    if feature_json is None:
         raise HTTPException(status_code=400, detail="More than one admin areas match given ID")
+    return feature_json
+
+
+def gzipped_json_response(request: Request, body: GzippedJson, media_type: str = "application/json") -> Response:
+    """Send a pre-serialized JSON document as is, or 304 if the client has the current version.
 
-    return filtered_features[0]
+    The gzip-encoded and the decompressed representation are different bytes, so they carry different strong ETags.
+    """
+    # Decompressing is the rare case, browsers all accept gzip
+    gzipped = "gzip" in request.headers.get("accept-encoding", "")
+    etag = body.etag if gzipped else f'{body.etag[:-1]}-identity"'
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=3600", "Vary": "Accept-Encoding"}
+    if is_not_modified(request, etag):
+        return Response(status_code=304, headers=headers)
+    if not gzipped:
+        return Response(content=gzip.decompress(body.data), media_type=media_type, headers=headers)
+    return Response(content=body.data, media_type=media_type, headers={**headers, "Content-Encoding": "gzip"})
@@ -1,13 +1,27 @@
+import threading
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
 from api.routers.comparison_router import router as comparison_router
 from api.routers.explore_router import router as explore_router
+from api.routers.jobs_router import router as jobs_router
 from api.routers.statistics_router import router as statistics_router
+from api.routers.tiles_router import router as tiles_router
+from lib.admin_area_store import warm_up_admin_areas
 from lib.config import LJ_METADATA_DOWNLOAD_DIR
 from lib.lj import lj_download_metadata
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Parse and pre-serialize the admin areas in the background, requests arriving earlier load them on demand
+    threading.Thread(target=warm_up_admin_areas, daemon=True).start()
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
 
 # CORS Stuff
 origins = ["http://localhost", "http://localhost:3000", "http://localhost:8000"]
@@ -38,3 +52,5 @@ def read_health():
 app.include_router(explore_router)
 app.include_router(comparison_router)
 app.include_router(statistics_router)
+app.include_router(tiles_router)
+app.include_router(jobs_router)
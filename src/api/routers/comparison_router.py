@@ -1,28 +1,45 @@
-import io
 import logging
-import pickle
-from concurrent.futures import ThreadPoolExecutor
+import os
+import uuid
+from concurrent.futures import Executor, ThreadPoolExecutor
 from datetime import date, timedelta
+from functools import partial
+from pathlib import Path
+from typing import Annotated, Awaitable, Callable, Hashable
 
 import geopandas
 import xarray as xr
 from blackmarble.types import Product
-from fastapi import HTTPException, Response
+from fastapi import Depends, HTTPException, Query, Request, Response
 from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse
 from fastapi.routing import APIRouter
-
-from lib.admin_areas import get_region_meta
-from lib.bm import bm_download, bm_get_unified_gdf
+from rasterio.enums import Resampling as RioResampling
+from shapely.geometry.base import BaseGeometry
+
+from api.dependencies import get_executor, get_raster_cache
+from api.helpers import bytes_response, file_validators, is_not_modified
+from lib.admin_areas import get_region_geometry, get_region_tiles
+from lib.bm import bm_get_unified_gdf
+from lib.bm_granules import bm_download_region
+from lib.cache import RasterCache, atomic_directory
 from lib.config import BM_DATA_DIR, LJ_DATA_DIR
-from lib.geotiff import get_geotiffs, merge_geotiffs
+from lib.geotiff import TileConversionError, get_geotiffs, merge_geotiffs
+from lib.jobs import ReportProgress, report_nothing, to_thread_cancellable
 from lib.lj import lj_download_tile
-from lib.types import VNP46A1_Variable, VNP46A2_Variable
+from lib.single_flight import SingleFlight, file_lock
+from lib.stats import RasterSketch
+from lib.types import ClipMode, CombineMode, Resampling, VNP46A1_Variable, VNP46A2_Variable
+from lib.zarr_store import zarr_add_variables, zarr_write
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 router = APIRouter(prefix="/compare/{date}/{admin_id}", tags=["Compare"])
 
+# Rasters of a URL only change when rebuilt with `nocache`, clients revalidate after an hour
+RASTER_CACHE_CONTROL = "public, max-age=3600"
+
 
 # directly returns GeoTIFF
 def lj_geotiff_task(gdf: geopandas.GeoDataFrame, date: date):
@@ -37,168 +54,479 @@ def lj_geotiff_task(gdf: geopandas.GeoDataFrame, date: date):
 
 def bm_download_wrapper(*args, **kwargs):
     try:
-        return bm_download(*args, **kwargs)
+        return bm_download_region(*args, **kwargs)
     except Exception as e:
         raise HTTPException(getattr(e, "status") if hasattr(e, "status") else 500, detail=[str(x) for x in e.args])
 
 
-@router.get("/bm")
-async def get_bm_geotiff(
-    date: date,
-    admin_id: str,
-    product: Product = Product.VNP46A2,
-    variable: VNP46A1_Variable | VNP46A2_Variable = "Gap_Filled_DNB_BRDF-Corrected_NTL",
-    crs: str = "EPSG:4326",
-    nocache: bool = False,
-):
-    # Need to add a day to the date
-    date += timedelta(days=1)
-    cache_dir = BM_DATA_DIR / "cache" / admin_id / date.isoformat() / variable
-    raster_path = cache_dir / "raster.tif"
-    meta_path = cache_dir / "meta.pkl"
+def bm_to_raster(data_array: xr.DataArray, path: Path, cog: bool = False):
+    """Write a (georeferenced) data array to a GeoTIFF file.
 
-    # Try to load from cache first
-    geotiff_buf, pc02, pc98 = None, None, None
-    if not nocache and cache_dir.exists():
-        logger.info("BM: Loading (%s, %s) from cache", admin_id, date.isoformat())
-        geotiff_buf = raster_path.read_bytes()
-        meta = pickle.loads(meta_path.read_bytes())
-        pc02, pc98 = meta["pc02"], meta["pc98"]
+    The raster is written to a temporary file next to `path` and renamed into place, so concurrent readers never see a
+    partially written file.
 
-    if not nocache and cache_dir.exists() and cache_dir.is_dir():
+    :param data_array: Data array with CRS set
+    :param path: Output path
+    :param cog: Write a Cloud-Optimized GeoTIFF, defaults to False
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{uuid.uuid4().hex}.tmp")
+    try:
+        if cog:
+            # COG driver lays out tiles and builds internal overviews itself
+            data_array.rio.to_raster(
+                tmp_path, driver="COG", compress="LZW", blocksize=256, overviews="AUTO", resampling="average"
+            )
+        else:
+            data_array.rio.to_raster(
+                tmp_path,
+                driver="GTiff",
+                compress="LZW",
+                tiled=True,
+                blockxsize=256,
+                blockysize=256,
+                windowed=True,
+            )
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+def bm_resample(data_array: xr.DataArray, max_size: int, resampling: Resampling = "average") -> xr.DataArray:
+    """Downsample a data array so that neither side exceeds `max_size` pixels. Never upsamples.
+
+    :param data_array: Data array with CRS set
+    :param max_size: Maximum width/height in pixels
+    :param resampling: Resampling kernel, defaults to "average"
+    :return: Resampled data array
+    """
+    height, width = data_array.rio.height, data_array.rio.width
+    if max(width, height) <= max_size:
+        return data_array
+    scale = max_size / max(width, height)
+    shape = (max(1, round(height * scale)), max(1, round(width * scale)))
+    return data_array.rio.reproject(data_array.rio.crs, shape=shape, resampling=RioResampling[resampling])
+
+
+# Rasters being built, shared by identical concurrent requests
+compare_flights = SingleFlight()
+
+
+async def raster_response(request: Request, cache: RasterCache, raster_path: Path, headers: dict[str, str]) -> Response:
+    """Send a cached raster with validators, answering conditional requests with 304 and range requests with 206.
+
+    Cached rasters are only ever replaced as a whole, so the mtime and size of the file identify its contents. Raises
+    FileNotFoundError if the raster was evicted since it was looked up, which callers treat as a cache miss.
+    """
+    stat = raster_path.stat()
+    headers = {**headers, **file_validators(stat), "Cache-Control": RASTER_CACHE_CONTROL}
+    if is_not_modified(request, headers["ETag"], stat.st_mtime):
+        return Response(status_code=304, headers=headers)
+
+    # Popular rasters are served from memory, all others streamed from the cache file without holding them in memory
+    data = await run_in_threadpool(cache.read_hot, raster_path)
+    if data is not None:
+        return bytes_response(request, data, "image/tiff", headers)
+    return FileResponse(raster_path, media_type="image/tiff", headers=headers, stat_result=stat)
+
+
+async def coalesced_build(
+    key: Hashable,
+    cache: RasterCache,
+    entry_dir: Path,
+    raster_path: Path,
+    meta_path: Path,
+    nocache: bool,
+    build: Callable[[], Awaitable[dict]],
+) -> dict:
+    """Build a cached raster once for all concurrent identical requests.
+
+    Within the process, requests with the same key await the same build. Across worker processes, builds take the lock
+    of the cache entry, and a process that had to wait first checks whether the raster was built meanwhile.
+
+    :param key: Identifies the request, all parameters affecting the raster must be part of it
+    :param cache: Raster cache
+    :param entry_dir: Cache entry, must contain every file `build` writes
+    :param raster_path: Cached raster
+    :param meta_path: Cached metadata
+    :param nocache: Rebuild even if the raster is cached
+    :param build: Coroutine function writing the raster, returns its metadata. Once cancelled, it must only return
+        after the work stopped, the entry is locked until then.
+    :return: Metadata of the raster
+    """
+
+    async def locked_build():
+        async with file_lock(cache.lock_path(entry_dir)):
+            if not nocache:
+                meta = cache.get_meta(entry_dir, raster_path, meta_path)
+                if meta is not None:
+                    return meta
+            meta = await build()
+            # Size accounting and eviction touch the whole cache
+            await run_in_threadpool(cache.put_meta, entry_dir, meta_path, meta)
+            return meta
+
+    return await compare_flights.run(key, locked_build)
+
+
+def bm_build_raster(
+    admin_id: str,
+    date: date,
+    product: Product,
+    variables: list[str],
+    crs: str,
+    nocache: bool,
+    cog: bool,
+    max_size: int | None,
+    resampling: Resampling,
+    store_path: Path,
+    raster_path: Path,
+    report: ReportProgress = report_nothing,
+) -> dict:
+    # Blocking from start to end, runs in a thread. Stops at the next `report` once cancelled.
+    # Other variables, resolutions and formats only need re-encoding from the cached Zarr group
+    dataset = None
+    if not nocache and ((store_path / ".zgroup").exists() or (store_path / "zarr.json").exists()):
         try:
             logger.info("Loading BM raster (%s, %s) from cache", admin_id, date.isoformat())
-            dataset = xr.load_dataset(cache_dir, engine="zarr", mode="r")
+            dataset = xr.load_dataset(store_path, engine="zarr")
         except Exception as e:
             logger.warning(
-                "Zarr file exists but failed to open. The file is possibly corrupted. (Looking up %s)", cache_dir
+                "Zarr file exists but failed to open. The file is possibly corrupted. (Looking up %s)", store_path
             )
             logger.warning("Error from previous call: %s", str(e))
             dataset = None
 
-    # Download if not available in cache
-    if geotiff_buf is None or pc02 is None or pc98 is None:
-        logger.info("BM: Downloading (%s, %s, %s, %s)", admin_id, date.isoformat(), product.name, variable)
+    # Download variables not available in cache, all of them in a single pass over the granules
+    missing = variables if dataset is None else [name for name in variables if name not in dataset]
+    if missing:
+        logger.info("BM: Downloading (%s, %s, %s, %s)", admin_id, date.isoformat(), product.name, missing)
+        report("downloading")
         gdf = bm_get_unified_gdf(admin_id, date - timedelta(days=1))  # Use original LuoJia date for this
-        dataset = await run_in_threadpool(
-            bm_download_wrapper, gdf=gdf, date_range=date, product=product, variable=variable
-        )
-        dataset.to_zarr(cache_dir, mode="w")
+        # Assembled from processed granules, which are shared with neighbouring regions
+        downloaded = bm_download_wrapper(gdf=gdf, date=date, product=product, variable=missing)
+        report("writing")
+        if dataset is None:
+            # Single-date rasters are read as a whole. Written aside and renamed into place, a store left behind by a
+            # crash would otherwise be taken for a complete one.
+            with atomic_directory(store_path) as tmp_path:
+                zarr_write(downloaded, tmp_path, "map")
+            dataset = downloaded
+        else:
+            zarr_add_variables(downloaded, store_path, "map")
+            dataset = dataset.merge(downloaded)
         logger.info("Download complete.")
 
-        # Convert dataset to GeoTIFF response
-        logger.info("Writing CRS...")
-        data_array = dataset[variable].rio.write_crs(crs)
+    # Convert dataset to GeoTIFF response, one band per variable
+    report("encoding")
+    logger.info("Writing CRS...")
+    data_array = dataset[variables].isel(time=0).to_array("band").rio.write_crs(crs)
+    data_array.attrs["long_name"] = tuple(variables)
 
-        # Create GeoTIFF in memory
-        logger.info("Converting to raster...")
-        with io.BytesIO() as buf:
-            data_array.rio.to_raster(
-                buf,
-                driver="GTiff",
-                compress="LZW",
-                tiled=True,
-                blockxsize=256,
-                blockysize=256,
-                windowed=True,
-            )
-            buf.seek(0)
-            geotiff_buf = buf.getvalue()
+    if max_size:
+        logger.info("Resampling to at most %d pixels (%s)...", max_size, resampling)
+        data_array = bm_resample(data_array, max_size, resampling)
+
+    # Calculate stats for headers on the first band of the served raster, like for LuoJia, from a single pass instead
+    # of a sort
+    logger.info("Computing quantiles...")
+    sketch = RasterSketch().add(data_array.isel(band=0).values)
+    pc02, pc98 = sketch.quantiles([0.02, 0.98])
+
+    # Write GeoTIFF straight into the cache, it is served from there
+    logger.info("Converting to raster...")
+    bm_to_raster(data_array, raster_path, cog=cog)
+    return {"pc02": pc02, "pc98": pc98, "sketch": sketch.to_dict()}
+
+
+async def bm_get_raster(
+    date: date,
+    admin_id: str,
+    product: Product,
+    variables: list[str],
+    crs: str,
+    nocache: bool,
+    cog: bool,
+    max_size: int | None,
+    resampling: Resampling,
+    raster_cache: RasterCache,
+    report: ReportProgress = report_nothing,
+) -> tuple[Path, dict]:
+    """Get the Black Marble raster of a region from the cache, building it if needed. See `get_bm_geotiff`.
+
+    :return: Tuple of (path of the cached raster, its metadata)
+    """
+    # Need to add a day to the date
+    date += timedelta(days=1)
+    # All variables of a region and date share one Zarr group, rasters are cached per combination of variables
+    entry_dir = BM_DATA_DIR / "cache" / admin_id / date.isoformat()
+    store_path = entry_dir / f"{product.name}.zarr"
+    cache_dir = entry_dir / "+".join(variables)
+    raster_name = "raster"
+    if max_size:
+        raster_name += f"_max{max_size}-{resampling}"
+    if cog:
+        raster_name += "_cog"
+    raster_path = cache_dir / f"{raster_name}.tif"
+    meta_path = cache_dir / f"{raster_name}_meta.pkl"
 
-        # Calculate stats for headers
-        logger.info("Computing quantiles...")
-        pc02 = float(data_array.quantile(0.02).values)
-        pc98 = float(data_array.quantile(0.98).values)
+    # Try to load from cache first
+    meta = None if nocache else raster_cache.get_meta(entry_dir, raster_path, meta_path)
+    if meta is not None:
+        logger.info("BM: Loading (%s, %s) from cache", admin_id, date.isoformat())
+    else:
+        # Identical concurrent requests share one run, other processes are kept out of the cache entry
+        key = ("bm", admin_id, date, product, tuple(variables), crs, nocache, cog, max_size, resampling)
+        build = partial(
+            to_thread_cancellable,
+            bm_build_raster,
+            admin_id=admin_id,
+            date=date,
+            product=product,
+            variables=variables,
+            crs=crs,
+            nocache=nocache,
+            cog=cog,
+            max_size=max_size,
+            resampling=resampling,
+            store_path=store_path,
+            raster_path=raster_path,
+            report=report,
+        )
+        meta = await coalesced_build(key, raster_cache, entry_dir, raster_path, meta_path, nocache, build)
+    return raster_path, meta
 
-        # Store in cache
-        cache_dir.mkdir(parents=True, exist_ok=True)
-        raster_path.write_bytes(geotiff_buf)
-        meta_path.write_bytes(pickle.dumps({"pc02": pc02, "pc98": pc98}))
 
-    # Create response with headers
-    headers = {
-        "Access-Control-Expose-Headers": "*",  # Required for CORS
-        "X-Raster-P02": str(pc02),
-        "X-Raster-P98": str(pc98),
-    }
+@router.get("/bm")
+async def get_bm_geotiff(
+    request: Request,
+    date: date,
+    admin_id: str,
+    product: Product = Product.VNP46A2,
+    variable: Annotated[list[VNP46A1_Variable | VNP46A2_Variable], Query()] = ["Gap_Filled_DNB_BRDF-Corrected_NTL"],
+    crs: str = "EPSG:4326",
+    nocache: bool = False,
+    cog: bool = False,
+    max_size: Annotated[int | None, Query(gt=0)] = None,
+    resampling: Resampling = "average",
+    raster_cache: RasterCache = Depends(get_raster_cache),
+):
+    # Repeat `variable` to get a multi-band raster, one band per variable in the given order
+    variables = list(dict.fromkeys(variable))
+    # A raster evicted between lookup and response is a cache miss, it is looked up (and built) once more
+    for attempt in range(2):
+        raster_path, meta = await bm_get_raster(
+            date, admin_id, product, variables, crs, nocache, cog, max_size, resampling, raster_cache
+        )
 
-    return Response(geotiff_buf, media_type="image/tiff", headers=headers)
+        # Create response with headers, percentiles are those of the first band
+        headers = {
+            "Access-Control-Expose-Headers": "*",  # Required for CORS
+            "X-Raster-P02": str(meta["pc02"]),
+            "X-Raster-P98": str(meta["pc98"]),
+            "X-Raster-Bands": ",".join(variables),
+        }
+        try:
+            return await raster_response(request, raster_cache, raster_path, headers)
+        except FileNotFoundError:
+            if attempt > 0:
+                raise
+            logger.info("BM: Raster (%s, %s) was evicted, rebuilding", admin_id, date.isoformat())
 
 
 def lj_download(
-    relevant_tiles: list[str], resample: tuple[float, float] | None = None, parallel_downloads: int | None = None
+    relevant_tiles: list[str],
+    max_size: int | None = None,
+    resampling: Resampling = "average",
+    parallel_downloads: int | None = None,
+    cog: bool = False,
+    executor: Executor | None = None,
+    clip_geometry: BaseGeometry | None = None,
+    clip: ClipMode = "none",
+    combine: CombineMode = "last",
+    report: ReportProgress = report_nothing,
 ):
     # Download all GeoTIFFs
     logger.info("Downloading %d tiles", len(relevant_tiles))
+    report("downloading", 0.0)
 
     if parallel_downloads:
-        with ThreadPoolExecutor(max_workers=parallel_downloads) as executor:
-            # Submit all download jobs to the executor
-            list(executor.map(lj_download_tile, relevant_tiles))
+        with ThreadPoolExecutor(max_workers=parallel_downloads) as download_executor:
+            # Submit all download jobs to the executor, drop those not started yet if one fails or `report` raises
+            futures = [download_executor.submit(lj_download_tile, tile_name) for tile_name in relevant_tiles]
+            try:
+                for done, future in enumerate(futures, start=1):
+                    future.result()
+                    report("downloading", done / len(relevant_tiles))
+            except BaseException:
+                download_executor.shutdown(cancel_futures=True)
+                raise
     else:
-        for tile_name in relevant_tiles:
+        for done, tile_name in enumerate(relevant_tiles, start=1):
             lj_download_tile(tile_name)
+            report("downloading", done / len(relevant_tiles))
 
-    # Merge
+    # Merge, resampling happens while translating the VRT
     logger.info("Merging tiles...")
-    geotiff_buf, pc02, pc98, geometry = merge_geotiffs(relevant_tiles)
-
-    if resample:
-        raise NotImplementedError("Resampling not yet supported")
+    geotiff_buf, pc02, pc98, geometry = merge_geotiffs(
+        relevant_tiles,
+        cog=cog,
+        executor=executor,
+        clip_geometry=clip_geometry,
+        clip=clip,
+        max_size=max_size,
+        resampling=resampling,
+        combine=combine,
+        report=report,
+    )
 
     return geotiff_buf, pc02, pc98
 
 
+def lj_build_raster(
+    admin_id: str,
+    date: date,
+    cog: bool,
+    clip: ClipMode,
+    max_size: int | None,
+    resampling: Resampling,
+    combine: CombineMode,
+    executor: Executor,
+    raster_path: Path,
+    report: ReportProgress = report_nothing,
+) -> dict:
+    # Blocking from start to end, runs in a thread. Stops at the next `report` once cancelled, the in-memory mosaic is
+    # closed either way.
+    logger.info("LJ: Downloading (%s, %s)", admin_id, date.isoformat())
+    # Tiles where region and date match
+    relevant_tiles = get_region_tiles(admin_id, date)
+    # Check if there is data on this day
+    if len(relevant_tiles) == 0:
+        raise HTTPException(
+            status_code=404,
+            detail={
+                "code": "LJ_NO_DATA",
+                "message": f"No tiles found for admin {admin_id} and date {date}. Please try a different date.",
+            },
+        )
+    # Crop/mask to the admin area, so pixels of neighbouring regions are not shipped
+    clip_geometry = get_region_geometry(admin_id) if clip != "none" else None
+    try:
+        geotiff_buf, pc02, pc98 = lj_download(
+            relevant_tiles,
+            max_size=max_size,
+            resampling=resampling,
+            parallel_downloads=8,
+            cog=cog,
+            executor=executor,
+            clip_geometry=clip_geometry,
+            clip=clip,
+            combine=combine,
+            report=report,
+        )
+    except TileConversionError as e:
+        logger.exception("LJ: Conversion failed for tile %s", e.tile_name)
+        raise HTTPException(
+            status_code=500,
+            detail={"code": "LJ_CONVERSION_FAILED", "message": str(e)},
+        ) from e
+    # Store in cache, straight from the in-memory file
+    try:
+        report("writing")
+        geotiff_buf.save(raster_path)
+    finally:
+        geotiff_buf.close()
+    return {"pc02": pc02, "pc98": pc98}
+
+
+async def lj_get_raster(
+    date: date,
+    admin_id: str,
+    variable: str,
+    crs: str,
+    nocache: bool,
+    cog: bool,
+    clip: ClipMode,
+    max_size: int | None,
+    resampling: Resampling,
+    combine: CombineMode,
+    executor: Executor,
+    raster_cache: RasterCache,
+    report: ReportProgress = report_nothing,
+) -> tuple[Path, dict]:
+    """Get the LuoJia raster of a region from the cache, building it if needed. See `get_lj_geotiff`.
+
+    :return: Tuple of (path of the cached raster, its metadata)
+    """
+    # Each resolution/clip mode/format is cached separately, percentiles depend on clip mode and resolution too
+    entry_dir = LJ_DATA_DIR / "cache" / admin_id / date.isoformat()
+    cache_dir = entry_dir / variable
+    raster_name = f"raster_{f'max{max_size}-{resampling}' if max_size else 'default'}"
+    if clip != "none":
+        raster_name += f"_clip-{clip}"
+    if combine != "last":
+        raster_name += f"_{combine}"
+    if cog:
+        raster_name += "_cog"
+    raster_path = cache_dir / f"{raster_name}.tif"
+    meta_path = cache_dir / f"{raster_name}_meta.pkl"
+
+    # Check if cache exists
+    meta = None if nocache else raster_cache.get_meta(entry_dir, raster_path, meta_path)
+    if meta is not None:
+        logger.info("LJ: Reading (%s, %s) from cache", admin_id, date.isoformat())
+    else:
+        # If not cached, download, once for identical concurrent requests
+        key = ("lj", admin_id, date, variable, crs, nocache, cog, clip, max_size, resampling, combine)
+        build = partial(
+            to_thread_cancellable,
+            lj_build_raster,
+            admin_id=admin_id,
+            date=date,
+            cog=cog,
+            clip=clip,
+            max_size=max_size,
+            resampling=resampling,
+            combine=combine,
+            executor=executor,
+            raster_path=raster_path,
+            report=report,
+        )
+        meta = await coalesced_build(key, raster_cache, entry_dir, raster_path, meta_path, nocache, build)
+    return raster_path, meta
+
+
 @router.get("/lj")
 async def get_lj_geotiff(
+    request: Request,
     date: date,
     admin_id: str,
     variable: str = "default",
     crs: str = "EPSG:4326",
     nocache: bool = False,
+    cog: bool = False,
+    clip: ClipMode = "bbox",
+    max_size: Annotated[int | None, Query(gt=0)] = None,
+    resampling: Resampling = "average",
+    combine: CombineMode = "last",
+    executor: Executor = Depends(get_executor),
+    raster_cache: RasterCache = Depends(get_raster_cache),
 ):
-    resample = None  # No resampling
-    cache_dir = LJ_DATA_DIR / "cache" / admin_id / date.isoformat() / variable
-    raster_path = cache_dir / f"raster_{'x'.join(resample) if resample else 'default'}.tif"
-    meta_path = cache_dir / "meta.pkl"
-
-    # Check if cache exists
-    geotiff_buf, pc02, pc98 = None, None, None
-    if not nocache and cache_dir.exists():
-        logger.info("LJ: Reading (%s, %s) from cache", admin_id, date.isoformat())
-        geotiff_buf = raster_path.read_bytes()
-        meta = pickle.loads(meta_path.read_bytes())
-        pc02, pc98 = meta["pc02"], meta["pc98"]
-
-    # If not cached, download
-    if geotiff_buf is None or pc02 is None or pc98 is None:
-        logger.info("LJ: Downloading (%s, %s)", admin_id, date.isoformat())
-        # Get region meta dataframe
-        region_meta = get_region_meta()
-        # Select only rows where region and date match
-        relevant_tiles = region_meta[(region_meta["country"] == admin_id) & (region_meta["date"] == date.isoformat())]
-        # Check if there is data on this day
-        if len(relevant_tiles) == 0:
-            raise HTTPException(
-                status_code=404,
-                detail={
-                    "code": "LJ_NO_DATA",
-                    "message": f"No tiles found for admin {admin_id} and date {date}. Please try a different date.",
-                },
-            )
-        relevant_tiles = relevant_tiles["tile_name"].values.tolist()
-        geotiff_buf, pc02, pc98 = await run_in_threadpool(
-            lj_download, relevant_tiles, resample=resample, parallel_downloads=8
+    # A raster evicted between lookup and response is a cache miss, it is looked up (and built) once more
+    for attempt in range(2):
+        raster_path, meta = await lj_get_raster(
+            date, admin_id, variable, crs, nocache, cog, clip, max_size, resampling, combine, executor, raster_cache
         )
-        # Store in cache
-        cache_dir.mkdir(parents=True, exist_ok=True)
-        raster_path.write_bytes(geotiff_buf)
-        meta_path.write_bytes(pickle.dumps({"pc02": pc02, "pc98": pc98}))
-
-    # We return some metadata in the headers as we can't use GDAL metadata on client
-    headers = {
-        "Access-Control-Expose-Headers": "*",  # Required for CORS
-        "X-Raster-P02": str(pc02),
-        "X-Raster-P98": str(pc98),
-    }
-    return Response(content=geotiff_buf, media_type="image/tiff", headers=headers)
+
+        # We return some metadata in the headers as we can't use GDAL metadata on client
+        headers = {
+            "Access-Control-Expose-Headers": "*",  # Required for CORS
+            "X-Raster-P02": str(meta["pc02"]),
+            "X-Raster-P98": str(meta["pc98"]),
+        }
+        try:
+            return await raster_response(request, raster_cache, raster_path, headers)
+        except FileNotFoundError:
+            if attempt > 0:
+                raise
+            logger.info("LJ: Raster (%s, %s) was evicted, rebuilding", admin_id, date.isoformat())
@@ -1,14 +1,13 @@
-import gzip
-
-import geopandas
-from fastapi import APIRouter
+from fastapi import APIRouter, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.params import Path
 from fastapi.responses import FileResponse
 from typing_extensions import Annotated
 
-from api.helpers import Resolution, get_admin_area_by_id
+from api.helpers import Resolution, get_admin_area_json_by_id, gzipped_json_response
+from lib.admin_area_store import load_admin_areas
 from lib.admin_areas import get_region_avail_dates
-from lib.config import ADMIN_AREA_FILE_MAPPING, GEOJSON_ADMIN_KEY
+from lib.config import ADMIN_AREA_FILE_MAPPING
 
 router = APIRouter(prefix="/explore", tags=["Explore"])
 
@@ -21,13 +20,12 @@ async def get_dates(admin_id: str):
 
 
 @router.get("/admin-areas")
-async def get_admin_areas(resolution: Resolution = "50m", include_id: bool = False):
+async def get_admin_areas(request: Request, resolution: Resolution = "50m", include_id: bool = False):
     # Validation performed by pydantic thanks to type annotation
     file_path = ADMIN_AREA_FILE_MAPPING[resolution]
     if include_id:
-        with gzip.open(file_path, "rt") as file:
-            gdf = geopandas.read_file(file).set_index(GEOJSON_ADMIN_KEY)
-        return gdf.to_geo_dict()
+        collection_json = await run_in_threadpool(lambda: load_admin_areas(resolution).get_collection_json())
+        return gzipped_json_response(request, collection_json, media_type="application/geo+json")
     else:
         return FileResponse(
             file_path,
@@ -37,6 +35,7 @@ async def get_admin_areas(resolution: Resolution = "50m", include_id: bool = Fal
 
 
 @router.get("/admin-areas/{id}")
-async def get_admin_area(id: Annotated[str, Path()], resolution: Resolution = "50m"):
-    admin_area = get_admin_area_by_id(id, resolution=resolution)
-    return admin_area
+async def get_admin_area(request: Request, id: Annotated[str, Path()], resolution: Resolution = "50m"):
+    # Loading the store the first time takes a while, don't block the event loop
+    admin_area_json = await run_in_threadpool(get_admin_area_json_by_id, id, resolution=resolution)
+    return gzipped_json_response(request, admin_area_json, media_type="application/geo+json")
@@ -0,0 +1,151 @@
+import asyncio
+from concurrent.futures import Executor
+from datetime import date
+from typing import Annotated, Literal
+from urllib.parse import urlencode
+
+from blackmarble.types import Product
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import JSONResponse, RedirectResponse
+from pydantic import BaseModel, Field
+
+from api.dependencies import get_executor, get_job_manager, get_raster_cache
+from api.routers.comparison_router import bm_get_raster, lj_get_raster
+from lib.cache import RasterCache
+from lib.jobs import Job, JobManager, JobQueueFull
+from lib.types import ClipMode, CombineMode, Resampling, VNP46A1_Variable, VNP46A2_Variable
+
+router = APIRouter(prefix="/jobs", tags=["Jobs"])
+
+
+class BMJobRequest(BaseModel):
+    """Parameters of `/compare/{date}/{admin_id}/bm`."""
+
+    dataset: Literal["bm"]
+    date: date
+    admin_id: str
+    product: Product = Product.VNP46A2
+    variable: list[VNP46A1_Variable | VNP46A2_Variable] = ["Gap_Filled_DNB_BRDF-Corrected_NTL"]
+    crs: str = "EPSG:4326"
+    cog: bool = False
+    max_size: Annotated[int | None, Field(gt=0)] = None
+    resampling: Resampling = "average"
+
+
+class LJJobRequest(BaseModel):
+    """Parameters of `/compare/{date}/{admin_id}/lj`."""
+
+    dataset: Literal["lj"]
+    date: date
+    admin_id: str
+    variable: str = "default"
+    crs: str = "EPSG:4326"
+    cog: bool = False
+    clip: ClipMode = "bbox"
+    max_size: Annotated[int | None, Field(gt=0)] = None
+    resampling: Resampling = "average"
+    combine: CombineMode = "last"
+
+
+JobRequest = Annotated[BMJobRequest | LJJobRequest, Field(discriminator="dataset")]
+
+
+def result_url(request: Request, params: BMJobRequest | LJJobRequest) -> str:
+    # The comparison endpoint serves the raster from the cache once the job is done
+    endpoint = "get_bm_geotiff" if params.dataset == "bm" else "get_lj_geotiff"
+    path = request.url_for(endpoint, date=params.date.isoformat(), admin_id=params.admin_id)
+    query = params.model_dump(exclude={"dataset", "date", "admin_id"}, exclude_none=True, mode="json")
+    query = {name: str(value).lower() if isinstance(value, bool) else value for name, value in query.items()}
+    return f"{path}?{urlencode(query, doseq=True)}"
+
+
+def job_response(request: Request, job: Job, status_code: int = 200) -> JSONResponse:
+    href = str(request.url_for("get_job", job_id=job.id))
+    return JSONResponse({**job.to_dict(), "href": href}, status_code=status_code, headers={"Location": href})
+
+
+@router.post("", status_code=202)
+async def create_job(
+    request: Request,
+    params: JobRequest,
+    executor: Executor = Depends(get_executor),
+    raster_cache: RasterCache = Depends(get_raster_cache),
+    job_manager: JobManager = Depends(get_job_manager),
+):
+    """
+    Start building a comparison raster in the background. Returns the job, whose URL (`href`) can be polled. Submitting
+    the parameters of a queued, running or completed job returns that job instead of starting another one.
+    """
+    url = result_url(request, params)
+    # All parameters affect the raster
+    key = params.model_dump_json()
+
+    async def run(job: Job) -> str:
+        if isinstance(params, BMJobRequest):
+            await bm_get_raster(
+                params.date,
+                params.admin_id,
+                params.product,
+                list(dict.fromkeys(params.variable)),
+                params.crs,
+                False,
+                params.cog,
+                params.max_size,
+                params.resampling,
+                raster_cache,
+                report=job.report,
+            )
+        else:
+            await lj_get_raster(
+                params.date,
+                params.admin_id,
+                params.variable,
+                params.crs,
+                False,
+                params.cog,
+                params.clip,
+                params.max_size,
+                params.resampling,
+                params.combine,
+                executor,
+                raster_cache,
+                report=job.report,
+            )
+        return url
+
+    try:
+        job, _ = job_manager.submit(key, run)
+    except JobQueueFull as e:
+        raise HTTPException(
+            status_code=429,
+            detail={"code": "JOBS_QUEUE_FULL", "message": f"{e}, please try again later."},
+            headers={"Retry-After": "30"},
+        ) from e
+    return job_response(request, job, status_code=202)
+
+
+@router.get("/{job_id}")
+async def get_job(request: Request, job_id: str, job_manager: JobManager = Depends(get_job_manager)):
+    """
+    Get the status of a job: its stage (e.g. "downloading", "merging") and the progress within the stage, if known.
+    Redirects (303) to the raster once the job is done.
+    """
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail={"code": "JOB_NOT_FOUND", "message": f"No job `{job_id}`."})
+    if job.status == "done":
+        return RedirectResponse(job.result, status_code=303)
+    return job_response(request, job)
+
+
+@router.delete("/{job_id}")
+async def cancel_job(request: Request, job_id: str, job_manager: JobManager = Depends(get_job_manager)):
+    """
+    Cancel a queued or running job. Work shared with identical requests still waiting for it is not cancelled.
+    """
+    job = job_manager.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail={"code": "JOB_NOT_FOUND", "message": f"No job `{job_id}`."})
+    if job.task is not None and not job.task.done():
+        await asyncio.wait({job.task}, timeout=5)
+    return job_response(request, job)
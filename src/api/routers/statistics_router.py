@@ -2,16 +2,27 @@ import numpy as np
 import pandas as pd
 import pycountry
 from fastapi import APIRouter, HTTPException
+from fastapi.concurrency import run_in_threadpool
 
+from api.dependencies import raster_cache, tile_cache
 from lib.admin_areas import (
     dates_from_csv,
     get_all_regions_gdf,
     get_region_avail_dates,
-    get_region_meta,
     get_tile_densities,
 )
+from lib.bm import bm_default_zarr_path
 from lib.cloud_coverage import get_day_cloud_coverage
-from lib.config import ADMIN_AREA_FILE_MAPPING, GEOJSON_ADMIN_KEY, STATIC_DIR
+from lib.config import (
+    ADMIN_AREA_FILE_MAPPING,
+    BM_DEFAULT_PRODUCT,
+    BM_DEFAULT_VARIABLE,
+    BM_DEFAULT_VARIABLES,
+    GEOJSON_ADMIN_KEY,
+    STATIC_DIR,
+)
+from lib.static_tables import load_region_meta
+from lib.zonal import zonal_timeseries
 
 router = APIRouter(prefix="/statistics", tags=["Statistics"])
 
@@ -21,14 +32,14 @@ async def get_statistics():
     """
     Get statistics for the dataset.
     """
-    country_meta = get_region_meta()
+    region_meta = load_region_meta()
     dates = dates_from_csv(filename=STATIC_DIR / "all_dates.csv")
 
     return {
         "general": {"geojson_resolutions": len(ADMIN_AREA_FILE_MAPPING)},
         "luojia": {
-            "total_images": len(country_meta),
-            "total_admin_areas": len(country_meta["country"].unique()),
+            "total_images": len(region_meta.frame),
+            "total_admin_areas": len(region_meta.countries),
             "total_dates": len(dates),
         },
     }
@@ -37,8 +48,7 @@ async def get_statistics():
 @router.get("/regions")
 async def get_regions():
     gdf = get_all_regions_gdf()
-    region_meta = get_region_meta()
-    avail_regions = region_meta["country"].unique()
+    avail_regions = load_region_meta().countries
     regions = gdf[[GEOJSON_ADMIN_KEY, "name"]].drop_duplicates()
     regions = regions[regions[GEOJSON_ADMIN_KEY].isin(avail_regions)]
     regions = regions.rename(columns={GEOJSON_ADMIN_KEY: "admin_id"})
@@ -52,16 +62,11 @@ async def get_region_dates(admin_id: str):
     Gets a heatmap of the region, where the available dates are binned into monthly intervals. Each row is a year of
     data, and each column is a month of the year. The data ranges over all contained years in the available dates.
     """
-    admin_meta = get_region_meta()
-
-    admin_data = admin_meta[admin_meta["country"] == admin_id]
+    # Dates are already datetime64, the shared table must not be modified
+    admin_data = load_region_meta().rows(admin_id)
     if admin_data.empty:
         raise HTTPException(status_code=404, detail="Admin area not found")
-
-    # Convert dates to datetime objects
-    admin_data["date"] = pd.to_datetime(admin_data["date"])
-    admin_data["year"] = admin_data["date"].dt.year
-    admin_data["month"] = admin_data["date"].dt.month
+    admin_data = admin_data.assign(year=admin_data["date"].dt.year, month=admin_data["date"].dt.month)
 
     # Compute monthly counts
     monthly_count = admin_data.groupby(["year", "month"]).size().reset_index(name="count")
@@ -109,7 +114,7 @@ async def get_coverage_fraction():
     df = get_tile_densities()
 
     # Return average country coverage over all dates where data is available
-    coverage = df.groupby("ISO_A3")["CoverageFraction"].mean().sort_values(ascending=False)
+    coverage = df.groupby("ISO_A3", observed=True)["CoverageFraction"].mean().sort_values(ascending=False)
     log_coverage = pd.Series(np.log10(coverage))
 
     # Compute percentiles
@@ -132,3 +137,43 @@ async def get_coverage_fraction():
             "zmax": pc98,
         },
     }
+
+
+@router.get("/cache")
+async def get_cache_statistics():
+    """
+    Get hit/miss/eviction counters of the raster and tile caches, since the start of this worker process.
+    """
+    return {
+        "rasters": raster_cache.stats.to_dict(),
+        "rasters_hot": raster_cache.hot.stats.to_dict(),
+        "tiles": tile_cache.stats.to_dict(),
+    }
+
+
+@router.get("/timeseries/{admin_id}")
+async def get_timeseries(admin_id: str, variable: str | None = None):
+    """
+    Get the daily radiance statistics (pixel count, sum, mean and percentiles) of an admin area over all dates of the
+    local Black Marble dataset. Answered from the table precomputed with `bm zonal`.
+    """
+    variable = variable or BM_DEFAULT_VARIABLE or BM_DEFAULT_VARIABLES[BM_DEFAULT_PRODUCT]
+    try:
+        # Loading the table the first time and after `bm zonal` updated it takes a while, don't block the event loop
+        series = await run_in_threadpool(zonal_timeseries, bm_default_zarr_path(), variable, admin_id)
+    except FileNotFoundError:
+        raise HTTPException(
+            status_code=404,
+            detail={
+                "code": "ZONAL_NOT_COMPUTED",
+                "message": f"No zonal statistics computed for {variable}. Run `bm zonal` first.",
+            },
+        )
+    if series is None:
+        raise HTTPException(status_code=404, detail="Admin area not found")
+
+    return {
+        "admin_id": admin_id,
+        "variable": variable,
+        **series.assign(date=series["date"].dt.strftime("%Y-%m-%d")).to_dict(orient="list"),
+    }
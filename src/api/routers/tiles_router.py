@@ -0,0 +1,145 @@
+from concurrent.futures import Executor, ThreadPoolExecutor
+from datetime import date
+from pathlib import Path
+
+from blackmarble.types import Product
+from fastapi import APIRouter, Depends, HTTPException, Response
+from fastapi.concurrency import run_in_threadpool
+from shapely.geometry import box
+
+from api.dependencies import get_executor, get_raster_cache, tile_cache
+from api.routers.comparison_router import bm_get_raster, lj_get_raster
+from lib.cache import RasterCache
+from lib.geotiff import convert_geotiffs
+from lib.lj import lj_download_tile
+from lib.lj_index import lj_query_tiles
+from lib.tiles import TILE_MEDIA_TYPES, TileFormat, encode_tile, tile_bounds_lonlat, warp_tile
+from lib.types import DatasetName, VNP46A1_Variable, VNP46A2_Variable
+
+router = APIRouter(prefix="/tiles", tags=["Tiles"])
+
+# At low zoom levels a single tile can cover hundreds of LuoJia tiles. Refuse to render those.
+LJ_TILE_MAX_SOURCES = 32
+LJ_TILE_PARALLEL_DOWNLOADS = 8
+
+
+def lj_render_tile(
+    date: date,
+    z: int,
+    x: int,
+    y: int,
+    tile_format: TileFormat,
+    vmin: float | None,
+    vmax: float | None,
+    executor: Executor | None = None,
+) -> bytes | None:
+    relevant_tiles = lj_query_tiles(box(*tile_bounds_lonlat(z, x, y)), date)
+    if len(relevant_tiles) == 0:
+        return None
+    if len(relevant_tiles) > LJ_TILE_MAX_SOURCES:
+        raise HTTPException(
+            status_code=422,
+            detail={
+                "code": "TILE_ZOOM_TOO_LOW",
+                "message": f"Tile covers {len(relevant_tiles)} LuoJia tiles, please zoom in.",
+            },
+        )
+
+    with ThreadPoolExecutor(max_workers=LJ_TILE_PARALLEL_DOWNLOADS) as download_executor:
+        list(download_executor.map(lj_download_tile, relevant_tiles))
+    converted = convert_geotiffs(relevant_tiles, executor=executor)
+
+    dataset = warp_tile([str(path) for path, _ in converted], z, x, y)
+    return encode_tile(dataset, tile_format, vmin, vmax)
+
+
+def bm_render_tile(
+    raster_path: Path, z: int, x: int, y: int, tile_format: TileFormat, vmin: float | None, vmax: float | None
+) -> bytes | None:
+    dataset = warp_tile([str(raster_path)], z, x, y)
+    return encode_tile(dataset, tile_format, vmin, vmax)
+
+
+async def lj_stretch(
+    date: date, admin_id: str | None, executor: Executor, raster_cache: RasterCache
+) -> tuple[float, float]:
+    """P02/P98 of the LuoJia mosaic of a region, from /compare/{date}/{admin_id}/lj with default parameters.
+
+    The stretch of all map tiles of a region comes from the same mosaic, so neighbouring tiles match.
+    """
+    if admin_id is None:
+        raise HTTPException(
+            status_code=400,
+            detail={
+                "code": "TILE_STRETCH_REQUIRED",
+                "message": "Pass vmin and vmax, or the admin_id whose LuoJia percentiles to stretch with.",
+            },
+        )
+    _, meta = await lj_get_raster(
+        date, admin_id, "default", "EPSG:4326", False, False, "bbox", None, "average", "last", executor, raster_cache
+    )
+    return meta["pc02"], meta["pc98"]
+
+
+@router.get("/{dataset}/{date}/{z:int}/{x:int}/{y:int}.{tile_format}")
+async def get_tile(
+    dataset: DatasetName,
+    date: date,
+    z: int,
+    x: int,
+    y: int,
+    tile_format: TileFormat,
+    admin_id: str | None = None,
+    product: Product = Product.VNP46A2,
+    variable: VNP46A1_Variable | VNP46A2_Variable = "Gap_Filled_DNB_BRDF-Corrected_NTL",
+    vmin: float | None = None,
+    vmax: float | None = None,
+    executor: Executor = Depends(get_executor),
+    raster_cache: RasterCache = Depends(get_raster_cache),
+):
+    """
+    Web mercator XYZ tile of LuoJia or Black Marble data. Images are colored with the CET-L8 colormap, stretched from
+    `vmin` to `vmax`, "tif" tiles contain raw float32 radiance. The stretch defaults to P02/P98 of the whole region
+    `admin_id` on that date, so that all tiles of a region match. LuoJia tiles are rendered from all tiles of the given
+    date, and need either `admin_id` or `vmin` and `vmax` as images. Black Marble tiles are rendered from the
+    full-resolution raster of `admin_id`, which is encoded from the cached Zarr store (or downloaded) on first use.
+    """
+    if not 0 <= z <= 24 or not 0 <= x < 2**z or not 0 <= y < 2**z:
+        raise HTTPException(status_code=400, detail=f"Invalid tile {z}/{x}/{y}")
+    if dataset not in (DatasetName.luojia, DatasetName.blackmarble):
+        raise HTTPException(status_code=400, detail=f"Tiles are not available for dataset `{dataset.value}`")
+
+    raster_path = None
+    if dataset == DatasetName.blackmarble:
+        if admin_id is None:
+            raise HTTPException(status_code=400, detail="admin_id is required for Black Marble tiles")
+        raster_path, meta = await bm_get_raster(
+            date, admin_id, product, [variable], "EPSG:4326", False, False, None, "average", raster_cache
+        )
+        vmin = meta["pc02"] if vmin is None else vmin
+        vmax = meta["pc98"] if vmax is None else vmax
+    elif tile_format != "tif" and (vmin is None or vmax is None):
+        pc02, pc98 = await lj_stretch(date, admin_id, executor, raster_cache)
+        vmin = pc02 if vmin is None else vmin
+        vmax = pc98 if vmax is None else vmax
+
+    # Keyed on the stretch actually applied, tiles are re-rendered once the region's percentiles change
+    if dataset == DatasetName.luojia:
+        cache_key = f"{dataset.value}/{date}/{z}/{x}/{y}.{tile_format}?vmin={vmin}&vmax={vmax}"
+    else:
+        source = f"{admin_id}/{product.name}/{variable}"
+        cache_key = f"{dataset.value}/{date}/{source}/{z}/{x}/{y}.{tile_format}?vmin={vmin}&vmax={vmax}"
+    tile = await run_in_threadpool(tile_cache.get, cache_key)
+
+    if tile is None:
+        if raster_path is None:
+            tile = await run_in_threadpool(lj_render_tile, date, z, x, y, tile_format, vmin, vmax, executor)
+        else:
+            tile = await run_in_threadpool(bm_render_tile, raster_path, z, x, y, tile_format, vmin, vmax)
+
+        # No data in this tile
+        if tile is None:
+            return Response(status_code=204)
+        await run_in_threadpool(tile_cache.put, cache_key, tile)
+
+    return Response(content=tile, media_type=TILE_MEDIA_TYPES[tile_format], headers={"Cache-Control": "max-age=3600"})
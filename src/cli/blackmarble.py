@@ -5,9 +5,18 @@ import geopandas
 from matplotlib import pyplot as plt
 
 from lib.admin_areas import dates_from_csv
-from lib.bm import bm_load_from_zarr, bm_store_to_zarr
-from lib.config import DEFAULT_DATES_FILE, DEFAULT_GDF_FILE
+from lib.bm import bm_default_zarr_path, bm_load_from_zarr, bm_rechunk_zarr, bm_store_to_zarr
+from lib.config import (
+    ADMIN_AREA_FILE_MAPPING,
+    BM_DEFAULT_PRODUCT,
+    BM_DEFAULT_VARIABLE,
+    BM_DEFAULT_VARIABLES,
+    BM_ZARR_LAYOUTS,
+    DEFAULT_DATES_FILE,
+    DEFAULT_GDF_FILE,
+)
 from lib.visualization import bm_plot_daily_radiance, bm_plot_difference, bm_plot_series
+from lib.zonal import zonal_compute
 
 
 def setup_bm_parser(parser: ArgumentParser, parents: list[ArgumentParser]):
@@ -32,6 +41,45 @@ def setup_bm_parser(parser: ArgumentParser, parents: list[ArgumentParser]):
     )
     bm_download_parser.add_argument("-d", "--dates", nargs="+", help="Manually list dates to download in ISO format")
     bm_download_parser.add_argument("--force", action="store_true", help="Force re-downloading and processing of files")
+    bm_download_parser.add_argument(
+        "--no-append",
+        dest="append",
+        action="store_false",
+        help="Do not download dates missing from an existing store",
+    )
+    bm_download_parser.add_argument(
+        "--layout",
+        choices=list(BM_ZARR_LAYOUTS),
+        default="timeseries",
+        help="Chunk layout of a new store",
+    )
+
+    # Rechunk
+    bm_rechunk_parser = subparsers_bm.add_parser(
+        "rechunk",
+        add_help=False,
+        parents=parents,
+        formatter_class=ArgumentDefaultsHelpFormatter,
+        help="Rewrite the local Blackmarble Zarr store with another chunk layout, sorted by date",
+    )
+    bm_rechunk_parser.add_argument("path", nargs="?", help="Path to the Zarr store, defaults to the downloaded dataset")
+    bm_rechunk_parser.add_argument("-l", "--layout", choices=list(BM_ZARR_LAYOUTS), default="timeseries")
+    bm_rechunk_parser.add_argument("-o", "--output", help="Write to a new store instead of replacing the store")
+
+    # Zonal statistics
+    bm_zonal_parser = subparsers_bm.add_parser(
+        "zonal",
+        add_help=False,
+        parents=parents,
+        formatter_class=ArgumentDefaultsHelpFormatter,
+        help="Compute per-admin-area radiance statistics for all dates of the local Zarr store",
+    )
+    bm_zonal_parser.add_argument("path", nargs="?", help="Path to the Zarr store, defaults to the downloaded dataset")
+    bm_zonal_parser.add_argument("--variable", default=BM_DEFAULT_VARIABLE or BM_DEFAULT_VARIABLES[BM_DEFAULT_PRODUCT])
+    bm_zonal_parser.add_argument(
+        "-r", "--resolution", choices=list(ADMIN_AREA_FILE_MAPPING), default="10m", help="Admin area resolution"
+    )
+    bm_zonal_parser.add_argument("--force", action="store_true", help="Recompute dates that were computed before")
 
     # Visualize
     bm_show_parser = subparsers_bm.add_parser(
@@ -64,9 +112,25 @@ def handle_bm_commands(args: Namespace):
         print("Selected GDF:    ", args.gdf.split("/")[-1])
         gdf = geopandas.read_file(args.gdf, force=args.force)
         print("Selected dates:", ", ".join(dates))
-        bm_store_to_zarr(gdf=gdf, dates=[datetime.date.fromisoformat(d) for d in dates], force=args.force)
+        bm_store_to_zarr(
+            gdf=gdf,
+            dates=[datetime.date.fromisoformat(d) for d in dates],
+            force=args.force,
+            append=args.append,
+            layout=args.layout,
+        )
         print("Download done.")
 
+    if args.bm_command == "rechunk":
+        path = bm_rechunk_zarr(args.layout, path=args.path, dest=args.output)
+        print(f"Rechunked to {args.layout} layout: {path}")
+
+    if args.bm_command == "zonal":
+        table = zonal_compute(
+            args.path or bm_default_zarr_path(), args.variable, resolution=args.resolution, force=args.force
+        )
+        print(f"Zonal statistics for {table['admin_id'].nunique()} admin area(s) and {table['date'].nunique()} date(s)")
+
     if args.bm_command == "show":
         gdf = geopandas.read_file(args.gdf)
         raster = bm_load_from_zarr()
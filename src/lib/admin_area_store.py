@@ -0,0 +1,150 @@
+import gzip
+import hashlib
+import json
+import threading
+from dataclasses import dataclass
+from typing import Any
+
+import numpy as np
+from geopandas import GeoDataFrame
+from shapely import STRtree
+from shapely.geometry.base import BaseGeometry
+from shapely.ops import unary_union
+
+from lib.config import ADMIN_AREA_FILE_MAPPING, GEOJSON_ADMIN_KEY
+from lib.types import Resolution
+
+_stores_lock = threading.Lock()
+_stores: dict[Resolution, tuple[int, "AdminAreaStore"]] = {}
+
+
+@dataclass(frozen=True)
+class GzippedJson:
+    """A JSON document serialized and gzip-compressed once, to be sent as is."""
+
+    data: bytes
+    etag: str  # Strong ETag of the compressed bytes, quoted
+
+    @classmethod
+    def dump(cls, obj: Any) -> "GzippedJson":
+        # mtime=0 keeps the output, and with it the ETag, identical across processes and restarts
+        data = gzip.compress(json.dumps(obj, separators=(",", ":")).encode("utf-8"), compresslevel=9, mtime=0)
+        return cls(data=data, etag=f'"{hashlib.sha1(data).hexdigest()}"')
+
+
+class AdminAreaStore:
+    """All admin areas of one resolution, parsed once and indexed by admin ID and by geometry.
+
+    Holds the raw GeoJSON features, a GeoDataFrame (EPSG:4326) in the same order, a dict from admin ID to feature
+    positions and an STRtree over all geometries. All of it is shared and must not be modified in place.
+    """
+
+    def __init__(self, geojson: dict[str, Any]):
+        self.features: list[dict[str, Any]] = geojson["features"]
+        self.gdf = GeoDataFrame.from_features(self.features, crs="EPSG:4326")
+        self.tree = STRtree(self.gdf.geometry.values)
+
+        self._positions: dict[str, list[int]] = {}
+        for position, feature in enumerate(self.features):
+            admin_id = feature["properties"].get(GEOJSON_ADMIN_KEY)
+            self._positions.setdefault(admin_id, []).append(position)
+        self._geometries: dict[str, BaseGeometry] = {}
+        self._serialize_lock = threading.Lock()
+        self._feature_json: dict[str, GzippedJson] | None = None
+        self._collection_json: GzippedJson | None = None
+
+    def __contains__(self, admin_id: str) -> bool:
+        return admin_id in self._positions
+
+    @property
+    def admin_ids(self) -> list[str]:
+        return list(self._positions)
+
+    def get_features(self, admin_id: str) -> list[dict[str, Any]]:
+        """GeoJSON features of a region, usually one. Empty if the ID is unknown."""
+        return [self.features[position] for position in self._positions.get(admin_id, [])]
+
+    def get_gdf(self, admin_id: str) -> GeoDataFrame:
+        """GeoDataFrame of the features of a region. Empty if the ID is unknown."""
+        return self.gdf.iloc[self._positions.get(admin_id, [])]
+
+    def get_geometry(self, admin_id: str) -> BaseGeometry:
+        """Union of the geometries of a region, computed once.
+
+        :raises KeyError: Unknown admin ID
+        """
+        geometry = self._geometries.get(admin_id)
+        if geometry is None:
+            positions = self._positions[admin_id]
+            geometry = unary_union(self.gdf.geometry.values[positions])
+            self._geometries[admin_id] = geometry
+        return geometry
+
+    def _serialize(self):
+        with self._serialize_lock:
+            if self._collection_json is not None:
+                return
+            feature_json, collection = {}, []
+            for admin_id, positions in self._positions.items():
+                # IDs matching several features are ambiguous, they are not served by ID
+                if len(positions) == 1:
+                    feature_json[admin_id] = GzippedJson.dump(self.features[positions[0]])
+                for position in positions:
+                    feature = self.features[position]
+                    properties = {k: v for k, v in feature["properties"].items() if k != GEOJSON_ADMIN_KEY}
+                    collection.append(
+                        {"id": admin_id, "type": "Feature", "properties": properties, "geometry": feature["geometry"]}
+                    )
+            self._feature_json = feature_json
+            self._collection_json = GzippedJson.dump({"type": "FeatureCollection", "features": collection})
+
+    def get_feature_json(self, admin_id: str) -> GzippedJson | None:
+        """Pre-serialized GeoJSON feature of a region. None if the ID is unknown or matches several features."""
+        if self._feature_json is None:
+            self._serialize()
+        return self._feature_json.get(admin_id)  # type: ignore[union-attr]
+
+    def get_collection_json(self) -> GzippedJson:
+        """Pre-serialized FeatureCollection of all regions, with the admin ID as feature `id` instead of a
+        property."""
+        if self._collection_json is None:
+            self._serialize()
+        return self._collection_json  # type: ignore[return-value]
+
+    def warm_up(self):
+        """Serialize all features now instead of on the first request."""
+        self._serialize()
+
+    def query(self, geometry: BaseGeometry, predicate: str = "intersects") -> GeoDataFrame:
+        """All admin areas matching a spatial predicate with a geometry in EPSG:4326.
+
+        :param geometry: Geometry to query with
+        :param predicate: Shapely predicate evaluated on the candidates of the STRtree, defaults to "intersects"
+        :return: GeoDataFrame of matching features, in file order
+        """
+        return self.gdf.iloc[np.sort(self.tree.query(geometry, predicate=predicate))]
+
+
+def load_admin_areas(resolution: Resolution = "50m") -> AdminAreaStore:
+    """Get the admin area store of a resolution. It is loaded on first use and reloaded when the file changes.
+
+    :param resolution: Geometry resolution, defaults to "50m"
+    :return: AdminAreaStore
+    """
+    path = ADMIN_AREA_FILE_MAPPING[resolution]
+    mtime = path.stat().st_mtime_ns
+    cached = _stores.get(resolution)
+    if cached is None or cached[0] != mtime:
+        with _stores_lock:
+            cached = _stores.get(resolution)
+            if cached is None or cached[0] != mtime:
+                with gzip.open(path, "rt", encoding="utf-8") as f:
+                    cached = (mtime, AdminAreaStore(json.load(f)))
+                _stores[resolution] = cached
+    return cached[1]
+
+
+def warm_up_admin_areas():
+    """Load and pre-serialize the admin areas of all resolutions."""
+    for resolution in ADMIN_AREA_FILE_MAPPING:
+        load_admin_areas(resolution).warm_up()
@@ -1,11 +1,13 @@
-import gzip
 from datetime import date, timedelta
 from pathlib import Path
 
 import geopandas
 import pandas as pd
+from shapely.geometry.base import BaseGeometry
 
-from lib.config import ADMIN_AREA_FILE_MAPPING, DEFAULT_DATES_FILE, GEOJSON_ADMIN_KEY, STATIC_DIR, TILE_DENSITY_CSV
+from lib.admin_area_store import load_admin_areas
+from lib.config import DEFAULT_DATES_FILE, TILE_DENSITY_CSV
+from lib.static_tables import load_region_meta, load_table
 from lib.types import DatasetName, Resolution
 
 
@@ -16,19 +18,25 @@ def dates_from_csv(filename: str | Path | None = None, colname: str = "date") ->
     :param colname: Column name for the dates column, defaults to "date"
     :return: List of date strings in ISO format, sorted in ascending order
     """
-    df = pd.read_csv(filename or DEFAULT_DATES_FILE)
-    date_list = df[colname].dropna().sort_values().unique().tolist()
-    return date_list
+    filename = filename or DEFAULT_DATES_FILE
+    if isinstance(filename, Path) or "://" not in filename:
+        # Local files are parsed once per process
+        dates = load_table(filename, date_columns=[colname])[colname]
+    else:
+        dates = pd.to_datetime(pd.read_csv(filename)[colname])
+    date_list = dates.dropna().sort_values().unique()
+    return [d.strftime("%Y-%m-%d") for d in pd.DatetimeIndex(date_list)]
 
 
 def get_all_regions_gdf(resolution: Resolution = "50m") -> geopandas.GeoDataFrame:
     """Get a GeoDataFrame from a pre-defined GeoJSON file at a configurable resolution for all available regions.
 
+    The GeoDataFrame is loaded once per process and shared, it must not be modified in place.
+
     :param resolution: Geometry resolution, defaults to "50m"
     :return: GeoDataFrame
     """
-    with gzip.open(ADMIN_AREA_FILE_MAPPING[resolution]) as f:
-        return geopandas.read_file(f)
+    return load_admin_areas(resolution).gdf
 
 
 def get_region_avail_dates(admin_id: str, dataset: DatasetName = DatasetName.luojia) -> list[str]:
@@ -37,12 +45,10 @@ def get_region_avail_dates(admin_id: str, dataset: DatasetName = DatasetName.luo
     :param admin_id: Administrative ID of the region of interest
     :return: List of dates (string), in ISO format, sorted in ascending order
     """
-    country_meta = pd.read_csv(STATIC_DIR / "country_meta.csv.gz")
-    dates = country_meta[country_meta["country"] == admin_id]["date"]
-    dates = dates.sort_values().unique().tolist()
+    dates = load_region_meta().dates(admin_id)
     if dataset == DatasetName.blackmarble:
-        return [(date.fromisoformat(d) + timedelta(days=1)).isoformat() for d in dates]
-    return dates
+        dates = dates + timedelta(days=1)
+    return dates.strftime("%Y-%m-%d").tolist()
 
 
 def get_region_gdf(admin_id: str, resolution: Resolution = "50m") -> geopandas.GeoDataFrame:
@@ -51,37 +57,66 @@ def get_region_gdf(admin_id: str, resolution: Resolution = "50m") -> geopandas.G
     :param admin_id: Administrative ID for this region.
     :return: GeoDataFrame of region
     """
-    with gzip.open(ADMIN_AREA_FILE_MAPPING[resolution]) as f:
-        gdf = geopandas.read_file(f)
-    gdf = gdf[gdf[GEOJSON_ADMIN_KEY] == admin_id]
-    assert isinstance(gdf, geopandas.GeoDataFrame)
-    return gdf
+    return load_admin_areas(resolution).get_gdf(admin_id)
+
+
+def get_region_geometry(admin_id: str, resolution: Resolution = "50m") -> BaseGeometry:
+    """Get the geometry of a particular region, the union of all of its features.
 
+    :param admin_id: Administrative ID for this region.
+    :raises KeyError: Unknown admin ID
+    :return: Geometry in EPSG:4326
+    """
+    return load_admin_areas(resolution).get_geometry(admin_id)
+
+
+def get_regions_intersecting(geometry: BaseGeometry, resolution: Resolution = "50m") -> geopandas.GeoDataFrame:
+    """Get all regions intersecting a geometry, using the spatial index of the admin areas.
+
+    :param geometry: Geometry in EPSG:4326
+    :return: GeoDataFrame of intersecting regions
+    """
+    return load_admin_areas(resolution).query(geometry)
 
-def get_region_meta(path: str | Path | None = None):
+
+def get_region_meta(path: str | Path | None = None) -> pd.DataFrame:
     """Get a dataframe of metadata about regions and LuoJia tiles. The resulting dataframe has the following columns:
 
-    - `country`:   Alpha-3 Admin 0 country code of region
-    - `date`:      ISO date of tile
+    - `country`:   Alpha-3 Admin 0 country code of region (categorical)
+    - `date`:      Date of tile (datetime64)
     - `tile_name`: Name of the LuoJia tile
 
+    The dataframe is cached and shared, it must not be modified in place. Use `get_region_tiles` or
+    `lib.static_tables.load_region_meta` for indexed lookups by region and date.
+
     :param path: Path to file, if None uses default path.
-    :return: DataFrame with meta information
+    :return: DataFrame with meta information, sorted by country and date
+    """
+    return load_region_meta(path).frame
+
+
+def get_region_tiles(admin_id: str, date: date | str) -> list[str]:
+    """Get the names of all LuoJia tiles of a region on a date.
+
+    :param admin_id: Administrative ID of the region of interest
+    :param date: Date of the tiles
+    :return: List of tile names, empty if there are none
     """
-    path = Path(path) if path else STATIC_DIR / "country_meta.csv.gz"
-    return pd.read_csv(path, compression="infer")
+    return load_region_meta().tiles(admin_id, date)
 
 
 def get_tile_densities():
     """Get a dataframe containing information about tile density for each region
 
+    The dataframe is cached and shared, it must not be modified in place.
+
     :return: DataFrame with columns:
 
-        - `Date` (str): Date of tile
-        - `ISO_A3` (str): ISO-Alpha3 name of country
-        - `Country` (str): Full name of country
+        - `Date` (datetime64): Date of tile
+        - `ISO_A3` (categorical): ISO-Alpha3 name of country
+        - `Country` (categorical): Full name of country
         - `Count` (int): Number of tiles on this date
         - `Area_km2` (float): Country area in km^2
         - `CoverageFraction` (float): Fraction of country covered on this date
     """
-    return pd.read_csv(TILE_DENSITY_CSV)
+    return load_table(TILE_DENSITY_CSV, date_columns=["Date"], category_columns=["ISO_A3", "Country"])
@@ -1,9 +1,10 @@
 import datetime
-from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
 from typing import Literal, overload
 
 import geopandas
+import numpy as np
 import xarray as xr
 from blackmarble.raster import bm_raster
 from blackmarble.types import Product
@@ -15,9 +16,13 @@ from lib.config import (
     BM_DEFAULT_PRODUCT,
     BM_DEFAULT_QUALITY_FLAG,
     BM_DEFAULT_VARIABLE,
+    BM_DEFAULT_VARIABLES,
+    BM_HOST,
     BM_TOKEN,
 )
-from lib.types import Resolution, VNP46A1_Variable, VNP46A2_Variable
+from lib.downloader import DownloadJob, DownloadScheduler, print_progress
+from lib.types import Resolution, VNP46A1_Variable, VNP46A2_Variable, ZarrLayout
+from lib.zarr_store import zarr_append_journal, zarr_rechunk, zarr_recover, zarr_write
 
 
 def bm_get_unified_gdf(
@@ -50,7 +55,7 @@ def bm_download(
     gdf: GeoDataFrame,
     date_range: datetime.date | list[datetime.date],
     product: Literal[Product.VNP46A1],
-    variable: VNP46A1_Variable,
+    variable: VNP46A1_Variable | list[VNP46A1_Variable],
     drop_values_by_quality_flag: list[int] | None = None,
     use_cache: bool = True,
 ) -> xr.Dataset: ...
@@ -61,7 +66,7 @@ def bm_download(
     gdf: GeoDataFrame,
     date_range: datetime.date | list[datetime.date],
     product: Literal[Product.VNP46A2],
-    variable: VNP46A2_Variable,
+    variable: VNP46A2_Variable | list[VNP46A2_Variable],
     drop_values_by_quality_flag: list[int] | None = None,
     use_cache: bool = True,
 ) -> xr.Dataset: ...
@@ -71,29 +76,45 @@ def bm_download(
     gdf: "GeoDataFrame",
     date_range: datetime.date | list[datetime.date],
     product: Product,
-    variable: VNP46A1_Variable | VNP46A2_Variable,
+    variable: VNP46A1_Variable | VNP46A2_Variable | list[VNP46A1_Variable] | list[VNP46A2_Variable],
     drop_values_by_quality_flag: list[int] | None = None,
     use_cache: bool = True,
 ) -> xr.Dataset:
     """Downloads data from Blackmarble dataset for a given region and date range.
 
+    With a list of variables, the granule files are downloaded once and every variable is extracted from the local
+    copies, so the result holds all variables in a single dataset.
+
     :param gdf: GeoDataFrame of region of interest
     :param date_range: Single date or list of dates to download data for
-    :return: xarray.Dataset containing raster data
+    :param variable: Variable or list of variables of `product` to extract
+    :return: xarray.Dataset containing raster data, one data variable per requested variable
     """
     out_dir = BM_DATA_DIR / "raw"
     out_dir.mkdir(parents=True, exist_ok=True)
-    raster = bm_raster(
-        gdf,
-        product_id=product,
-        date_range=date_range,
-        bearer=BM_TOKEN,
-        output_directory=out_dir,
-        drop_values_by_quality_flag=drop_values_by_quality_flag or BM_DEFAULT_QUALITY_FLAG,
-        variable=variable,
-        output_skip_if_exists=use_cache,
-    )
-    return raster
+    variables = [variable] if isinstance(variable, str) else list(variable)
+
+    rasters = []
+    for i, name in enumerate(variables):
+        rasters.append(
+            bm_raster(
+                gdf,
+                product_id=product,
+                date_range=date_range,
+                bearer=BM_TOKEN,
+                output_directory=out_dir,
+                drop_values_by_quality_flag=drop_values_by_quality_flag or BM_DEFAULT_QUALITY_FLAG,
+                variable=name,
+                # Granules downloaded for the first variable are reused for the others
+                output_skip_if_exists=use_cache or i > 0,
+            )
+        )
+    return rasters[0] if len(rasters) == 1 else xr.merge(rasters, compat="override", join="exact")
+
+
+def bm_default_zarr_path() -> Path:
+    """Path of the Zarr store written by `bm_store_to_zarr` by default."""
+    return BM_DATA_DIR / "preprocessed" / f"{BM_DEFAULT_PRODUCT}-{BM_DEFAULT_VARIABLE}.zarr"
 
 
 def bm_store_to_zarr(
@@ -101,39 +122,84 @@ def bm_store_to_zarr(
     dates: list[datetime.date],
     dest: str | Path | None = None,
     force: bool = False,
+    append: bool = True,
+    layout: ZarrLayout = "timeseries",
 ) -> xr.Dataset:
     """Downloads Blackmarble data and stores it to a Zarr backend.
 
+    Dates are downloaded by a `DownloadScheduler` (bounded concurrency, per-host rate limit, retries with backoff).
+    If the store already exists, only dates missing from its `time` coordinate are downloaded and appended along
+    `time`, so extending a series by one day costs one day of work. Dates that fail after all retries do not discard
+    the others: successful dates are stored first, then the failure is raised. Appends are journaled (see
+    `zarr_append_journal`): if an append fails, the store is rolled back and stays readable. Appending keeps the `time`
+    coordinate sorted, so missing dates earlier than the last stored date are rejected; rewrite the store with `force`
+    to include them.
+
     :param gdf: GeoDataFrame of region of interest
     :param dates: List of dates to download
     :param dest: Path to Zarr store, defaults to None
-    :param force: Force re-downloading all files, defaults to False
+    :param force: Force re-downloading all files and rewriting the store, defaults to False
+    :param append: Append missing dates to an existing store, otherwise return it as is, defaults to True
+    :param layout: Chunk layout of a new store, see `zarr_encoding`. Appends keep the layout of the existing store.
+        Defaults to "timeseries"
+    :raises ValueError: Missing dates are earlier than the last stored date
     :return: Fresh reference to Zarr store
     """
     # Check if already preprocessed
-    zarr_path = (
-        Path(dest) if dest else (BM_DATA_DIR / "preprocessed" / f"{BM_DEFAULT_PRODUCT}-{BM_DEFAULT_VARIABLE}.zarr")
-    )
+    zarr_path = Path(dest) if dest else bm_default_zarr_path()
     zarr_path.parent.mkdir(parents=True, exist_ok=True)
-    if not force and zarr_path.exists():
-        print("Dataset already preprocessed, skipping...")
-        return bm_load_from_zarr(zarr_path)
+    exists = not force and zarr_path.exists()
+    if exists:
+        stored = bm_load_from_zarr(zarr_path)
+        if not append:
+            print("Dataset already preprocessed, skipping...")
+            return stored
+        stored_dates = set(stored["time"].values.astype("datetime64[D]"))
+        dates = sorted(set(date for date in dates if np.datetime64(date, "D") not in stored_dates))
+        if len(dates) == 0:
+            print("All dates already preprocessed, skipping...")
+            return stored
+        # Label slicing and the time series chunk layout need a monotonic `time` coordinate
+        last_stored = stored["time"].values.astype("datetime64[D]").max()
+        earlier = [date for date in dates if np.datetime64(date, "D") < last_stored]
+        if earlier:
+            raise ValueError(
+                f"{len(earlier)} missing date(s) are earlier than the last date in {zarr_path.name} ({last_stored}), "
+                f"appending them would leave `time` unsorted: {', '.join(str(date) for date in earlier[:5])}"
+                f"{', ...' if len(earlier) > 5 else ''}. Use --force to rewrite the store with all dates."
+            )
+        print(f"Appending {len(dates)} missing date(s) to {zarr_path.name}...")
 
     # Download all datasets for each date in parallel
     # Note: date_range does not download for each date individually, but for each date between any
     # dates in the list of dates! We need to download each date separately.
+    product = BM_DEFAULT_PRODUCT
+    variable = BM_DEFAULT_VARIABLE or BM_DEFAULT_VARIABLES[product]
+
     def process(date: datetime.date):
-        raster = bm_download(gdf, date)
+        raster = bm_download(gdf, date, product, variable)
         return raster
 
-    with ThreadPoolExecutor(max_workers=8) as executor:
-        results = executor.map(process, dates)
+    jobs = [DownloadJob(key=date, host=BM_HOST, func=partial(process, date)) for date in dates]
+    report = DownloadScheduler().run_sync(jobs, progress=print_progress)
+    results = [report.results[date] for date in dates if date in report.results]
+    if len(results) == 0:
+        report.raise_for_failures()
 
     # Combine all rasters into a single raster concatenated along time dimension
     combined = xr.concat(results, dim="time", data_vars="minimal", coords="minimal")
 
     # Store in Zarr format for later
-    combined.to_zarr(zarr_path)
+    if exists:
+        with zarr_append_journal(zarr_path, append_dim="time"):
+            combined.to_zarr(zarr_path, append_dim="time", consolidated=True)
+    else:
+        zarr_write(combined, zarr_path, layout)
+
+    # Dates that did succeed are stored, running again only downloads the failed ones
+    if not report.ok:
+        print(f"Failed to download {len(report.failures)} date(s): {', '.join(str(d) for d in report.failures)}")
+        report.raise_for_failures()
 
     # Loads fresh from disk
     return bm_load_from_zarr(zarr_path)
@@ -146,9 +212,30 @@ def bm_load_from_zarr(path: str | Path | None = None) -> xr.Dataset:
     :raises ValueError: Zarr store does not exist
     :return: Reference to Zarr dataset
     """
-    path = Path(path) if path else BM_DATA_DIR / "preprocessed" / f"{BM_DEFAULT_PRODUCT}-{BM_DEFAULT_VARIABLE}.zarr"
+    path = Path(path) if path else bm_default_zarr_path()
 
     if not path.exists():
         raise ValueError(f"File does not exist: {path}")
 
+    # Roll back an append that did not complete
+    if zarr_recover(path):
+        print(f"Rolled back interrupted append to {path.name}")
+
     return xr.open_zarr(path)
+
+
+def bm_rechunk_zarr(layout: ZarrLayout, path: str | Path | None = None, dest: str | Path | None = None) -> Path:
+    """Rewrite a Blackmarble Zarr store with another chunk layout, see `zarr_rechunk`.
+
+    :param layout: Target layout
+    :param path: Path to Zarr store, defaults to None
+    :param dest: Path to write the rechunked store to, defaults to None (replace the store)
+    :raises ValueError: Zarr store does not exist
+    :return: Path to the rechunked store
+    """
+    path = Path(path) if path else bm_default_zarr_path()
+
+    if not path.exists():
+        raise ValueError(f"File does not exist: {path}")
+
+    return zarr_rechunk(path, layout, dest)
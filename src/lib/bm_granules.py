@@ -0,0 +1,193 @@
+import datetime
+import math
+import os
+import uuid
+from functools import partial
+from pathlib import Path
+
+import geopandas
+import numpy as np
+import pandas as pd
+import rioxarray
+import xarray as xr
+from blackmarble.types import Product
+from geopandas import GeoDataFrame
+from rioxarray.merge import merge_arrays
+from shapely.geometry import box
+from shapely.geometry.base import BaseGeometry
+
+from lib.bm import bm_download
+from lib.config import BM_DATA_DIR, BM_DEFAULT_QUALITY_FLAG, BM_HOST
+from lib.downloader import DownloadJob, DownloadScheduler
+from lib.types import VNP46A1_Variable, VNP46A2_Variable
+
+# Black Marble products are distributed as granules on a global 10° x 10° lat/lon grid (h: 0-35 from west to east,
+# v: 0-17 from north to south), each 2400 x 2400 pixels of 15 arc seconds.
+BM_GRANULE_DEGREES = 10
+BM_GRANULE_PIXEL_DEGREES = 15 / 3600
+
+# Processed granules, shared by all regions: <product>/<variable>/<quality flags>/<date>/h<hh>v<vv>.tif
+BM_GRANULE_DIR = BM_DATA_DIR / "granules"
+
+
+def bm_granule_bounds(h: int, v: int) -> tuple[float, float, float, float]:
+    """Bounds of a granule in EPSG:4326.
+
+    :return: Tuple of (min lon, min lat, max lon, max lat)
+    """
+    minx = -180 + h * BM_GRANULE_DEGREES
+    maxy = 90 - v * BM_GRANULE_DEGREES
+    return minx, maxy - BM_GRANULE_DEGREES, minx + BM_GRANULE_DEGREES, maxy
+
+
+def bm_granules_for_geometry(geometry: BaseGeometry) -> list[tuple[int, int]]:
+    """Get all granules intersecting a geometry.
+
+    :param geometry: Region in EPSG:4326
+    :return: List of (h, v) tuples
+    """
+    minx, miny, maxx, maxy = geometry.bounds
+    h_min, h_max = (math.floor((lon + 180) / BM_GRANULE_DEGREES) for lon in (minx, maxx))
+    v_min, v_max = (math.floor((90 - lat) / BM_GRANULE_DEGREES) for lat in (maxy, miny))
+    h_range = range(max(0, h_min), min(360 // BM_GRANULE_DEGREES - 1, h_max) + 1)
+    v_range = range(max(0, v_min), min(180 // BM_GRANULE_DEGREES - 1, v_max) + 1)
+    granules = []
+    for v in v_range:
+        for h in h_range:
+            granule = box(*bm_granule_bounds(h, v))
+            # Regions ending exactly on a granule edge only touch the next granule
+            if granule.intersects(geometry) and not granule.touches(geometry):
+                granules.append((h, v))
+    return granules
+
+
+def _quality_key(quality_flags: list[int]) -> str:
+    return "qf-" + ("-".join(str(flag) for flag in sorted(quality_flags)) if quality_flags else "none")
+
+
+def bm_granule_path(
+    product: Product,
+    variable: VNP46A1_Variable | VNP46A2_Variable,
+    date: datetime.date,
+    h: int,
+    v: int,
+    quality_flags: list[int] | None = None,
+) -> Path:
+    """Path of a processed granule in the granule cache. The path is the index: it is derived from the granule key
+    only, so looking up a granule is a single `stat`.
+
+    :param quality_flags: Quality flag values that were dropped, defaults to BM_DEFAULT_QUALITY_FLAG
+    """
+    quality_flags = BM_DEFAULT_QUALITY_FLAG if quality_flags is None else quality_flags
+    return (
+        BM_GRANULE_DIR
+        / Product(product).name
+        / variable
+        / _quality_key(quality_flags)
+        / date.isoformat()
+        / f"h{h:02d}v{v:02d}.tif"
+    )
+
+
+def bm_list_granules() -> pd.DataFrame:
+    """List all processed granules in the cache.
+
+    :return: DataFrame with columns `product`, `variable`, `quality_flags`, `date`, `h`, `v` and `path`
+    """
+    rows = []
+    for path in BM_GRANULE_DIR.glob("*/*/*/*/h*v*.tif"):
+        product, variable, quality_flags, date = path.parts[-5:-1]
+        rows.append(
+            (product, variable, quality_flags, date, int(path.stem[1:3]), int(path.stem[4:6]), path),
+        )
+    return pd.DataFrame(rows, columns=["product", "variable", "quality_flags", "date", "h", "v", "path"])
+
+
+def _download_granule(
+    product: Product,
+    paths: dict[str, Path],
+    date: datetime.date,
+    h: int,
+    v: int,
+    quality_flags: list[int],
+):
+    # Shrink the granule by a fraction of a pixel, so the request does not touch (and download) neighbouring granules
+    margin = BM_GRANULE_PIXEL_DEGREES / 4
+    minx, miny, maxx, maxy = bm_granule_bounds(h, v)
+    gdf = GeoDataFrame(geometry=[box(minx + margin, miny + margin, maxx - margin, maxy - margin)], crs="EPSG:4326")
+    # All variables are extracted from the same downloaded granule file
+    raster = bm_download(gdf, date, product, list(paths), drop_values_by_quality_flag=quality_flags)
+
+    for variable, path in paths.items():
+        data_array = raster[variable].isel(time=0).rio.write_crs("EPSG:4326")
+
+        # Written to a temporary file and renamed into place, concurrent requests might process the same granule
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{uuid.uuid4().hex}.tmp")
+        try:
+            data_array.rio.to_raster(tmp_path, driver="GTiff", compress="LZW", tiled=True, windowed=True)
+            os.replace(tmp_path, path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+
+
+def bm_download_region(
+    gdf: GeoDataFrame,
+    date: datetime.date,
+    product: Product,
+    variable: VNP46A1_Variable | VNP46A2_Variable | list[VNP46A1_Variable] | list[VNP46A2_Variable],
+    drop_values_by_quality_flag: list[int] | None = None,
+    max_workers: int = 4,
+) -> xr.Dataset:
+    """Get Blackmarble data for a region, assembled from processed granules.
+
+    Granules are processed once and shared between all regions that intersect them, so neighbouring regions reuse each
+    other's work. Only granules missing from the cache are downloaded, with retries and backoff. Each granule file is
+    downloaded once for all of its missing variables.
+
+    :param gdf: GeoDataFrame of region of interest
+    :param date: Date to get data for
+    :param variable: Variable or list of variables of `product`
+    :param drop_values_by_quality_flag: Quality flag values to drop, defaults to BM_DEFAULT_QUALITY_FLAG
+    :param max_workers: Maximum number of granules processed in parallel, defaults to 4
+    :raises ValueError: Region does not intersect any granule
+    :return: xarray.Dataset with one data variable per requested variable on (time, y, x), clipped to the region
+        like `bm_download`
+    """
+    quality_flags = BM_DEFAULT_QUALITY_FLAG if drop_values_by_quality_flag is None else drop_values_by_quality_flag
+    gdf = gdf.to_crs("EPSG:4326") if gdf.crs is not None else gdf.set_crs("EPSG:4326")
+    geometry = gdf.union_all()
+
+    granules = bm_granules_for_geometry(geometry)
+    if len(granules) == 0:
+        raise ValueError("Region does not intersect any Blackmarble granule")
+    variables = [variable] if isinstance(variable, str) else list(variable)
+    paths = {
+        (h, v): {name: bm_granule_path(product, name, date, h, v, quality_flags) for name in variables}
+        for h, v in granules
+    }
+
+    jobs = []
+    for (h, v), granule_paths in paths.items():
+        missing = {name: path for name, path in granule_paths.items() if not path.exists()}
+        if missing:
+            func = partial(_download_granule, product, missing, date, h, v, quality_flags)
+            jobs.append(DownloadJob(key=(h, v), host=BM_HOST, func=func))
+    if jobs:
+        DownloadScheduler(concurrency=max_workers).run_sync(jobs).raise_for_failures()
+
+    data_arrays = {}
+    for name in variables:
+        arrays = [
+            rioxarray.open_rasterio(granule_paths[name], masked=True).squeeze("band", drop=True)
+            for granule_paths in paths.values()
+        ]
+        try:
+            merged = merge_arrays(arrays) if len(arrays) > 1 else arrays[0].load()
+            clipped = merged.rio.clip(geopandas.GeoSeries([geometry]), "EPSG:4326", drop=True)
+        finally:
+            for array in arrays:
+                array.close()
+        data_arrays[name] = clipped.expand_dims(time=[np.datetime64(date, "ns")])
+
+    return xr.Dataset(data_arrays)
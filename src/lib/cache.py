@@ -0,0 +1,412 @@
+import fcntl
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any
+
+
+@dataclass
+class CacheStats:
+    """Counters of a cache, per process."""
+
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+    def to_dict(self) -> dict[str, int]:
+        return asdict(self)
+
+
+class DiskCache:
+    """Size-bounded on-disk key/value cache with least-recently-used eviction.
+
+    Values are stored as one file per key, named after the SHA-1 of the key. The file mtime doubles as the last access
+    time (atime is unreliable on `noatime` mounts), so reads touch the file. Writes go to a temporary file that is
+    renamed into place, which makes the cache safe to share between processes.
+    """
+
+    def __init__(self, directory: str | Path, max_bytes: int):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._size: int | None = None  # Lazily computed on first write
+        self.stats = CacheStats()
+
+    def _path(self, key: str) -> Path:
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return self.directory / digest[:2] / digest
+
+    def get(self, key: str) -> bytes | None:
+        """Get a cached value and mark it as recently used.
+
+        :param key: Cache key
+        :return: Cached bytes, or None on a miss
+        """
+        path = self._path(key)
+        try:
+            data = path.read_bytes()
+            os.utime(path)
+        except FileNotFoundError:
+            self.stats.misses += 1
+            return None
+        self.stats.hits += 1
+        return data
+
+    def put(self, key: str, data: bytes):
+        """Store a value, evicting least-recently-used entries if the cache exceeds its budget.
+
+        Blocking, call it from a thread.
+
+        :param key: Cache key
+        :param data: Value to store
+        """
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{uuid.uuid4().hex}.tmp")
+        try:
+            tmp_path.write_bytes(data)
+            # Overwriting a key replaces its size instead of adding to it
+            try:
+                replaced = path.stat().st_size
+            except FileNotFoundError:
+                replaced = 0
+            os.replace(tmp_path, path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+
+        with self._lock:
+            if self._size is None:
+                self._size = self._disk_usage()
+            else:
+                self._size += len(data) - replaced
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _entries(self) -> list[tuple[int, int, str]]:
+        entries = []
+        if not self.directory.exists():
+            return entries
+        for subdir in self.directory.iterdir():
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir):
+                if entry.name.endswith(".tmp"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        return entries
+
+    def _disk_usage(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self):
+        # Rescan, other processes share the directory. Evict down to 90% of the budget to avoid evicting on every put.
+        entries = sorted(self._entries())
+        size = sum(size for _, size, _ in entries)
+        target = int(self.max_bytes * 0.9)
+        for _, entry_size, path in entries:
+            if size <= target:
+                break
+            try:
+                os.unlink(path)
+                size -= entry_size
+                self.stats.evictions += 1
+            except FileNotFoundError:
+                pass
+        self._size = size
+
+
+class HotCache:
+    """Small in-memory LRU cache of file contents, for the most requested files.
+
+    A file is only taken in once it was requested `min_hits` times, so one-off requests do not push out popular files.
+    Entries are keyed by path and invalidated when the file's mtime or size changes.
+    """
+
+    def __init__(self, max_bytes: int, max_item_bytes: int, min_hits: int = 2):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self.min_hits = min_hits
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[Path, tuple[tuple[int, int], bytes]] = OrderedDict()
+        self._requests: dict[Path, int] = {}
+        self._size = 0
+        self.stats = CacheStats()
+
+    def get(self, path: Path) -> bytes | None:
+        """Get the contents of a file, from memory if it is hot.
+
+        :param path: File path
+        :return: File contents if the file is (or just became) hot, None if it should be read from disk
+        """
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return None
+        version = (stat.st_mtime_ns, stat.st_size)
+
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(path)
+                self.stats.hits += 1
+                return entry[1]
+            self.stats.misses += 1
+            if stat.st_size > self.max_item_bytes or stat.st_size > self.max_bytes:
+                return None
+            requests = self._requests.get(path, 0) + 1
+            # Bounded like the entries, forget about files requested only once
+            if len(self._requests) >= 16 * 1024:
+                self._requests.clear()
+            self._requests[path] = requests
+            if requests < self.min_hits:
+                return None
+
+        data = path.read_bytes()
+        with self._lock:
+            old = self._entries.pop(path, None)
+            if old is not None:
+                self._size -= len(old[1])
+            self._entries[path] = (version, data)
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+                self.stats.evictions += 1
+        return data
+
+
+class RasterCache:
+    """Size-bounded on-disk cache of rendered rasters, with least-recently-used eviction and an in-memory hot tier.
+
+    The unit of caching and eviction is an entry directory, e.g. `<root>/<admin_id>/<date>`, holding the rasters,
+    metadata and source data of a region and date. Reads touch an access marker in the entry, whose mtime is the last
+    access time. Builds hold the entry lock (`lock_path`), and entries whose lock is held, or that were accessed within
+    the last `EVICTION_GRACE_SECONDS`, are never evicted. Files are written to temporary paths and renamed into place,
+    so readers never see partial files. The directories of all roots share one budget, across all processes using them.
+
+    Entry sizes are recorded in a size file in the entry, per top-level file or directory along with its mtime. Files
+    are only ever added or renamed into place, which changes the mtime of the directory holding them, so only the parts
+    changed since the last write are walked again.
+    """
+
+    ACCESS_FILE = ".access"
+    SIZE_FILE = ".size"
+    LOCKS_DIR = ".locks"
+    # Long enough for a request to send a raster it just looked up
+    EVICTION_GRACE_SECONDS = 60
+
+    def __init__(self, roots: list[Path], max_bytes: int, hot_max_bytes: int, hot_max_item_bytes: int):
+        self.roots = [Path(root) for root in roots]
+        self.max_bytes = max_bytes
+        self.hot = HotCache(hot_max_bytes, hot_max_item_bytes)
+        self.stats = CacheStats()
+        self._lock = threading.Lock()
+        self._sizes: dict[Path, int] | None = None  # Lazily computed on first write
+
+    def lock_path(self, entry_dir: Path) -> Path:
+        """Lock file of an entry, `<root>/.locks/<admin_id>/<date>.lock`. Kept outside the entry, so that evicting the
+        entry does not take the lock with it while a build waits on it."""
+        root = entry_dir.parent.parent
+        return root / self.LOCKS_DIR / entry_dir.parent.name / f"{entry_dir.name}.lock"
+
+    def _touch(self, entry_dir: Path):
+        try:
+            os.utime(entry_dir / self.ACCESS_FILE)
+        except FileNotFoundError:
+            (entry_dir / self.ACCESS_FILE).touch()
+
+    def get_meta(self, entry_dir: Path, raster_path: Path, meta_path: Path) -> dict[str, Any] | None:
+        """Look up a cached raster and mark its entry as recently used.
+
+        :param entry_dir: Entry directory the raster belongs to
+        :param raster_path: Raster file
+        :param meta_path: Pickled metadata of the raster
+        :return: Metadata dict, None on a miss. Unreadable metadata (e.g. from an older version) is a miss too.
+        """
+        try:
+            if not raster_path.exists():
+                raise FileNotFoundError(raster_path)
+            meta = pickle.loads(meta_path.read_bytes())
+            self._touch(entry_dir)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            self.stats.misses += 1
+            return None
+        self.stats.hits += 1
+        return meta
+
+    def put_meta(self, entry_dir: Path, meta_path: Path, meta: dict[str, Any]):
+        """Store the metadata of a raster, which completes it, and evict entries if the cache exceeds its budget.
+
+        Blocking, call it from a thread.
+
+        :param entry_dir: Entry directory the raster belongs to
+        :param meta_path: Path of the pickled metadata
+        :param meta: Metadata dict
+        """
+        meta_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = meta_path.with_name(f"{meta_path.name}.{os.getpid()}.{uuid.uuid4().hex}.tmp")
+        try:
+            tmp_path.write_bytes(pickle.dumps(meta))
+            os.replace(tmp_path, meta_path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+        self._touch(entry_dir)
+
+        with self._lock:
+            if self._sizes is None:
+                self._sizes = {entry: self._entry_size(entry) for entry in self._entries()}
+            else:
+                self._sizes[entry_dir] = self._entry_size(entry_dir)
+            if sum(self._sizes.values()) > self.max_bytes:
+                self._evict(keep=entry_dir)
+
+    def read_hot(self, raster_path: Path) -> bytes | None:
+        """Contents of a raster if it is among the most requested ones, None if it should be streamed from disk."""
+        return self.hot.get(raster_path)
+
+    def _entries(self) -> list[Path]:
+        # Names starting with a dot are temporary directories, being written or evicted, and the lock files
+        return [
+            entry
+            for root in self.roots
+            if root.exists()
+            for entry in root.glob("*/*")
+            if entry.is_dir() and not entry.name.startswith(".") and not entry.parent.name.startswith(".")
+        ]
+
+    def _access_time(self, entry_dir: Path) -> int | None:
+        marker = entry_dir / self.ACCESS_FILE
+        try:
+            return marker.stat().st_mtime_ns if marker.exists() else entry_dir.stat().st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _entry_size(self, entry_dir: Path) -> int:
+        size_path = entry_dir / self.SIZE_FILE
+        try:
+            recorded = json.loads(size_path.read_bytes())
+        except (OSError, ValueError):
+            recorded = {}
+        try:
+            children = list(os.scandir(entry_dir))
+        except FileNotFoundError:
+            return 0
+
+        sizes = {}
+        for child in children:
+            # Access marker, size file and temporary files
+            if child.name.startswith(".") or child.name.endswith(".tmp"):
+                continue
+            try:
+                stat = child.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            previous = recorded.get(child.name)
+            if previous is not None and previous[1] == stat.st_mtime_ns:
+                sizes[child.name] = previous
+            elif child.is_dir(follow_symlinks=False):
+                sizes[child.name] = [_directory_size(Path(child.path)), stat.st_mtime_ns]
+            else:
+                sizes[child.name] = [stat.st_size, stat.st_mtime_ns]
+
+        if sizes != recorded:
+            tmp_path = size_path.with_name(f"{size_path.name}.{os.getpid()}.{uuid.uuid4().hex}.tmp")
+            try:
+                tmp_path.write_text(json.dumps(sizes))
+                os.replace(tmp_path, size_path)
+            except FileNotFoundError:
+                pass  # Evicted meanwhile
+            finally:
+                tmp_path.unlink(missing_ok=True)
+        return sum(size for size, _ in sizes.values())
+
+    def _evict(self, keep: Path):
+        # Rescan, other processes share the directories. Evict down to 90% of the budget to avoid evicting on every put.
+        entries = []
+        for entry in self._entries():
+            atime = self._access_time(entry)
+            if atime is not None:
+                entries.append((atime, entry))
+        entries.sort()
+
+        sizes = {entry: self._entry_size(entry) for _, entry in entries}
+        total = sum(sizes.values())
+        target = int(self.max_bytes * 0.9)
+        for _, entry in entries:
+            if total <= target:
+                break
+            if entry == keep or not self._remove_entry(entry):
+                continue
+            total -= sizes.pop(entry)
+            self.stats.evictions += 1
+        self._sizes = sizes
+
+    def _remove_entry(self, entry_dir: Path) -> bool:
+        # Entries are only removed when no build holds their lock and nobody used them just now. Renamed first, so
+        # nobody sees a half-deleted entry.
+        lock_path = self.lock_path(entry_dir)
+        lock_path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            atime = self._access_time(entry_dir)
+            if atime is None or time.time_ns() - atime < self.EVICTION_GRACE_SECONDS * 1_000_000_000:
+                return False
+            trash = entry_dir.with_name(f".{entry_dir.name}.{uuid.uuid4().hex}.evicted")
+            try:
+                os.rename(entry_dir, trash)
+            except FileNotFoundError:
+                return False
+        finally:
+            os.close(fd)
+        shutil.rmtree(trash, ignore_errors=True)
+        return True
+
+
+def _directory_size(path: Path) -> int:
+    size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                size += os.stat(os.path.join(dirpath, filename)).st_size
+            except FileNotFoundError:
+                pass
+    return size
+
+
+@contextmanager
+def atomic_directory(path: Path):
+    """Write a directory (e.g. a Zarr store) atomically: the block writes to the yielded temporary directory, which
+    replaces `path` once the block completes. Nothing is changed if it raises.
+
+    :param path: Directory to create or replace
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{uuid.uuid4().hex}.tmp")
+    try:
+        yield tmp_path
+        if path.exists():
+            old_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}.old")
+            os.rename(path, old_path)
+            os.rename(tmp_path, path)
+            shutil.rmtree(old_path, ignore_errors=True)
+        else:
+            os.rename(tmp_path, path)
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
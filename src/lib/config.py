@@ -4,7 +4,7 @@ from pathlib import Path
 
 from blackmarble.types import Product
 
-from lib.types import Resolution
+from lib.types import Resolution, ZarrLayout
 
 # Note: This code runs whenever the module is first imported.
 # This is to make sure that the DATA_DIR and BEARER_TOKEN variables are appropriately set.
@@ -27,14 +27,46 @@ BM_DEFAULT_VARIABLES: dict[Product, str] = {
     Product.VNP46A3: "NearNadir_Composite_Snow_Free",
     Product.VNP46A4: "NearNadir_Composite_Snow_Free",
 }
+# Chunk shapes of the Zarr layouts, dimensions not listed are stored in a single chunk. Chunks along time may exceed
+# the number of stored dates, so appended dates fill up the last chunk instead of creating small ones.
+BM_ZARR_LAYOUTS: dict[ZarrLayout, dict[str, int]] = {
+    "timeseries": {"time": 365, "y": 128, "x": 128},
+    "map": {"time": 1, "y": 1024, "x": 1024},
+}
+BM_ZARR_CLEVEL = int(os.getenv("BM_ZARR_CLEVEL", 5))  # Zstd compression level
+BM_HOST = "ladsweb.modaps.eosdis.nasa.gov"  # Granules are served from LAADS DAAC
 
 # LuoJia constants
 LJ_DATA_DIR = DATA_DIR / "luojia"
 LJ_DEFAULT_IDS_FILE = STATIC_DIR / "luojia_image_ids.csv"
-LJ_TILE_URL_PREFIX = "https://polybox.ethz.ch/index.php/s/dnP82nHZkjR4gr7/download/file?path=%2F"
+LJ_TILE_URL_PREFIX = os.getenv(
+    "LJ_TILE_URL_PREFIX", "https://polybox.ethz.ch/index.php/s/dnP82nHZkjR4gr7/download/file?path=%2F"
+)
 LJ_METADATA_URL = "https://polybox.ethz.ch/index.php/s/dnP82nHZkjR4gr7/download/file?path=%2Fmetadata%2FMETA.tar.gz"
 LJ_METADATA_DOWNLOAD_DIR = LJ_DATA_DIR / "metadata"
 
+# Downloads: parallel jobs, requests per second per host, retries and exponential backoff (seconds)
+DOWNLOAD_CONCURRENCY = int(os.getenv("DOWNLOAD_CONCURRENCY", 8))
+DOWNLOAD_RATE_PER_HOST = float(os.getenv("DOWNLOAD_RATE_PER_HOST", 4))
+DOWNLOAD_RETRIES = int(os.getenv("DOWNLOAD_RETRIES", 5))
+DOWNLOAD_BACKOFF_BASE = float(os.getenv("DOWNLOAD_BACKOFF_BASE", 1.0))
+DOWNLOAD_BACKOFF_MAX = float(os.getenv("DOWNLOAD_BACKOFF_MAX", 60.0))
+
+# Map tiles
+TILE_CACHE_DIR = DATA_DIR / "tiles"
+TILE_CACHE_MAX_BYTES = int(os.getenv("TILE_CACHE_MAX_BYTES", 1024**3))  # 1 GiB
+
+# Rasters of /compare, cached per region and date in BM_DATA_DIR/cache and LJ_DATA_DIR/cache with a shared budget.
+# The most requested rasters up to RASTER_HOT_CACHE_MAX_ITEM_BYTES are also kept in memory, per worker process.
+RASTER_CACHE_MAX_BYTES = int(os.getenv("RASTER_CACHE_MAX_BYTES", 20 * 1024**3))  # 20 GiB
+RASTER_HOT_CACHE_MAX_BYTES = int(os.getenv("RASTER_HOT_CACHE_MAX_BYTES", 256 * 1024**2))  # 256 MiB
+RASTER_HOT_CACHE_MAX_ITEM_BYTES = int(os.getenv("RASTER_HOT_CACHE_MAX_ITEM_BYTES", 16 * 1024**2))  # 16 MiB
+
+# Background jobs (/jobs): jobs running at a time, jobs waiting at most, seconds finished jobs are kept
+JOBS_CONCURRENCY = int(os.getenv("JOBS_CONCURRENCY", 2))
+JOBS_MAX_QUEUED = int(os.getenv("JOBS_MAX_QUEUED", 32))
+JOBS_TTL = float(os.getenv("JOBS_TTL", 3600))
+
 # GeoJSON, dates, etc
 DEFAULT_DATES_FILE = STATIC_DIR / "defaults" / "dates_luojia_myanmar.csv"
 DEFAULT_GDF_FILE = "gadm41_MMR_1.geojson.gz"
@@ -51,6 +83,9 @@ CLOUD_API_KEY = "C6FNLY48VY2CHXVP2TD9534X4"
 # Region-level metrics
 TILE_DENSITY_CSV = STATIC_DIR / "tile_density" / "image_counts_with_density_patched.csv"
 
+# Parquet copies of the static CSV tables, see lib.static_tables
+STATIC_CACHE_DIR = DATA_DIR / "static"
+
 # Checks
 # Ensure data dirs exists
 for _d in [DATA_DIR, BM_DATA_DIR, LJ_DATA_DIR]:
@@ -0,0 +1,253 @@
+import asyncio
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Hashable
+from urllib.parse import urlsplit
+
+import requests
+
+from lib.config import (
+    DOWNLOAD_BACKOFF_BASE,
+    DOWNLOAD_BACKOFF_MAX,
+    DOWNLOAD_CONCURRENCY,
+    DOWNLOAD_RATE_PER_HOST,
+    DOWNLOAD_RETRIES,
+)
+from lib.single_flight import blocking_file_lock
+
+# HTTP status codes worth retrying, all other 4xx errors are permanent
+RETRYABLE_STATUS_CODES = {408, 425, 429, 500, 502, 503, 504}
+
+
+@dataclass
+class DownloadJob:
+    """A unit of work for the `DownloadScheduler`.
+
+    :param key: Identifies the job in the report, e.g. a date
+    :param host: Host the job talks to, rate limits apply per host. None for jobs pacing their own requests, e.g.
+        through `download_file`.
+    :param func: Blocking callable doing the work, run on a worker thread. Must be safe to call again after a failure.
+    """
+
+    key: Hashable
+    host: str | None
+    func: Callable[[], Any]
+
+
+@dataclass
+class DownloadReport:
+    """Outcome of `DownloadScheduler.run`."""
+
+    results: dict[Hashable, Any] = field(default_factory=dict)
+    failures: dict[Hashable, BaseException] = field(default_factory=dict)
+    attempts: dict[Hashable, int] = field(default_factory=dict)
+
+    @property
+    def ok(self) -> bool:
+        return len(self.failures) == 0
+
+    def raise_for_failures(self):
+        """Raise the error of the first failed job, if any."""
+        for key, error in self.failures.items():
+            raise RuntimeError(f"{len(self.failures)} download(s) failed, first: {key}") from error
+
+
+def _status_code(error: BaseException) -> int | None:
+    response = getattr(error, "response", None)
+    if response is not None:
+        return response.status_code
+    # Errors raised by the Blackmarble client carry the status directly
+    status = getattr(error, "status", None)
+    return status if isinstance(status, int) else None
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Whether a failed job should be retried: network errors and throttling/server errors are, client errors not."""
+    status = _status_code(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS_CODES
+    return not isinstance(error, (ValueError, TypeError, KeyError))
+
+
+def _retry_after(error: BaseException) -> float | None:
+    response = getattr(error, "response", None)
+    value = response.headers.get("Retry-After") if response is not None else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class HostRateLimiter:
+    """Spaces out requests to the same host, so at most `rate` requests per second start per host.
+
+    Shared by the event loop and worker threads: `wait` paces scheduler attempts, `acquire` paces individual HTTP
+    requests made on worker threads (see `download_file`).
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0.0
+        self._next: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def _reserve(self, host: str) -> float:
+        # Book the next free slot of the host, returns how long to wait for it
+        if self.interval == 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next.get(host, now))
+            self._next[host] = start + self.interval
+        return start - now
+
+    async def wait(self, host: str):
+        await asyncio.sleep(self._reserve(host))
+
+    def acquire(self, host: str):
+        """Blocking version of `wait`, for worker threads."""
+        delay = self._reserve(host)
+        if delay > 0:
+            time.sleep(delay)
+
+
+# Shared by all downloads of the process, so concurrent schedulers and downloads respect the same per-host rate
+host_rate_limiter = HostRateLimiter(DOWNLOAD_RATE_PER_HOST)
+
+
+class DownloadScheduler:
+    """Runs download jobs with bounded concurrency, per-host rate limits and retries with exponential backoff.
+
+    Jobs are independent: a failed job does not cancel the others, and the report tells which keys succeeded and which
+    failed, so callers can keep partial results and retry only the failures later.
+    """
+
+    def __init__(
+        self,
+        concurrency: int = DOWNLOAD_CONCURRENCY,
+        rate_limiter: HostRateLimiter | None = None,
+        retries: int = DOWNLOAD_RETRIES,
+        backoff_base: float = DOWNLOAD_BACKOFF_BASE,
+        backoff_max: float = DOWNLOAD_BACKOFF_MAX,
+    ):
+        self.concurrency = concurrency
+        self.rate_limiter = rate_limiter or host_rate_limiter
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    def backoff(self, attempt: int, error: BaseException | None = None) -> float:
+        """Delay before retry number `attempt` (starting at 1), with jitter. Honors `Retry-After` if the server sent
+        one."""
+        retry_after = _retry_after(error) if error is not None else None
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        return min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+
+    async def run(
+        self,
+        jobs: list[DownloadJob],
+        progress: Callable[[int, int, DownloadJob, BaseException | None], None] | None = None,
+    ) -> DownloadReport:
+        """Run all jobs.
+
+        :param jobs: Jobs to run, keys must be unique
+        :param progress: Called with (finished jobs, total jobs, job, error or None) whenever a job finishes
+        :return: Report with the results and failures by job key
+        """
+        report = DownloadReport()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        loop = asyncio.get_running_loop()
+
+        def finished(job: DownloadJob, error: BaseException | None):
+            if progress is not None:
+                progress(len(report.results) + len(report.failures), len(jobs), job, error)
+
+        async def run_job(job: DownloadJob, executor: ThreadPoolExecutor):
+            for attempt in range(1, self.retries + 2):
+                report.attempts[job.key] = attempt
+                async with semaphore:
+                    if job.host is not None:
+                        await self.rate_limiter.wait(job.host)
+                    try:
+                        report.results[job.key] = await loop.run_in_executor(executor, job.func)
+                        finished(job, None)
+                        return
+                    except Exception as e:
+                        error = e
+                if attempt > self.retries or not is_retryable(error):
+                    report.failures[job.key] = error
+                    finished(job, error)
+                    return
+                # Back off without holding a slot, other jobs keep going
+                await asyncio.sleep(self.backoff(attempt, error))
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            await asyncio.gather(*(run_job(job, executor) for job in jobs))
+        return report
+
+    def run_sync(
+        self,
+        jobs: list[DownloadJob],
+        progress: Callable[[int, int, DownloadJob, BaseException | None], None] | None = None,
+    ) -> DownloadReport:
+        """Blocking version of `run`, for callers without an event loop (CLI, worker threads)."""
+        return asyncio.run(self.run(jobs, progress))
+
+
+def print_progress(done: int, total: int, job: DownloadJob, error: BaseException | None):
+    status = "done" if error is None else f"failed ({error})"
+    print(f"[{done}/{total}] {job.key}: {status}")
+
+
+def download_file(
+    url: str,
+    dest: str | Path,
+    timeout: float = 30.0,
+    chunk_size: int = 64 * 1024,
+    rate_limiter: HostRateLimiter | None = None,
+) -> Path:
+    """Download a file, resuming a previous partial download if there is one.
+
+    Data is streamed to `<dest>.part`, which is kept if the download fails. The next call continues from where it
+    stopped using an HTTP range request (or starts over if the server does not support ranges). The complete file is
+    renamed to `dest`. Every request, including range requests resuming a download, is paced by the rate limiter.
+
+    Concurrent downloads of the same `dest`, across threads and processes, take turns on the lock file `<dest>.lock`.
+    A caller that had to wait returns the file the other one downloaded, an existing `dest` is never downloaded again.
+
+    :param url: URL to download
+    :param dest: Destination path
+    :param timeout: Connect/read timeout in seconds, defaults to 30
+    :param chunk_size: Bytes written per chunk, at most this much is lost when the connection drops, defaults to 64 KiB
+    :param rate_limiter: Per-host rate limiter, defaults to the one shared by the process
+    :raises requests.HTTPError: Download failure
+    :return: Destination path
+    """
+    dest = Path(dest)
+    with blocking_file_lock(dest.with_name(f"{dest.name}.lock")):
+        if dest.exists():
+            return dest
+        part = dest.with_name(f"{dest.name}.part")
+        offset = part.stat().st_size if part.exists() else 0
+
+        headers = {"Range": f"bytes={offset}-"} if offset > 0 else {}
+        (rate_limiter or host_rate_limiter).acquire(urlsplit(url).netloc)
+        with requests.get(url, headers=headers, stream=True, timeout=timeout) as response:
+            # Range starts at the end of the file, i.e. the previous attempt got everything but the rename
+            if response.status_code == 416 and offset > 0:
+                os.replace(part, dest)
+                return dest
+            response.raise_for_status()
+            if response.status_code != 206:
+                offset = 0
+            with open(part, "ab" if offset > 0 else "wb") as file:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    file.write(chunk)
+
+        os.replace(part, dest)
+    return dest
@@ -1,81 +1,73 @@
 import datetime
-import io
+import json
+import os
+import uuid
+from concurrent.futures import Executor
+from contextlib import contextmanager
 from pathlib import Path
 
 import geopandas
 import numpy as np
+import shapely
 import xarray as xr
 from geopandas import GeoDataFrame
-from osgeo import gdal, ogr
-from shapely.geometry import Polygon
+from osgeo import gdal
+from shapely.geometry import Polygon, box, mapping
 from shapely.geometry.base import BaseGeometry
 from shapely.ops import unary_union
 
-from lib.config import DATA_DIR, LJ_DATA_DIR, LJ_METADATA_URL
+from lib.config import DATA_DIR, LJ_DATA_DIR, LJ_METADATA_DOWNLOAD_DIR, LJ_METADATA_URL
+from lib.jobs import ReportProgress, report_nothing
 from lib.lj import lj_download_metadata, lj_download_tile
+from lib.lj_index import lj_get_footprints, lj_parse_footprint, lj_query_tiles
+from lib.raster_buffer import RasterBuffer
+from lib.stats import RasterSketch, merge_sketches
+from lib.types import ClipMode, CombineMode, Resampling
 
 DEBUG = False
 NODATA_VALUE = "nan"
+LJ_RESCALING_FACTOR = 0.3122 * (10**5)
+CONVERSION_VERSION = 3  # Bump whenever the output of convert_geotiff changes, invalidates converted tiles
+
+# Converted tiles and mosaics are written as tiled, compressed GeoTIFFs
+TILE_SIZE = 256
+TILED_CREATION_OPTIONS = [
+    "TILED=YES",
+    f"BLOCKXSIZE={TILE_SIZE}",
+    f"BLOCKYSIZE={TILE_SIZE}",
+    "COMPRESS=LZW",
+    "PREDICTOR=3",  # Floating point predictor
+]
+# Cloud-Optimized GeoTIFFs additionally carry internal overviews, so clients can fetch just the level they need
+COG_CREATION_OPTIONS = [
+    f"BLOCKSIZE={TILE_SIZE}",
+    "COMPRESS=LZW",
+    "PREDICTOR=YES",
+    "OVERVIEWS=AUTO",
+    "RESAMPLING=AVERAGE",
+]
+
+
+def output_format(cog: bool = False) -> tuple[str, list[str]]:
+    """Get the GDAL driver name and creation options for mosaics.
+
+    :param cog: Write a Cloud-Optimized GeoTIFF instead of a plain tiled GeoTIFF, defaults to False
+    :return: Tuple of (driver name, creation options)
+    """
+    if cog:
+        return "COG", COG_CREATION_OPTIONS
+    return "GTiff", TILED_CREATION_OPTIONS
 
 
 def get_geotiffs(gdf: "GeoDataFrame", date_range: datetime.date | list[datetime.date]) -> list[str]:
     """
     Get the list of geotiffs from the given GeoDataFrame and date range.
     """
-    # assume metadata is downloaded in DATA_DIR / "luojia" / "metadata"
-    relevant_geotiffs: list[str] = []
-    geotiff_metadata = LJ_DATA_DIR / "metadata"
-
-    # ensure metadata is downloaded
-    if not geotiff_metadata.exists():
+    # ensure metadata is downloaded, the footprint index is built from it
+    if not LJ_METADATA_DOWNLOAD_DIR.exists():
         lj_download_metadata(LJ_METADATA_URL)
 
-    # iterate through the geotiffs and check if they are in the date and location range
-    for geotiff in geotiff_metadata.glob("*.xml"):
-        # parse XML file
-        from xml.etree import ElementTree
-
-        tree = ElementTree.parse(geotiff)
-        # path to Metadata.ProductInfo.imagingTime
-        imaging_time = tree.findtext(".//imagingTime")
-        if imaging_time is None:
-            print(f"imagingTime not found in {geotiff}")
-            continue
-
-        # convert to datetime, format is 2018-6-3T5:50:57.157223
-        imaging_time = datetime.datetime.strptime(imaging_time, "%Y-%m-%dT%H:%M:%S.%f")
-        # check if the imaging time is in the date range
-        if isinstance(date_range, datetime.date):
-            if imaging_time.date() != date_range:
-                continue
-        elif isinstance(date_range, list):
-            if imaging_time.date() not in date_range:
-                continue
-
-        lt = (tree.findtext(".//LTLongitude"), tree.findtext(".//LTLatitude"))
-        rt = (tree.findtext(".//RTLongitude"), tree.findtext(".//RTLatitude"))
-        rb = (tree.findtext(".//RBLongitude"), tree.findtext(".//RBLatitude"))
-        lb = (tree.findtext(".//LBLongitude"), tree.findtext(".//LBLatitude"))
-        # check if the coordinates are valid
-        if any(x is None for x in (*lt, *rt, *rb, *lb)):
-            print(f"Coordinates not found in {geotiff}")
-            continue
-        geotiff_polygon = Polygon(
-            [
-                (float(lt[0]), float(lt[1])),
-                (float(rt[0]), float(rt[1])),
-                (float(rb[0]), float(rb[1])),
-                (float(lb[0]), float(lb[1])),
-            ]
-        )
-        intersects = get_intersection(gdf, geotiff_polygon)
-        if intersects:
-            geotiff_name = geotiff.name
-            # remove _meta.xml
-            geotiff_name = geotiff_name.replace("_meta.xml", "")
-            relevant_geotiffs.append(geotiff_name)
-
-    return relevant_geotiffs
+    return lj_query_tiles(gdf, date_range)
 
 
 def print_geotiff_metadata(geotiff: str):
@@ -136,16 +128,17 @@ def downsample_xarray(ds: xr.Dataset, factor: int = 2) -> xr.Dataset:
     return ds
 
 
-def empty_geotiff() -> bytes:
+def empty_geotiff() -> RasterBuffer:
     """
-    Create a minimal empty GeoTIFF with NaN as the no-data value and return it as bytes.
+    Create a minimal empty GeoTIFF with NaN as the no-data value.
 
     Returns:
-    - bytes: The GeoTIFF file as bytes.
+    - RasterBuffer: The GeoTIFF file, owned by the caller.
     """
-    # Create an in-memory file for the GeoTIFF
+    # Create an in-memory file for the GeoTIFF, unique per call as requests run concurrently
+    buffer = RasterBuffer()
     driver = gdal.GetDriverByName("GTiff")
-    dataset = driver.Create("/vsimem/temp.tif", 1, 1, 1, gdal.GDT_Float32)
+    dataset = driver.Create(buffer.path, 1, 1, 1, gdal.GDT_Float32)
 
     # Set the no-data value to NaN
     band = dataset.GetRasterBand(1)
@@ -156,210 +149,558 @@ def empty_geotiff() -> bytes:
 
     # Flush data to the virtual file system
     dataset.FlushCache()
+    dataset = None
 
-    # Read the dataset into a bytes object
-    vsi_file = gdal.VSIFOpenL("/vsimem/temp.tif", "rb")
-    gdal.VSIFSeekL(vsi_file, 0, 2)  # Seek to the end
-    size = gdal.VSIFTellL(vsi_file)  # Get the size of the file
-    gdal.VSIFSeekL(vsi_file, 0, 0)  # Seek to the beginning
+    return buffer
 
-    bytes_io = io.BytesIO()
-    buffer = bytearray(size)
-    gdal.VSIFReadL(size, size, vsi_file)
-    bytes_io.seek(0)
 
-    # Clean up
-    gdal.VSIFCloseL(vsi_file)
-    dataset = None
-    gdal.Unlink("/vsimem/temp.tif")
+def sketch_dataset(dataset: "gdal.Dataset") -> RasterSketch:
+    """Sketch of all values in the first band of a dataset, read window by window.
+
+    :param dataset: GDAL dataset
+    :return: Sketch of the band values
+    """
+    band = dataset.GetRasterBand(1)
+    sketch = RasterSketch()
+    for xoff, yoff, xsize, ysize in _iter_windows(dataset):
+        sketch.add(band.ReadAsArray(xoff, yoff, xsize, ysize))
+    return sketch
+
+
+def _clip_tiles(geotiff_list: list[str], clip_geometry: BaseGeometry | None, clip: ClipMode) -> list[str]:
+    # Tiles entirely outside of the region are never converted or read
+    if clip == "none" or clip_geometry is None:
+        return geotiff_list
+    region = clip_geometry if clip == "geometry" else box(*clip_geometry.bounds)
+    footprints = lj_get_footprints(geotiff_list)
+    return [geotiff for geotiff, footprint in zip(geotiff_list, footprints) if footprint.intersects(region)]
+
+
+def _target_size(dataset: "gdal.Dataset", max_size: int | None) -> dict[str, int]:
+    # Output width/height for gdal.Translate, preserving the aspect ratio. Never upsamples.
+    width, height = dataset.RasterXSize, dataset.RasterYSize
+    if max_size is None or max(width, height) <= max_size:
+        return {}
+    scale = max_size / max(width, height)
+    return {"width": max(1, round(width * scale)), "height": max(1, round(height * scale))}
+
+
+@contextmanager
+def _config_option(key: str, value: str):
+    """Set a GDAL config option for the current thread only, restoring the previous value afterwards."""
+    previous = gdal.GetThreadLocalConfigOption(key, None)
+    gdal.SetThreadLocalConfigOption(key, value)
+    try:
+        yield
+    finally:
+        gdal.SetThreadLocalConfigOption(key, previous)
+
+
+def _aligned_tiles(file_list: list[str], grid_dataset: "gdal.Dataset") -> list["gdal.Dataset"]:
+    """Every tile as a VRT on the pixel grid of `grid_dataset`, with the tile's footprint mask as mask band.
+
+    Nodata values are ignored (`srcNodata="None"`), so the mask band is the footprint mask stored with the converted
+    tile. Pixels outside the tile are NaN and masked.
+    """
+    x0, dx, _, y0, _, dy = grid_dataset.GetGeoTransform()
+    bounds = (x0, y0 + grid_dataset.RasterYSize * dy, x0 + grid_dataset.RasterXSize * dx, y0)
+    options = gdal.BuildVRTOptions(outputBounds=bounds, xRes=dx, yRes=abs(dy), srcNodata="None", VRTNodata=NODATA_VALUE)
+    return [gdal.BuildVRT("", [path], options=options) for path in file_list]
 
-    return bytes_io.getvalue()
 
+def _reduce_bands(grid_dataset: "gdal.Dataset", file_list: list[str], combine: CombineMode) -> RasterBuffer:
+    """Combine overlapping tiles into a single band on the grid of a mosaic, window by window.
 
-## problematic: noData from geotiffs overwrite actual data
-# need to take geometry into account
-def merge_geotiffs(geotiff_list) -> tuple[bytes, float, float, BaseGeometry]:
+    Validity is taken from the mask band of every tile, i.e. the footprint mask stored with the converted tile.
+
+    :param grid_dataset: Mosaic VRT of the tiles, defines the output grid
+    :param file_list: Paths to converted tiles
+    :param combine: "max" or "mean" of all valid values per pixel
+    :return: In-memory float32 GeoTIFF, owned by the caller
+    """
+    tiles = _aligned_tiles(file_list, grid_dataset)
+    buffer = RasterBuffer()
+    try:
+        driver = gdal.GetDriverByName("GTiff")
+        out_dataset = driver.Create(
+            buffer.path,
+            grid_dataset.RasterXSize,
+            grid_dataset.RasterYSize,
+            1,
+            gdal.GDT_Float32,
+            options=TILED_CREATION_OPTIONS,
+        )
+        out_dataset.SetGeoTransform(grid_dataset.GetGeoTransform())
+        out_dataset.SetProjection(grid_dataset.GetProjection())
+        out_band = out_dataset.GetRasterBand(1)
+        out_band.SetNoDataValue(float(NODATA_VALUE))
+
+        bands = [tile.GetRasterBand(1) for tile in tiles]
+        for xoff, yoff, xsize, ysize in _iter_windows(grid_dataset):
+            data = np.stack([band.ReadAsArray(xoff, yoff, xsize, ysize) for band in bands]).astype(np.float32)
+            valid = np.stack([band.GetMaskBand().ReadAsArray(xoff, yoff, xsize, ysize) > 0 for band in bands])
+            valid &= np.isfinite(data)
+            count = valid.sum(axis=0)
+            if combine == "max":
+                result = np.where(valid, data, -np.inf).max(axis=0)
+            else:
+                result = np.where(valid, data, 0).sum(axis=0) / np.maximum(count, 1)
+            result[count == 0] = np.nan
+            out_band.WriteArray(result.astype(np.float32), xoff, yoff)
+
+        out_band.FlushCache()
+        out_dataset = None
+    except BaseException:
+        buffer.close()
+        raise
+    return buffer
+
+
+@contextmanager
+def _mosaic_dataset(
+    file_list: list[str],
+    footprints: list[BaseGeometry],
+    clip_geometry: BaseGeometry | None = None,
+    clip: ClipMode = "none",
+    combine: CombineMode = "last",
+):
+    """Lazy mosaic of converted tiles as a VRT, optionally cropped or masked to a region.
+
+    Cropping happens in the VRT and masking in a warped VRT, so pixels outside the region are never read. Where tiles
+    overlap, only pixels inside each tile's footprint mask are considered: nodata values are ignored and the VRT
+    composites the tiles through their mask bands. "first" and "last" pick the first/last valid tile in `file_list`
+    order and stay lazy, "max" and "mean" are reduced block by block into an in-memory raster.
+
+    :param file_list: Paths to converted tiles
+    :param footprints: Footprints of the tiles
+    :param clip_geometry: Region geometry in EPSG:4326, defaults to None
+    :param clip: "bbox" crops to the bounding box of `clip_geometry`, "geometry" additionally masks pixels outside of
+        it, defaults to "none"
+    :param combine: How to combine overlapping tiles, defaults to "last"
+    :yield: GDAL dataset, only valid inside the context
+    """
+    # Validity comes from the footprint masks of the tiles, pixels without any valid tile are NaN
+    vrt_options = {"srcNodata": "None", "VRTNodata": NODATA_VALUE}
+    if clip != "none" and clip_geometry is not None:
+        minx, miny, maxx, maxy = clip_geometry.bounds
+        tiles_minx, tiles_miny, tiles_maxx, tiles_maxy = unary_union(footprints).bounds
+        vrt_options["outputBounds"] = (
+            max(minx, tiles_minx),
+            max(miny, tiles_miny),
+            min(maxx, tiles_maxx),
+            min(maxy, tiles_maxy),
+        )
+    if combine == "first":
+        # Later VRT sources are drawn on top
+        file_list = file_list[::-1]
+
+    reduced, cutline_path, warped_dataset = None, None, None
+    vrt_dataset = gdal.BuildVRT("", file_list, options=gdal.BuildVRTOptions(**vrt_options))
+    try:
+        if combine in ("max", "mean"):
+            reduced = _reduce_bands(vrt_dataset, file_list, combine)
+            vrt_dataset = gdal.Open(reduced.path)
+
+        if clip != "geometry" or clip_geometry is None:
+            yield vrt_dataset
+            return
+
+        cutline_path = f"/vsimem/{uuid.uuid4().hex}.geojson"
+        cutline = {"type": "Feature", "properties": {}, "geometry": mapping(clip_geometry)}
+        gdal.FileFromMemBuffer(cutline_path, json.dumps({"type": "FeatureCollection", "features": [cutline]}))
+        warp_options = gdal.WarpOptions(
+            format="VRT", cutlineDSName=cutline_path, srcNodata=NODATA_VALUE, dstNodata=NODATA_VALUE
+        )
+        warped_dataset = gdal.Warp("", vrt_dataset, options=warp_options)
+        yield warped_dataset
+    finally:
+        warped_dataset = None
+        vrt_dataset = None
+        if cutline_path is not None:
+            gdal.Unlink(cutline_path)
+        if reduced is not None:
+            reduced.close()
+
+
+def merge_geotiffs(
+    geotiff_list,
+    cog: bool = False,
+    executor: Executor | None = None,
+    clip_geometry: BaseGeometry | None = None,
+    clip: ClipMode = "none",
+    max_size: int | None = None,
+    resampling: Resampling = "average",
+    combine: CombineMode = "last",
+    report: ReportProgress = report_nothing,
+) -> tuple[RasterBuffer, float, float, BaseGeometry]:
     """Merge a list of geotiffs into a single large geotiff
 
+    The mosaic is translated straight from the VRT to a tiled, compressed GeoTIFF and is never fully materialized as an
+    array. Overlapping tiles are combined using their footprint masks, so pixels outside a tile's footprint never
+    overwrite data from another tile. Percentiles are those of the output, i.e. of the downsampled mosaic with
+    `max_size`. For "first"/"last" at full resolution without clipping, they are estimated by merging the value
+    sketches of the converted tiles (see `RasterSketch` for the error bound; pixels in the overlap of two tiles are
+    counted once per tile). Otherwise the sketch is built block by block from the output mosaic.
+
     :param geotiff_list: List of tile names of geotiffs to merge
-    :return: Tuple containing (buffer, 2nd percentile, 98th percentile)
+    :param cog: Output a Cloud-Optimized GeoTIFF with internal overviews, defaults to False
+    :param executor: Executor to convert tiles on in parallel, defaults to None (sequential)
+    :param clip_geometry: Region geometry in EPSG:4326 to clip the mosaic to, defaults to None
+    :param clip: Clip mode, see `_mosaic_dataset`, defaults to "none"
+    :param max_size: Downsample so that neither side exceeds this many pixels, defaults to None (full resolution)
+    :param resampling: Resampling kernel used when downsampling, defaults to "average"
+    :param combine: How to combine overlapping tiles, see `_mosaic_dataset`, defaults to "last"
+    :param report: Progress callback, called per converted tile ("converting") and before merging ("merging")
+    :raises TileConversionError: A tile failed to convert
+    :return: Tuple containing (buffer, 2nd percentile, 98th percentile, unified tile geometry). The caller owns the
+        buffer and must close it.
     """
-    if geotiff_list is None or len(geotiff_list) == 0:
+    geotiff_list = _clip_tiles(geotiff_list or [], clip_geometry, clip)
+    if len(geotiff_list) == 0:
         print("No geotiffs found, serving empty file")
-        return empty_geotiff(), 0, 0
-
-    file_list = [str(LJ_DATA_DIR / "tiles" / geotiff) + "_gec.tif" for geotiff in geotiff_list]
-
-    geometries = []
-    for file in file_list:
-        metadata_path = str(LJ_DATA_DIR / "metadata" / file.split("/")[-1].replace("_gec.tif", "_meta.xml"))
-        polygon = convert_geotiff(file, file.replace(".tif", "_float.tif"), metadata_path)
-        geometries.append(polygon)
-
-    new_file_list = [str(LJ_DATA_DIR / "tiles" / geotiff) + "_gec_float.tif" for geotiff in geotiff_list]
+        return empty_geotiff(), 0, 0, Polygon()
+
+    # Only converts tiles that have not been converted before (or whose source changed)
+    converted = convert_geotiffs(geotiff_list, executor=executor, report=report)
+    new_file_list = [str(path) for path, _ in converted]
+    geometries = lj_get_footprints(geotiff_list)
+    report("merging")
+
+    # Unique in-memory file, requests run concurrently
+    buffer = RasterBuffer()
+    driver_name, creation_options = output_format(cog)
+    try:
+        with _mosaic_dataset(new_file_list, geometries, clip_geometry, clip, combine) as mosaic_dataset:
+            target_size = _target_size(mosaic_dataset, max_size)
+            out_dataset = gdal.Translate(
+                buffer.path,
+                mosaic_dataset,
+                format=driver_name,
+                creationOptions=creation_options,
+                noData=NODATA_VALUE,
+                maskBand="none",  # Pixels outside all footprints are NaN, no separate mask needed
+                resampleAlg=resampling,
+                **target_size,
+            )
+
+        # Calculate the 2nd and 98th percentiles of the output, ignoring NaN values. The tile sketches describe it
+        # exactly unless it is clipped, combined or downsampled.
+        if (clip == "none" or clip_geometry is None) and combine in ("first", "last") and not target_size:
+            sketch = merge_sketches([sketch for _, sketch in converted])
+        else:
+            sketch = sketch_dataset(out_dataset)
+        pc02, pc98 = sketch.quantiles([0.02, 0.98])
+        out_dataset = None
+    except BaseException:
+        # Clean up the virtual file system
+        buffer.close()
+        raise
 
-    vrt_options = gdal.BuildVRTOptions(srcNodata=NODATA_VALUE)
-    vrt_dataset = gdal.BuildVRT("", new_file_list, options=vrt_options)
-
-    # Create an in-memory buffer to hold the GeoTIFF data
-    mem_driver = gdal.GetDriverByName("MEM")
-    mem_dataset = mem_driver.CreateCopy("", vrt_dataset, 0)
+    unified_geometry = unary_union(geometries)
 
-    compression_options = [
-        "COMPRESS=LZW"  # You can use other compression methods like 'DEFLATE' or 'JPEG'
-    ]
+    return buffer, pc02, pc98, unified_geometry
 
-    # Serialize the in-memory dataset to a byte buffer
-    buffer = io.BytesIO()
-    gdal.Translate(
-        "/vsimem/temp.tif", mem_dataset, format="GTiff", creationOptions=compression_options, noData=NODATA_VALUE
-    )
 
-    # Open the virtual file and read its content into the buffer
-    vsi_file = gdal.VSIFOpenL("/vsimem/temp.tif", "rb")
-    gdal.VSIFSeekL(vsi_file, 0, 2)  # Seek to the end of the file
-    file_size = gdal.VSIFTellL(vsi_file)  # Get the file size
-    gdal.VSIFSeekL(vsi_file, 0, 0)  # Seek back to the beginning
-    buffer.write(gdal.VSIFReadL(1, file_size, vsi_file))
-    buffer.seek(0)
+def merge_geotiffs_to_file(
+    geotiff_list,
+    output_name="merged.tif",
+    cog: bool = False,
+    executor: Executor | None = None,
+    clip_geometry: BaseGeometry | None = None,
+    clip: ClipMode = "none",
+    max_size: int | None = None,
+    resampling: Resampling = "average",
+    combine: CombineMode = "last",
+):
+    """Merge geotiffs into single large geotiff and save to file
 
-    data_array = mem_dataset.GetRasterBand(1).ReadAsArray()
+    :param geotiff_list: List of tile names to merge
+    :param output_name: Name of the output file, defaults to "merged.tif"
+    :param cog: Output a Cloud-Optimized GeoTIFF with internal overviews, defaults to False
+    :param executor: Executor to convert tiles on in parallel, defaults to None (sequential)
+    :param clip_geometry: Region geometry in EPSG:4326 to clip the mosaic to, defaults to None
+    :param clip: Clip mode, see `_mosaic_dataset`, defaults to "none"
+    :param max_size: Downsample so that neither side exceeds this many pixels, defaults to None (full resolution)
+    :param resampling: Resampling kernel used when downsampling, defaults to "average"
+    :param combine: How to combine overlapping tiles, see `_mosaic_dataset`, defaults to "last"
+    :raises TileConversionError: A tile failed to convert
+    """
+    geotiff_list = _clip_tiles(geotiff_list, clip_geometry, clip)
 
-    # Calculate the 2nd and 98th percentiles, ignoring NaN values
-    pc02 = np.nanpercentile(data_array, 2)
-    pc98 = np.nanpercentile(data_array, 98)
+    # Only converts tiles that have not been converted before (or whose source changed)
+    new_file_list = [str(path) for path, _ in convert_geotiffs(geotiff_list, executor=executor)]
+    geometries = lj_get_footprints(geotiff_list)
 
-    # Close the datasets
-    vrt_dataset = None
-    mem_dataset = None
+    output_file = LJ_DATA_DIR / output_name
 
-    # Clean up the virtual file system
-    gdal.Unlink("/vsimem/temp.tif")
+    # Translate VRT to TIFF
+    driver_name, creation_options = output_format(cog)
+    with _mosaic_dataset(new_file_list, geometries, clip_geometry, clip, combine) as mosaic_dataset:
+        gdal.Translate(
+            output_file,
+            mosaic_dataset,
+            format=driver_name,
+            creationOptions=creation_options,
+            noData=NODATA_VALUE,
+            maskBand="none",
+            resampleAlg=resampling,
+            **_target_size(mosaic_dataset, max_size),
+        )
 
     unified_geometry = unary_union(geometries)
+    return unified_geometry
 
-    return buffer.read(), pc02, pc98, unified_geometry
 
+class TileConversionError(RuntimeError):
+    """Raised when a LuoJia tile could not be converted."""
 
-def merge_geotiffs_to_file(geotiff_list, output_name="merged.tif"):
-    """Merge geotiffs into single large geotiff and save to file
+    def __init__(self, tile_name: str):
+        super().__init__(f"Failed to convert tile {tile_name}")
+        self.tile_name = tile_name
 
-    :param geotiff_list: List of tile names to merge
-    :param output_name: Name of the output file, defaults to "merged.tif"
-    """
-    file_list = [str(LJ_DATA_DIR / "tiles" / geotiff) + "_gec.tif" for geotiff in geotiff_list]
 
-    geometries = []
-    for file in file_list:
-        metadata_path = str(LJ_DATA_DIR / "metadata" / file.split("/")[-1].replace("_gec.tif", "_meta.xml"))
-        polygon = convert_geotiff(file, file.replace(".tif", "_float.tif"), metadata_path)
-        geometries.append(polygon)
+def convert_geotiffs(
+    geotiff_list: list[str], executor: Executor | None = None, report: ReportProgress = report_nothing
+) -> list[tuple[Path, RasterSketch]]:
+    """Get converted versions of all tiles, see `get_converted_geotiff`.
 
-    new_file_list = [str(LJ_DATA_DIR / "tiles" / geotiff) + "_gec_float.tif" for geotiff in geotiff_list]
+    Tiles are independent, so with an executor (e.g. the shared process pool of the API) they are converted in
+    parallel and a merge takes roughly as long as its slowest tile.
 
-    output_file = LJ_DATA_DIR / output_name
+    :param geotiff_list: List of tile names
+    :param executor: Executor to convert tiles on, defaults to None (sequential)
+    :param report: Progress callback, called as ("converting", fraction done) after each tile. If it raises (e.g.
+        because the work was cancelled), the remaining conversions are cancelled too.
+    :raises TileConversionError: A tile failed to convert, the remaining conversions are cancelled
+    :return: List of (path, sketch) tuples, in the same order as `geotiff_list`
+    """
+    if executor is None:
+        results = []
+        for geotiff in geotiff_list:
+            try:
+                results.append(get_converted_geotiff(geotiff))
+            except Exception as e:
+                raise TileConversionError(geotiff) from e
+            report("converting", len(results) / len(geotiff_list))
+        return results
+
+    futures = [executor.submit(get_converted_geotiff, geotiff) for geotiff in geotiff_list]
+    results = []
+    try:
+        for geotiff, future in zip(geotiff_list, futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                raise TileConversionError(geotiff) from e
+            report("converting", len(results) / len(geotiff_list))
+    except BaseException:
+        for pending in futures:
+            pending.cancel()
+        raise
+    return results
+
+
+def _window_size(block_size: int, raster_size: int) -> int:
+    # Smallest multiple of the source block size that covers at least one output tile
+    if block_size >= raster_size:
+        return raster_size
+    return block_size * -(-TILE_SIZE // block_size)
+
+
+def _iter_windows(dataset: "gdal.Dataset"):
+    """Iterate over (xoff, yoff, xsize, ysize) windows aligned to the blocks of the first band of `dataset`."""
+    block_x, block_y = dataset.GetRasterBand(1).GetBlockSize()
+    win_x = _window_size(block_x, dataset.RasterXSize)
+    win_y = _window_size(block_y, dataset.RasterYSize)
+    for yoff in range(0, dataset.RasterYSize, win_y):
+        for xoff in range(0, dataset.RasterXSize, win_x):
+            yield xoff, yoff, min(win_x, dataset.RasterXSize - xoff), min(win_y, dataset.RasterYSize - yoff)
+
+
+def _window_geotransform(geotransform, xoff: int, yoff: int) -> tuple[float, ...]:
+    x0, dx, rx, y0, ry, dy = geotransform
+    return (x0 + xoff * dx + yoff * rx, dx, rx, y0 + xoff * ry + yoff * dy, ry, dy)
+
+
+def _window_envelope(geotransform, xsize: int, ysize: int) -> Polygon:
+    x0, dx, rx, y0, ry, dy = geotransform
+    corners = ((0, 0), (xsize, 0), (xsize, ysize), (0, ysize))
+    return Polygon([(x0 + px * dx + py * rx, y0 + px * ry + py * dy) for px, py in corners])
+
+
+def _footprint_mask(footprint: Polygon, geotransform, xsize: int, ysize: int) -> np.ndarray:
+    """Rasterize a footprint polygon onto a window, without OGR.
+
+    A pixel is inside if its center is (even-odd rule), which matches `gdal.RasterizeLayer`. Footprints are
+    quadrilaterals, so this is a handful of vectorized comparisons per window.
+
+    :return: Boolean array of shape (ysize, xsize)
+    """
+    x0, dx, rx, y0, ry, dy = geotransform
+    cols = np.arange(xsize) + 0.5
+    rows = (np.arange(ysize) + 0.5)[:, None]
+    x = x0 + cols * dx + rows * rx
+    y = y0 + cols * ry + rows * dy
+    x, y = np.broadcast_arrays(x, y)
+
+    inside = np.zeros((ysize, xsize), dtype=bool)
+    coords = np.asarray(footprint.exterior.coords)
+    for (xa, ya), (xb, yb) in zip(coords[:-1], coords[1:]):
+        if ya == yb:
+            continue
+        crosses = (ya > y) != (yb > y)
+        inside ^= crosses & (x < xa + (y - ya) * (xb - xa) / (yb - ya))
+    return inside
+
+
+def _conversion_key(input_path: Path, nodata_value, rescaling_factor) -> dict:
+    stat = input_path.stat()
+    return {
+        "version": CONVERSION_VERSION,
+        "source_size": stat.st_size,
+        "source_mtime_ns": stat.st_mtime_ns,
+        "nodata": str(nodata_value),
+        "rescaling_factor": float(rescaling_factor),
+    }
 
-    vrt_options = gdal.BuildVRTOptions(srcNodata=NODATA_VALUE)
-    vrt_dataset = gdal.BuildVRT("", new_file_list, options=vrt_options)
 
-    # Translate VRT to TIFF
-    gdal.Translate(output_file, vrt_dataset, noData=NODATA_VALUE)
+def get_converted_geotiff(
+    tile_name: str, nodata_value=NODATA_VALUE, rescaling_factor=LJ_RESCALING_FACTOR, force: bool = False
+) -> tuple[Path, RasterSketch]:
+    """Get the float32 version of a downloaded LuoJia tile, converting it only if needed.
 
-    # Close the in-memory VRT dataset
-    vrt_dataset = None
+    Converted tiles are stored next to the source as `<tile>_gec_float.tif`, together with a `<tile>_gec_float.json`
+    sidecar holding the cache key (source size and mtime, conversion parameters) and the value sketch of the tile. The
+    tile is re-converted if the sidecar is missing or does not match. Outputs are renamed into place, so concurrent
+    readers never see partially written files.
 
-    unified_geometry = unary_union(geometries)
-    return unified_geometry
+    :param tile_name: LuoJia tile name
+    :param nodata_value: Fill value, defaults to NODATA_VALUE
+    :param rescaling_factor: Radiance rescaling factor, defaults to LJ_RESCALING_FACTOR
+    :param force: Convert even if a valid converted tile exists, defaults to False
+    :return: Tuple of (path to the converted tile, sketch of its values)
+    """
+    tiles_dir = LJ_DATA_DIR / "tiles"
+    input_path = tiles_dir / f"{tile_name}_gec.tif"
+    output_path = tiles_dir / f"{tile_name}_gec_float.tif"
+    sidecar_path = tiles_dir / f"{tile_name}_gec_float.json"
+    metadata_path = LJ_DATA_DIR / "metadata" / f"{tile_name}_meta.xml"
+
+    key = _conversion_key(input_path, nodata_value, rescaling_factor)
+    if not force and output_path.exists() and sidecar_path.exists():
+        try:
+            sidecar = json.loads(sidecar_path.read_text())
+            if sidecar["key"] == key:
+                return output_path, RasterSketch.from_dict(sidecar["sketch"])
+        except (OSError, KeyError, json.JSONDecodeError):
+            pass
+
+    # Unique temporary names, other workers might be converting the same tile
+    tmp_suffix = f".{os.getpid()}.{uuid.uuid4().hex}.tmp"
+    output_tmp = output_path.with_name(output_path.name + tmp_suffix)
+    sidecar_tmp = sidecar_path.with_name(sidecar_path.name + tmp_suffix)
+    sketch = RasterSketch()
+    try:
+        convert_geotiff(str(input_path), str(output_tmp), str(metadata_path), nodata_value, rescaling_factor, sketch)
+        sidecar_tmp.write_text(json.dumps({"key": key, "sketch": sketch.to_dict()}))
+        os.replace(output_tmp, output_path)
+        os.replace(sidecar_tmp, sidecar_path)
+    finally:
+        output_tmp.unlink(missing_ok=True)
+        sidecar_tmp.unlink(missing_ok=True)
+
+    return output_path, sketch
 
 
 # convert uint32 to float32,
-def convert_geotiff(input_path, output_path, metadata_path, nodata_value=NODATA_VALUE):
+def convert_geotiff(
+    input_path,
+    output_path,
+    metadata_path,
+    nodata_value=NODATA_VALUE,
+    rescaling_factor=LJ_RESCALING_FACTOR,
+    sketch: RasterSketch | None = None,
+):
     """Converts raw LuoJia uint32 GeoTIFFs to float32 GeoTIFFs
 
+    The conversion runs window by window (aligned to the source blocks), so only one window of the tile is held in
+    memory at a time. Pixels outside the tile footprint from the metadata file are set to `nodata_value`, and the
+    footprint is stored as an internal per-dataset mask band, which mosaics use to combine overlapping tiles.
+
     :param input_path: Path to raw LuoJia GeoTIFF
     :param output_path: Output path
     :param metadata_path: Path to LuoJia metadata file
     :param nodata_value: Fill value, defaults to NODATA_VALUE
+    :param rescaling_factor: Radiance rescaling factor, defaults to LJ_RESCALING_FACTOR
+    :param sketch: If given, all converted values inside the footprint are added to this sketch
+    :return: Footprint of the tile
     """
     # Open the input GeoTIFF file
     dataset = gdal.Open(input_path)
     geotransform = dataset.GetGeoTransform()
     projection = dataset.GetProjection()
     band = dataset.GetRasterBand(1)
+    nodata = np.float32(nodata_value)
+    # Radiance conversion formula is L = DN^(3/2) * 10^-10 * rescaling factor
+    scale = np.float32(10 ** (-10) * rescaling_factor)
+
+    # Footprint from metadata, rasterized into the mask window by window
+    _, footprint = lj_parse_footprint(metadata_path)
+    shapely.prepare(footprint)
+
+    # Footprint mask stored inside the GeoTIFF instead of a .msk sidecar, set for this thread only
+    with _config_option("GDAL_TIFF_INTERNAL_MASK", "YES"):
+        # Single tiled, compressed output
+        driver = gdal.GetDriverByName("GTiff")
+        out_dataset = driver.Create(
+            output_path,
+            dataset.RasterXSize,
+            dataset.RasterYSize,
+            1,
+            gdal.GDT_Float32,
+            options=TILED_CREATION_OPTIONS,
+        )
+        out_dataset.SetGeoTransform(geotransform)
+        out_dataset.SetProjection(projection)
+        out_band = out_dataset.GetRasterBand(1)
+        out_band.SetNoDataValue(float(nodata))
+        out_dataset.CreateMaskBand(gdal.GMF_PER_DATASET)
+        mask_band = out_band.GetMaskBand()
+
+        for xoff, yoff, xsize, ysize in _iter_windows(dataset):
+            window_geotransform = _window_geotransform(geotransform, xoff, yoff)
+            envelope = _window_envelope(window_geotransform, xsize, ysize)
+
+            # Window entirely outside of the footprint, no need to read or convert anything
+            if not footprint.intersects(envelope):
+                out_band.WriteArray(np.full((ysize, xsize), nodata, dtype=np.float32), xoff, yoff)
+                mask_band.WriteArray(np.zeros((ysize, xsize), dtype=np.uint8), xoff, yoff)
+                continue
 
-    # Read the data as a numpy array
-    data = band.ReadAsArray()
+            radiance = band.ReadAsArray(xoff, yoff, xsize, ysize).astype(np.float32)
+            np.power(radiance, np.float32(3 / 2), out=radiance)
+            radiance *= scale
 
-    # Apply the radiance conversion formula
-    radiance = (data ** (3 / 2)) * 10 ** (-10)
+            # Only rasterize the footprint for windows on its edge
+            if footprint.contains(envelope):
+                mask = np.full((ysize, xsize), 255, dtype=np.uint8)
+            else:
+                inside = _footprint_mask(footprint, window_geotransform, xsize, ysize)
+                radiance[~inside] = nodata
+                mask = np.where(inside, 255, 0).astype(np.uint8)
 
-    # Apply the user-defined rescaling factor
-    rescaling_factor_luojia = 0.3122 * (10**5)
-    radiance = radiance * rescaling_factor_luojia
+            if sketch is not None:
+                sketch.add(radiance)
+            out_band.WriteArray(radiance, xoff, yoff)
+            mask_band.WriteArray(mask, xoff, yoff)
 
-    driver = gdal.GetDriverByName("GTiff")
-    out_dataset = driver.Create(output_path, dataset.RasterXSize, dataset.RasterYSize, 1, gdal.GDT_Float32)
-    out_dataset.SetGeoTransform(dataset.GetGeoTransform())
-    out_dataset.SetProjection(dataset.GetProjection())
-    out_band = out_dataset.GetRasterBand(1)
-    out_band.WriteArray(radiance)
-    out_band.FlushCache()
-
-    # read metadata from the XML file
-    from xml.etree import ElementTree
-
-    tree = ElementTree.parse(metadata_path)
-    coordinates = {
-        "LT": (float(tree.findtext(".//LTLongitude") or 0.0), float(tree.findtext(".//LTLatitude") or 0.0)),
-        "RT": (float(tree.findtext(".//RTLongitude") or 0.0), float(tree.findtext(".//RTLatitude") or 0.0)),
-        "RB": (float(tree.findtext(".//RBLongitude") or 0.0), float(tree.findtext(".//RBLatitude") or 0.0)),
-        "LB": (float(tree.findtext(".//LBLongitude") or 0.0), float(tree.findtext(".//LBLatitude") or 0.0)),
-    }
-
-    ring = ogr.Geometry(ogr.wkbLinearRing)
-    ring.AddPoint(coordinates["LT"][0], coordinates["LT"][1])
-    ring.AddPoint(coordinates["RT"][0], coordinates["RT"][1])
-    ring.AddPoint(coordinates["RB"][0], coordinates["RB"][1])
-    ring.AddPoint(coordinates["LB"][0], coordinates["LB"][1])
-    ring.AddPoint(coordinates["LT"][0], coordinates["LT"][1])  # Close the ring
-
-    polygon = ogr.Geometry(ogr.wkbPolygon)
-    polygon.AddGeometry(ring)
-
-    # Create a memory layer to hold the polygon
-    mem_driver = ogr.GetDriverByName("MEMORY")
-    mem_source = mem_driver.CreateDataSource("memData")
-    mem_layer = mem_source.CreateLayer("memLayer", srs=ogr.osr.SpatialReference(wkt=projection))
-    feature = ogr.Feature(mem_layer.GetLayerDefn())
-    feature.SetGeometry(polygon)
-    mem_layer.CreateFeature(feature)
-
-    # Rasterize the polygon to create a mask
-    driver = gdal.GetDriverByName("MEM")
-    mask_dataset = driver.Create("", dataset.RasterXSize, dataset.RasterYSize, 1, gdal.GDT_Byte)
-    mask_dataset.SetGeoTransform(geotransform)
-    mask_dataset.SetProjection(projection)
-    gdal.RasterizeLayer(mask_dataset, [1], mem_layer, burn_values=[1])
-    mask = mask_dataset.GetRasterBand(1).ReadAsArray()
-
-    # Apply the mask to set values outside the mask to 1
-    radiance[mask == 0] = nodata_value
-
-    # Create a new GeoTIFF file to save the result
-    driver = gdal.GetDriverByName("GTiff")
-    out_dataset = driver.Create(output_path, dataset.RasterXSize, dataset.RasterYSize, 1, gdal.GDT_Float32)
-    out_dataset.SetGeoTransform(geotransform)
-    out_dataset.SetProjection(projection)
-    out_band = out_dataset.GetRasterBand(1)
-    out_band.WriteArray(radiance)
-    out_band.FlushCache()
-    # Close the datasets
-    dataset = None
-    out_dataset = None
+        # Close the datasets
+        out_band.FlushCache()
+        mask_band.FlushCache()
+        dataset = None
+        out_dataset = None
 
-    # Create shapely polygon for returning
-    shapely_polygon = Polygon([coordinates["LT"], coordinates["RT"], coordinates["RB"], coordinates["LB"]])
-    return shapely_polygon
+    return footprint
 
 
 if __name__ == "__main__":
@@ -385,7 +726,7 @@ if __name__ == "__main__":
         lj_download_tile(geotiff)
 
     # merge geotiffs
-    geotiff, pc02, pc98 = merge_geotiffs(geotiff_list)
+    merge_geotiffs_to_file(geotiff_list)
 
     # get xarray
     ds = get_xarray_from_geotiff("merged.tif")
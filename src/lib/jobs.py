@@ -0,0 +1,176 @@
+import asyncio
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Hashable, Literal, TypeVar
+
+T = TypeVar("T")
+
+JobStatus = Literal["queued", "running", "done", "failed", "cancelled"]
+
+# Called with the current stage and optionally the progress within it (0-1)
+ReportProgress = Callable[[str, float | None], None]
+
+
+def report_nothing(stage: str, progress: float | None = None):
+    pass
+
+
+class JobQueueFull(Exception):
+    """Raised when submitting a job while the queue is full."""
+
+
+class WorkCancelled(Exception):
+    """Raised by `report` in a worker thread once the work it reports on was cancelled."""
+
+
+async def to_thread_cancellable(func: Callable[..., T], *args, report: ReportProgress = report_nothing, **kwargs) -> T:
+    """Run a blocking function in a thread, and stop it cooperatively when the caller is cancelled.
+
+    `func` is called with a `report` keyword argument that forwards to `report`, and raises `WorkCancelled` once the
+    caller was cancelled, so the work stops at its next progress report. The cancellation only propagates once the
+    thread returned, cancelled work does not keep running outside of concurrency limits and resources it holds (e.g.
+    in-memory rasters) are released by the function itself.
+
+    :param func: Blocking function to run, must accept `report`
+    :param report: Progress callback, defaults to report_nothing
+    :return: Result of `func`
+    """
+    cancelled = threading.Event()
+
+    def checked_report(stage: str, progress: float | None = None):
+        if cancelled.is_set():
+            raise WorkCancelled(stage)
+        report(stage, progress)
+
+    future = asyncio.ensure_future(asyncio.to_thread(func, *args, report=checked_report, **kwargs))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        cancelled.set()
+        while not future.done():
+            try:
+                await asyncio.wait([future])
+            except asyncio.CancelledError:
+                pass
+        # Mark the exception as retrieved, most likely the WorkCancelled raised by `report`
+        future.exception()
+        raise
+
+
+@dataclass
+class Job:
+    """State of a job. `stage` and `progress` are updated by the job function through `report`."""
+
+    id: str
+    key: Hashable
+    status: JobStatus = "queued"
+    stage: str = "queued"
+    progress: float | None = None
+    result: Any = None
+    error: Any = None
+    error_status_code: int | None = None
+    created: float = field(default_factory=time.time)
+    finished: float | None = None
+    task: "asyncio.Task | None" = field(default=None, repr=False)
+
+    @property
+    def active(self) -> bool:
+        return self.status in ("queued", "running")
+
+    def report(self, stage: str, progress: float | None = None):
+        """Report the current stage, and optionally the progress within it (0-1). Safe to call from worker threads."""
+        self.stage = stage
+        self.progress = progress
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "id": self.id,
+            "status": self.status,
+            "stage": self.stage,
+            "progress": self.progress,
+            "error": self.error,
+            "created": self.created,
+            "finished": self.finished,
+        }
+
+
+class JobManager:
+    """Runs jobs in the background, at most `concurrency` at a time.
+
+    At most `max_queued` jobs wait for a slot, further submissions raise `JobQueueFull`. Jobs with the same key are
+    deduplicated: submitting a job whose key matches a queued, running or successfully finished job returns that job.
+    Finished jobs are kept for `ttl` seconds. Jobs live in the memory of the process that accepted them.
+    """
+
+    def __init__(self, concurrency: int, max_queued: int, ttl: float):
+        self.concurrency = concurrency
+        self.max_queued = max_queued
+        self.ttl = ttl
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._jobs: dict[str, Job] = {}
+        self._by_key: dict[Hashable, Job] = {}
+
+    def submit(self, key: Hashable, func: Callable[[Job], Awaitable[Any]]) -> tuple[Job, bool]:
+        """Submit a job, unless an identical one exists. Must be called from the event loop.
+
+        :param key: Identifies the work, all parameters affecting the result must be part of it
+        :param func: Coroutine function doing the work, called with the job to report progress on
+        :raises JobQueueFull: Too many jobs are waiting
+        :return: Tuple of (job, whether it was newly created)
+        """
+        self._prune()
+        existing = self._by_key.get(key)
+        if existing is not None and (existing.active or existing.status == "done"):
+            return existing, False
+        if sum(job.status == "queued" for job in self._jobs.values()) >= self.max_queued:
+            raise JobQueueFull(f"{self.max_queued} jobs are already waiting")
+
+        job = Job(id=uuid.uuid4().hex, key=key)
+        self._jobs[job.id] = job
+        self._by_key[key] = job
+        job.task = asyncio.ensure_future(self._run(job, func))
+        return job, True
+
+    async def _run(self, job: Job, func: Callable[[Job], Awaitable[Any]]):
+        try:
+            async with self._semaphore:
+                job.status = "running"
+                job.report("running")
+                job.result = await func(job)
+            job.status = "done"
+            job.report("done", 1.0)
+        except asyncio.CancelledError:
+            job.status = "cancelled"
+            job.report("cancelled")
+        except Exception as e:
+            # HTTPExceptions raised by the work keep their status code and detail
+            job.status = "failed"
+            job.error = getattr(e, "detail", None) or str(e)
+            job.error_status_code = getattr(e, "status_code", 500)
+            job.report("failed")
+        finally:
+            job.finished = time.time()
+
+    def get(self, job_id: str) -> Job | None:
+        self._prune()
+        return self._jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> Job | None:
+        """Cancel a queued or running job. Work shared with other requests keeps running for them.
+
+        :return: The job, None if the ID is unknown
+        """
+        job = self._jobs.get(job_id)
+        if job is not None and job.active and job.task is not None:
+            job.task.cancel()
+        return job
+
+    def _prune(self):
+        now = time.time()
+        for job in list(self._jobs.values()):
+            if job.finished is not None and now - job.finished > self.ttl:
+                del self._jobs[job.id]
+                if self._by_key.get(job.key) is job:
+                    del self._by_key[job.key]
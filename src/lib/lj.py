@@ -6,8 +6,11 @@ from shapely import Polygon
 from shapely.geometry.base import BaseGeometry
 from shapely.ops import unary_union
 
-from lib.admin_areas import get_region_meta
+from lib.admin_areas import get_region_tiles
 from lib.config import LJ_DATA_DIR, LJ_METADATA_DOWNLOAD_DIR, LJ_METADATA_URL, LJ_TILE_URL_PREFIX
+from lib.downloader import download_file
+from lib.lj_index import lj_get_footprints
+from lib.single_flight import blocking_file_lock
 
 
 def lj_download_metadata(metadata_url: str = LJ_METADATA_URL):
@@ -49,24 +52,25 @@ def lj_download_tile(tile_name: str):
     tile_path = LJ_DATA_DIR / "tiles"
     tile_path.mkdir(parents=True, exist_ok=True)
 
-    # Check if any file in the directory contains the tile_name
-    if any(tile_name in file.name for file in tile_path.iterdir()):
-        print(f"Tile {tile_name} already exists, skipping download...")
-        return
+    # Concurrent requests (e.g. neighbouring map tiles or regions) share source tiles, one of them downloads and
+    # extracts it while the others wait, then find it extracted
+    with blocking_file_lock(tile_path / f"{tile_name}.extract.lock"):
+        # Check if any file in the directory contains the tile_name, partial downloads are resumed below
+        if any(tile_name in file.name and not file.name.endswith((".part", ".lock")) for file in tile_path.iterdir()):
+            print(f"Tile {tile_name} already exists, skipping download...")
+            return
 
-    tile_file = tile_path / (tile_name + ".tar.gz")
-    response = requests.get(tile_url, timeout=30.0)
-    if response.status_code >= 400:
-        raise requests.HTTPError("Failed to download tile. Please double-check the URL and try again.")
-    tile_file.write_bytes(response.content)
+        # Streamed to disk, an interrupted download resumes where it stopped
+        tile_file = tile_path / (tile_name + ".tar.gz")
+        download_file(tile_url, tile_file)
 
-    # Unpack the tar.gz file
-    with tarfile.open(tile_file, "r:gz") as tar:
-        tar.extractall(path=tile_path)
-        print("Tile successfully extracted")
+        # Unpack the tar.gz file
+        with tarfile.open(tile_file, "r:gz") as tar:
+            tar.extractall(path=tile_path)
+            print("Tile successfully extracted")
 
-    # Delete the tar.gz file after extraction
-    tile_file.unlink()
+        # Delete the tar.gz file after extraction
+        tile_file.unlink()
 
 
 def lj_select_tiles(admin_id: str, date: str) -> list[str]:
@@ -76,9 +80,7 @@ def lj_select_tiles(admin_id: str, date: str) -> list[str]:
     :param date: Date in ISO format
     :return: List of relevant tiles
     """
-    region_meta = get_region_meta()
-    region_meta = region_meta[(region_meta["country"] == admin_id) & (region_meta["date"] == date)]
-    return region_meta["tile_name"].tolist()
+    return get_region_tiles(admin_id, date)
 
 
 def lj_get_tile_metadata(tile_name: str) -> dict:
@@ -120,8 +122,7 @@ def lj_get_region_geometry(admin_id: str, date: str) -> BaseGeometry:
     :return: Polygon containing unified outline
     """
     relevant_tiles = lj_select_tiles(admin_id, date)
-    all_metadata = [lj_get_tile_metadata(tile_name) for tile_name in relevant_tiles]
-    geometries = [lj_get_bounding_geometry(meta) for meta in all_metadata]
+    geometries = lj_get_footprints(relevant_tiles)
     unified_geometry = unary_union(geometries)
     return unified_geometry
 
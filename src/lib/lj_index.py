@@ -0,0 +1,167 @@
+import datetime
+import json
+import os
+import threading
+from pathlib import Path
+from xml.etree import ElementTree
+
+import geopandas
+import numpy as np
+from geopandas import GeoDataFrame
+from shapely import STRtree
+from shapely.geometry import Polygon
+from shapely.geometry.base import BaseGeometry
+
+from lib.config import LJ_DATA_DIR, LJ_METADATA_DOWNLOAD_DIR
+
+# Persistent footprint index: one row per tile with its imaging time and footprint quadrilateral. The index is rebuilt
+# whenever the mtime of the metadata directory changes, i.e. when metadata files are added, removed or re-extracted.
+LJ_INDEX_DIR = LJ_DATA_DIR / "index"
+LJ_INDEX_FILE = LJ_INDEX_DIR / "footprints.parquet"
+LJ_INDEX_SIGNATURE_FILE = LJ_INDEX_DIR / "footprints.json"
+
+_index_lock = threading.Lock()
+_index_cache: "tuple[int, GeoDataFrame, STRtree, np.ndarray] | None" = None
+
+
+def lj_parse_footprint(metadata_path: str | Path) -> tuple[datetime.datetime, Polygon]:
+    """Parse the imaging time and footprint quadrilateral from a LuoJia metadata XML file.
+
+    :param metadata_path: Path to `<tile>_meta.xml`
+    :raises ValueError: Imaging time or corner coordinates are missing
+    :return: Tuple of (imaging time, footprint polygon in EPSG:4326)
+    """
+    tree = ElementTree.parse(metadata_path)
+
+    # Format is e.g. 2018-6-3T5:50:57.157223, some files omit the fractional seconds
+    imaging_time = tree.findtext(".//imagingTime")
+    if imaging_time is None:
+        raise ValueError(f"imagingTime not found in {metadata_path}")
+    try:
+        time = datetime.datetime.strptime(imaging_time, "%Y-%m-%dT%H:%M:%S.%f")
+    except ValueError:
+        time = datetime.datetime.strptime(imaging_time, "%Y-%m-%dT%H:%M:%S")
+
+    corners = []
+    for corner in ("LT", "RT", "RB", "LB"):
+        lon, lat = tree.findtext(f".//{corner}Longitude"), tree.findtext(f".//{corner}Latitude")
+        if lon is None or lat is None:
+            raise ValueError(f"Coordinates not found in {metadata_path}")
+        corners.append((float(lon), float(lat)))
+
+    return time, Polygon(corners)
+
+
+def _metadata_signature(metadata_dir: Path) -> int:
+    return metadata_dir.stat().st_mtime_ns
+
+
+def lj_build_footprint_index(metadata_dir: str | Path | None = None) -> GeoDataFrame:
+    """Parse all metadata files and write the footprint index to `LJ_INDEX_FILE`.
+
+    :param metadata_dir: Directory with `*_meta.xml` files, defaults to `LJ_METADATA_DOWNLOAD_DIR`
+    :return: GeoDataFrame with columns `tile_name`, `imaging_time` and `geometry`
+    """
+    metadata_dir = Path(metadata_dir) if metadata_dir else LJ_METADATA_DOWNLOAD_DIR
+    signature = _metadata_signature(metadata_dir)
+
+    rows = []
+    for metadata_file in sorted(metadata_dir.glob("*_meta.xml")):
+        try:
+            imaging_time, footprint = lj_parse_footprint(metadata_file)
+        except (ValueError, ElementTree.ParseError) as e:
+            print(f"Skipping {metadata_file.name}: {e}")
+            continue
+        rows.append((metadata_file.name.removesuffix("_meta.xml"), imaging_time, footprint))
+
+    tile_names, imaging_times, footprints = zip(*rows) if rows else ((), (), ())
+    index = GeoDataFrame(
+        {"tile_name": list(tile_names), "imaging_time": list(imaging_times)},
+        geometry=list(footprints),
+        crs="EPSG:4326",
+    )
+    index["imaging_time"] = index["imaging_time"].astype("datetime64[us]")
+
+    # Write atomically, other processes might be reading the index at the same time
+    LJ_INDEX_DIR.mkdir(parents=True, exist_ok=True)
+    index_tmp = LJ_INDEX_FILE.with_name(f"{LJ_INDEX_FILE.name}.{os.getpid()}.tmp")
+    signature_tmp = LJ_INDEX_SIGNATURE_FILE.with_name(f"{LJ_INDEX_SIGNATURE_FILE.name}.{os.getpid()}.tmp")
+    index.to_parquet(index_tmp)
+    signature_tmp.write_text(json.dumps({"metadata_mtime_ns": signature, "count": len(index)}))
+    os.replace(index_tmp, LJ_INDEX_FILE)
+    os.replace(signature_tmp, LJ_INDEX_SIGNATURE_FILE)
+
+    return index
+
+
+def lj_load_footprint_index() -> tuple[GeoDataFrame, STRtree, np.ndarray]:
+    """Load the footprint index, (re)building it if the metadata directory changed since the last build.
+
+    The loaded index is kept in memory, so repeated lookups only cost a `stat` of the metadata directory.
+
+    :return: Tuple of (index GeoDataFrame indexed by tile name, STRtree over footprints, imaging dates as
+        `datetime64[D]`)
+    """
+    global _index_cache
+
+    signature = _metadata_signature(LJ_METADATA_DOWNLOAD_DIR)
+    cached = _index_cache
+    if cached is not None and cached[0] == signature:
+        return cached[1], cached[2], cached[3]
+
+    with _index_lock:
+        if _index_cache is not None and _index_cache[0] == signature:
+            return _index_cache[1], _index_cache[2], _index_cache[3]
+
+        index = None
+        if LJ_INDEX_FILE.exists() and LJ_INDEX_SIGNATURE_FILE.exists():
+            stored = json.loads(LJ_INDEX_SIGNATURE_FILE.read_text())
+            if stored.get("metadata_mtime_ns") == signature:
+                index = geopandas.read_parquet(LJ_INDEX_FILE)
+        if index is None:
+            print("LuoJia metadata changed, rebuilding footprint index...")
+            index = lj_build_footprint_index()
+
+        index = index.set_index("tile_name", drop=False)
+        tree = STRtree(index.geometry.values)
+        dates = index["imaging_time"].values.astype("datetime64[D]")
+        _index_cache = (signature, index, tree, dates)
+        return index, tree, dates
+
+
+def lj_query_tiles(
+    geometry: "BaseGeometry | GeoDataFrame",
+    date_range: datetime.date | list[datetime.date] | None = None,
+) -> list[str]:
+    """Get all tiles whose footprint intersects the given geometry on the given date(s).
+
+    :param geometry: Region of interest, either a shapely geometry in EPSG:4326 or a GeoDataFrame
+    :param date_range: Single date or list of dates, None matches all dates
+    :return: List of tile names, sorted by name
+    """
+    if isinstance(geometry, GeoDataFrame):
+        if geometry.crs is not None:
+            geometry = geometry.to_crs("EPSG:4326")
+        geometry = geometry.union_all()
+
+    index, tree, dates = lj_load_footprint_index()
+    candidates = np.sort(tree.query(geometry, predicate="intersects"))
+
+    if date_range is not None:
+        if isinstance(date_range, datetime.date):
+            date_range = [date_range]
+        wanted = np.array(date_range, dtype="datetime64[D]")
+        candidates = candidates[np.isin(dates[candidates], wanted)]
+
+    return index["tile_name"].values[candidates].tolist()
+
+
+def lj_get_footprints(tile_names: list[str]) -> list[Polygon]:
+    """Look up the footprints of the given tiles in the index.
+
+    :param tile_names: LuoJia tile names
+    :raises KeyError: A tile is not in the index
+    :return: List of footprint polygons, in the same order as `tile_names`
+    """
+    index, _, _ = lj_load_footprint_index()
+    return index.geometry.loc[tile_names].tolist()
@@ -0,0 +1,56 @@
+import os
+import uuid
+from pathlib import Path
+
+from osgeo import gdal
+
+
+class RasterBuffer:
+    """A file in GDAL's in-memory file system (`/vsimem`), owned by a single caller.
+
+    Every buffer gets a unique path, so concurrent requests never write to the same virtual file. Pass `path` to GDAL
+    as output, then hand the result on with `getbuffer()` (no further copies) or `save()`. The virtual file is
+    removed on `close()` or when leaving the `with` block.
+    """
+
+    def __init__(self, suffix: str = ".tif"):
+        self.path = f"/vsimem/{uuid.uuid4().hex}{suffix}"
+
+    def __enter__(self) -> "RasterBuffer":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def size(self) -> int:
+        stat = gdal.VSIStatL(self.path)
+        return stat.size if stat is not None else 0
+
+    def getbuffer(self) -> memoryview:
+        """Contents of the virtual file, as a read-only view.
+
+        :return: memoryview of the file contents
+        """
+        return memoryview(gdal.VSIGetMemFileBuffer_unsafe(self.path)).toreadonly()
+
+    def save(self, path: str | Path):
+        """Write the contents to a file on disk. The file is renamed into place, so readers never see partial files.
+
+        :param path: Destination path
+        """
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{uuid.uuid4().hex}.tmp")
+        try:
+            with open(tmp_path, "wb") as file:
+                file.write(self.getbuffer())
+            os.replace(tmp_path, path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+
+    def close(self):
+        gdal.Unlink(self.path)
+        # Some drivers (e.g. PNG) write auxiliary metadata next to the file
+        if gdal.VSIStatL(self.path + ".aux.xml") is not None:
+            gdal.Unlink(self.path + ".aux.xml")
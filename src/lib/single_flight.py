@@ -0,0 +1,110 @@
+import asyncio
+import fcntl
+import os
+from contextlib import asynccontextmanager, contextmanager
+from pathlib import Path
+from typing import Awaitable, Callable, Hashable, TypeVar
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """Coalesces concurrent identical work within a process.
+
+    The first caller for a key starts the work as a task, callers arriving while it runs await the same task instead
+    of starting their own. The task is shielded, so a cancelled caller does not cancel the work for the others. Once
+    the last waiting caller is cancelled, the work is cancelled too, and that caller waits for it to stop. Results are
+    not kept once the task is done, caching them is up to the caller.
+    """
+
+    def __init__(self):
+        self._inflight: dict[Hashable, asyncio.Task] = {}
+        self._waiters: dict[Hashable, int] = {}
+
+    async def run(self, key: Hashable, func: Callable[[], Awaitable[T]]) -> T:
+        """Run `func`, or wait for the running call with the same key.
+
+        :param key: Identifies the work, all parameters affecting the result must be part of it
+        :param func: Coroutine function doing the work
+        :return: Result of the (shared) call, exceptions are raised to all callers
+        """
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._done(key, done))
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if self._waiters.get(key) == 1 and not task.done():
+                # Later callers start over instead of joining the cancelled task. Waiting for the task to wind down
+                # keeps work that holds threads or locks within the limits of whoever awaited it.
+                if self._inflight.get(key) is task:
+                    del self._inflight[key]
+                task.cancel()
+                await asyncio.wait([task])
+            raise
+        finally:
+            self._waiters[key] = self._waiters.get(key, 1) - 1
+            if self._waiters[key] <= 0:
+                self._waiters.pop(key, None)
+
+    def _done(self, key: Hashable, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # Mark the exception as retrieved, all waiters might have gone away
+        if not task.cancelled():
+            task.exception()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._inflight
+
+
+@asynccontextmanager
+async def file_lock(path: str | Path):
+    """Exclusive lock on a file, shared by all processes on the host (`flock`). Waiting does not block the event loop.
+
+    :param path: Lock file, created if it does not exist
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    locking = asyncio.ensure_future(asyncio.to_thread(fcntl.flock, fd, fcntl.LOCK_EX))
+    try:
+        await asyncio.shield(locking)
+    except BaseException:
+        # The thread may still be blocked on the lock. The fd is closed once it returns, which releases the lock.
+        def close(done: asyncio.Future):
+            if not done.cancelled():
+                done.exception()
+            os.close(fd)
+
+        locking.add_done_callback(close)
+        raise
+    try:
+        yield
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+@contextmanager
+def blocking_file_lock(path: str | Path):
+    """Blocking version of `file_lock`, for worker threads and scripts.
+
+    Locks are held per open file, so the same thread taking the lock of a path twice deadlocks.
+
+    :param path: Lock file, created if it does not exist
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
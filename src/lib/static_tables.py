@@ -0,0 +1,142 @@
+import datetime
+import os
+import threading
+from pathlib import Path
+from typing import Callable, Sequence
+
+import numpy as np
+import pandas as pd
+
+from lib.config import STATIC_CACHE_DIR, STATIC_DIR
+
+# Tables are loaded once per process and reloaded when their source file changes (mtime or size). Parsed tables are
+# also written as Parquet shadows to `STATIC_CACHE_DIR`, so new processes skip decompressing and parsing the CSVs.
+_tables_lock = threading.Lock()
+_tables: dict[tuple, tuple[tuple[int, int], object]] = {}
+
+
+def _file_version(path: Path) -> tuple[int, int]:
+    stat = path.stat()
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _cached(key: tuple, path: Path, build: Callable[[Path], object]):
+    version = _file_version(path)
+    cached = _tables.get(key)
+    if cached is None or cached[0] != version:
+        with _tables_lock:
+            cached = _tables.get(key)
+            if cached is None or cached[0] != version:
+                cached = (version, build(path))
+                _tables[key] = cached
+    return cached[1]
+
+
+def _shadow_path(path: Path, version: tuple[int, int], key: str) -> Path:
+    return STATIC_CACHE_DIR / f"{path.name}-{key}-{version[0]}-{version[1]}.parquet"
+
+
+def _read_table(path: Path, date_columns: Sequence[str], category_columns: Sequence[str]) -> pd.DataFrame:
+    version = _file_version(path)
+    key = "_".join([*date_columns, "", *category_columns])
+    shadow = _shadow_path(path, version, key)
+    if shadow.exists():
+        return pd.read_parquet(shadow)
+
+    df = pd.read_csv(path, compression="infer")
+    for column in date_columns:
+        df[column] = pd.to_datetime(df[column])
+    for column in category_columns:
+        df[column] = df[column].astype("category")
+
+    # The shadow is only an optimization, e.g. a read-only data dir just means parsing the CSV in every process
+    try:
+        STATIC_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        for stale in STATIC_CACHE_DIR.glob(f"{path.name}-{key}-*.parquet"):
+            stale.unlink(missing_ok=True)
+        tmp_path = shadow.with_name(f"{shadow.name}.{os.getpid()}.tmp")
+        df.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, shadow)
+    except OSError:
+        pass
+    return df
+
+
+def load_table(
+    path: str | Path, date_columns: Sequence[str] = (), category_columns: Sequence[str] = ()
+) -> pd.DataFrame:
+    """Load a static CSV table, cached in-process and as Parquet shadow.
+
+    The returned DataFrame is shared by all callers and must not be modified in place.
+
+    :param path: Path to a (optionally compressed) CSV file
+    :param date_columns: Columns parsed as datetime64
+    :param category_columns: Columns stored as categoricals
+    :return: DataFrame
+    """
+    path = Path(path)
+    return _cached(
+        ("table", path, tuple(date_columns), tuple(category_columns)),
+        path,
+        lambda p: _read_table(p, date_columns, category_columns),
+    )
+
+
+def _date_key(date: datetime.date | str | np.datetime64 | pd.Timestamp) -> pd.Timestamp:
+    return pd.Timestamp(date).normalize()
+
+
+class RegionMeta:
+    """Region/LuoJia tile metadata (`country_meta.csv.gz`) with indexes on `country` and `(country, date)`.
+
+    Rows are sorted by country and date, so each index entry is a contiguous slice and a lookup returns a view without
+    scanning the table.
+    """
+
+    def __init__(self, frame: pd.DataFrame):
+        self.frame = frame.sort_values(["country", "date"], ignore_index=True)
+        self._by_country: dict[str, slice] = {}
+        self._by_country_date: dict[tuple[str, pd.Timestamp], slice] = {}
+
+        countries = self.frame["country"].astype(str).to_numpy()
+        dates = self.frame["date"].to_numpy()
+        # Boundaries of runs of equal country and (country, date), the table is sorted
+        country_starts = np.flatnonzero(np.r_[True, countries[1:] != countries[:-1]])
+        date_starts = np.flatnonzero(np.r_[True, (countries[1:] != countries[:-1]) | (dates[1:] != dates[:-1])])
+        for start, stop in zip(country_starts, np.r_[country_starts[1:], len(countries)]):
+            self._by_country[countries[start]] = slice(start, stop)
+        for start, stop in zip(date_starts, np.r_[date_starts[1:], len(countries)]):
+            self._by_country_date[(countries[start], pd.Timestamp(dates[start]))] = slice(start, stop)
+
+    @property
+    def countries(self) -> list[str]:
+        """Admin IDs with at least one tile, sorted."""
+        return list(self._by_country)
+
+    def rows(self, admin_id: str) -> pd.DataFrame:
+        """All rows of a region, sorted by date. Empty if the region has no tiles."""
+        return self.frame.iloc[self._by_country.get(admin_id, slice(0, 0))]
+
+    def dates(self, admin_id: str) -> pd.DatetimeIndex:
+        """Unique dates with tiles of a region, sorted in ascending order."""
+        return pd.DatetimeIndex(self.rows(admin_id)["date"].unique())
+
+    def tiles(self, admin_id: str, date: datetime.date | str | np.datetime64 | pd.Timestamp) -> list[str]:
+        """Names of the LuoJia tiles of a region on a date."""
+        rows = self._by_country_date.get((admin_id, _date_key(date)))
+        return [] if rows is None else self.frame["tile_name"].iloc[rows].tolist()
+
+
+def _build_region_meta(path: Path) -> RegionMeta:
+    frame = _read_table(path, date_columns=["date"], category_columns=["country"])
+    return RegionMeta(frame)
+
+
+def load_region_meta(path: str | Path | None = None) -> RegionMeta:
+    """Load the indexed region metadata, cached in-process and reloaded when the file changes.
+
+    :param path: Path to file, defaults to `country_meta.csv.gz` in `STATIC_DIR`
+    :return: RegionMeta
+    """
+    path = Path(path) if path else STATIC_DIR / "country_meta.csv.gz"
+    return _cached(("region_meta", path), path, _build_region_meta)
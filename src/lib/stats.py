@@ -0,0 +1,179 @@
+import math
+from typing import Any
+
+import numpy as np
+
+# Default sketch parameters. Radiance values below SKETCH_MIN_VALUE are treated as zero, values above SKETCH_MAX_VALUE
+# are clamped to the last bucket.
+SKETCH_RELATIVE_ACCURACY = 0.01
+SKETCH_MIN_VALUE = 1e-6
+SKETCH_MAX_VALUE = 1e9
+
+
+class RasterSketch:
+    """Mergeable log-bin histogram of raster values, used for approximate percentiles.
+
+    A positive value `x` is counted in bucket `i = ceil(log_gamma(x))` with `gamma = (1 + a) / (1 - a)`, where `a` is
+    the relative accuracy. Every value in bucket `i` lies in `(gamma^(i-1), gamma^i]` and is represented by
+    `2 * gamma^i / (gamma + 1)`, which is within relative error `a` of it. Negative values use a mirrored set of
+    buckets, values with `|x| < min_value` are counted as zero, and NaN/inf are ignored.
+
+    **Error bound:** `quantile(q)` returns a value within relative error `a` (absolute error `min_value` near zero) of
+    the exact order statistic at rank `round(q * (n - 1))`. `np.nanpercentile` interpolates between the order statistics
+    at ranks `floor(q * (n - 1))` and `ceil(q * (n - 1))`, so for the same data the estimate lies in
+    `[x_floor * (1 - a), x_ceil * (1 + a)]` (for positive values). With the default `a = 0.01`, P02/P98 are accurate to
+    1%.
+
+    Sketches with the same parameters can be merged, which gives exactly the sketch of the concatenated data. Mosaic
+    percentiles are computed by merging the sketches of the individual tiles instead of scanning the mosaic.
+    """
+
+    def __init__(
+        self,
+        relative_accuracy: float = SKETCH_RELATIVE_ACCURACY,
+        min_value: float = SKETCH_MIN_VALUE,
+        max_value: float = SKETCH_MAX_VALUE,
+    ):
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.max_value = max_value
+        self._log_gamma = math.log((1 + relative_accuracy) / (1 - relative_accuracy))
+        self._offset = math.ceil(math.log(min_value) / self._log_gamma)
+        num_buckets = math.ceil(math.log(max_value) / self._log_gamma) - self._offset + 1
+        self.positive = np.zeros(num_buckets, dtype=np.int64)
+        self.negative = np.zeros(num_buckets, dtype=np.int64)
+        self.zero_count = 0
+
+    @property
+    def count(self) -> int:
+        return int(self.positive.sum() + self.negative.sum() + self.zero_count)
+
+    def _bucket_counts(self, magnitudes: np.ndarray) -> np.ndarray:
+        index = np.ceil(np.log(magnitudes) / self._log_gamma).astype(np.int64) - self._offset
+        np.clip(index, 0, len(self.positive) - 1, out=index)
+        return np.bincount(index, minlength=len(self.positive))
+
+    def add(self, values: np.ndarray) -> "RasterSketch":
+        """Add all finite values of an array to the sketch.
+
+        :param values: Array of any shape
+        :return: self
+        """
+        values = np.asarray(values).ravel()
+        values = values[np.isfinite(values)]
+        positive = values[values >= self.min_value]
+        negative = -values[values <= -self.min_value]
+        self.positive += self._bucket_counts(positive)
+        self.negative += self._bucket_counts(negative)
+        self.zero_count += len(values) - len(positive) - len(negative)
+        return self
+
+    def merge(self, other: "RasterSketch") -> "RasterSketch":
+        """Merge another sketch into this one.
+
+        :param other: Sketch with the same parameters
+        :raises ValueError: Sketch parameters do not match
+        :return: self
+        """
+        if (other.relative_accuracy, other.min_value, other.max_value) != (
+            self.relative_accuracy,
+            self.min_value,
+            self.max_value,
+        ):
+            raise ValueError("Cannot merge sketches with different parameters")
+        self.positive += other.positive
+        self.negative += other.negative
+        self.zero_count += other.zero_count
+        return self
+
+    @property
+    def num_buckets(self) -> int:
+        """Number of buckets in ascending order, see `bucket_index`."""
+        return 2 * len(self.positive) + 1
+
+    def bucket_values(self) -> np.ndarray:
+        """Representative value of every bucket, in ascending order: negatives (largest magnitude first), zero,
+        positives."""
+        indices = np.arange(len(self.positive)) + self._offset
+        representatives = 2 * np.exp(indices * self._log_gamma) / (1 + math.exp(self._log_gamma))
+        return np.concatenate([-representatives[::-1], [0.0], representatives])
+
+    def bucket_index(self, values: np.ndarray) -> np.ndarray:
+        """Index of the bucket of every value, in the ascending order of `bucket_values`.
+
+        Counting these indices, e.g. with a 2D `np.bincount` over (zone, bucket), gives one sketch per zone in a single
+        vectorized pass, see `quantiles_from_counts`.
+
+        :param values: Array of finite values
+        :return: Array of bucket indices with the same shape
+        """
+        values = np.asarray(values)
+        magnitudes = np.maximum(np.abs(values), self.min_value)
+        index = np.ceil(np.log(magnitudes) / self._log_gamma).astype(np.int64) - self._offset
+        np.clip(index, 0, len(self.positive) - 1, out=index)
+        zero = len(self.positive)
+        return np.where(np.abs(values) < self.min_value, zero, np.where(values > 0, zero + 1 + index, zero - 1 - index))
+
+    def quantiles_from_counts(self, counts: np.ndarray, qs: list[float]) -> np.ndarray:
+        """Approximate quantiles of several sketches at once, with the same error bound as `quantiles`.
+
+        :param counts: Bucket counts of shape (..., num_buckets), in the order of `bucket_values`
+        :param qs: Quantiles in range [0, 1]
+        :return: Array of shape (..., len(qs)), NaN where a sketch is empty
+        """
+        cumulative = np.cumsum(counts, axis=-1)
+        total = cumulative[..., -1:]
+        ranks = np.round(np.asarray(qs, dtype=np.float64) * (total - 1))
+        index = (cumulative[..., None, :] <= ranks[..., :, None]).sum(axis=-1)
+        result = self.bucket_values()[np.minimum(index, self.num_buckets - 1)]
+        return np.where(total > 0, result, np.nan)
+
+    def quantiles(self, qs: list[float]) -> list[float]:
+        """Approximate quantiles of all values added so far.
+
+        :param qs: Quantiles in range [0, 1]
+        :return: List of quantile values, NaN if the sketch is empty
+        """
+        counts = np.concatenate([self.negative[::-1], [self.zero_count], self.positive])
+        return self.quantiles_from_counts(counts, qs).tolist()
+
+    def quantile(self, q: float) -> float:
+        return self.quantiles([q])[0]
+
+    def to_dict(self) -> dict[str, Any]:
+        """Sparse, JSON-serializable representation of the sketch."""
+
+        def sparse(counts: np.ndarray):
+            (index,) = np.nonzero(counts)
+            return {"index": index.tolist(), "counts": counts[index].tolist()}
+
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "min_value": self.min_value,
+            "max_value": self.max_value,
+            "zero_count": self.zero_count,
+            "positive": sparse(self.positive),
+            "negative": sparse(self.negative),
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> "RasterSketch":
+        sketch = cls(data["relative_accuracy"], data["min_value"], data["max_value"])
+        sketch.zero_count = int(data["zero_count"])
+        sketch.positive[data["positive"]["index"]] = data["positive"]["counts"]
+        sketch.negative[data["negative"]["index"]] = data["negative"]["counts"]
+        return sketch
+
+
+def merge_sketches(sketches: list[RasterSketch]) -> RasterSketch:
+    """Merge a list of sketches into a new sketch.
+
+    :param sketches: Sketches with identical parameters
+    :return: Merged sketch (empty default sketch if the list is empty)
+    """
+    if len(sketches) == 0:
+        return RasterSketch()
+    merged = RasterSketch(sketches[0].relative_accuracy, sketches[0].min_value, sketches[0].max_value)
+    for sketch in sketches:
+        merged.merge(sketch)
+    return merged
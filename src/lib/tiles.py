@@ -0,0 +1,101 @@
+import math
+from typing import Literal
+
+import colorcet as cc
+import numpy as np
+from osgeo import gdal
+
+from lib.raster_buffer import RasterBuffer
+from lib.types import Resampling
+
+TileFormat = Literal["png", "webp", "tif"]
+
+TILE_PIXELS = 256
+WEB_MERCATOR_EXTENT = 20037508.342789244
+
+# Same colormap as the web client (CET-L8, a.k.a. bmy), as a 256x3 lookup table
+COLORMAP_LUT = np.array([[int(color[i : i + 2], 16) for i in (1, 3, 5)] for color in cc.bmy], dtype=np.uint8)
+
+TILE_MEDIA_TYPES: dict[str, str] = {"png": "image/png", "webp": "image/webp", "tif": "image/tiff"}
+
+
+def tile_bounds(z: int, x: int, y: int) -> tuple[float, float, float, float]:
+    """Bounds of an XYZ tile in web mercator (EPSG:3857).
+
+    :return: Tuple of (minx, miny, maxx, maxy)
+    """
+    size = 2 * WEB_MERCATOR_EXTENT / 2**z
+    minx = -WEB_MERCATOR_EXTENT + x * size
+    maxy = WEB_MERCATOR_EXTENT - y * size
+    return minx, maxy - size, minx + size, maxy
+
+
+def tile_bounds_lonlat(z: int, x: int, y: int) -> tuple[float, float, float, float]:
+    """Bounds of an XYZ tile in EPSG:4326.
+
+    :return: Tuple of (min lon, min lat, max lon, max lat)
+    """
+    n = 2**z
+
+    def lat(row: int) -> float:
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+
+    return x / n * 360 - 180, lat(y + 1), (x + 1) / n * 360 - 180, lat(y)
+
+
+def warp_tile(sources: list[str], z: int, x: int, y: int, resampling: Resampling = "average") -> "gdal.Dataset":
+    """Warp the given rasters onto an XYZ tile grid.
+
+    :param sources: Paths to GDAL-readable rasters, later sources are drawn on top
+    :param resampling: Resampling kernel, defaults to "average"
+    :return: In-memory float32 dataset of TILE_PIXELS x TILE_PIXELS, NaN where there is no data
+    """
+    warp_options = gdal.WarpOptions(
+        format="MEM",
+        dstSRS="EPSG:3857",
+        outputBounds=tile_bounds(z, x, y),
+        width=TILE_PIXELS,
+        height=TILE_PIXELS,
+        resampleAlg=resampling,
+        outputType=gdal.GDT_Float32,
+        dstNodata=np.nan,
+    )
+    return gdal.Warp("", sources, options=warp_options)
+
+
+def encode_tile(dataset: "gdal.Dataset", tile_format: TileFormat, vmin: float | None, vmax: float | None) -> bytes:
+    """Encode a warped tile.
+
+    Images are stretched linearly from [vmin, vmax] onto the colormap, pixels without data are transparent. "tif"
+    returns the raw float32 values as GeoTIFF.
+
+    :param dataset: Dataset returned by `warp_tile`
+    :param tile_format: Output format
+    :param vmin: Value mapped to the lowest color (e.g. P02 of the raster), required for images
+    :param vmax: Value mapped to the highest color (e.g. P98 of the raster), required for images
+    :return: Encoded tile
+    """
+    with RasterBuffer(f".{tile_format}") as buffer:
+        if tile_format == "tif":
+            gdal.Translate(buffer.path, dataset, format="GTiff", creationOptions=["COMPRESS=DEFLATE", "PREDICTOR=3"])
+            return bytes(buffer.getbuffer())
+
+        if vmin is None or vmax is None:
+            raise ValueError("vmin and vmax are required to encode images")
+        data = dataset.GetRasterBand(1).ReadAsArray()
+        valid = np.isfinite(data)
+        scale = 255 / (vmax - vmin) if vmax > vmin else 0.0
+        index = np.nan_to_num((data - vmin) * scale, nan=0.0)
+        np.clip(index, 0, 255, out=index)
+
+        rgba = np.empty((4, TILE_PIXELS, TILE_PIXELS), dtype=np.uint8)
+        rgba[:3] = COLORMAP_LUT[index.astype(np.uint8)].transpose(2, 0, 1)
+        rgba[3] = np.where(valid, 255, 0)
+
+        mem_dataset = gdal.GetDriverByName("MEM").Create("", TILE_PIXELS, TILE_PIXELS, 4, gdal.GDT_Byte)
+        for i in range(4):
+            mem_dataset.GetRasterBand(i + 1).WriteArray(rgba[i])
+        driver = gdal.GetDriverByName("PNG" if tile_format == "png" else "WEBP")
+        driver.CreateCopy(buffer.path, mem_dataset, options=["LOSSLESS=TRUE"] if tile_format == "webp" else [])
+        mem_dataset = None
+        return bytes(buffer.getbuffer())
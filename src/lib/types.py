@@ -3,6 +3,18 @@ from typing import Literal
 
 Resolution = Literal["110m", "50m", "10m"]
 
+# How to clip mosaics to a region: not at all, to its bounding box, or to the geometry itself
+ClipMode = Literal["none", "bbox", "geometry"]
+
+# How to combine overlapping tiles in a mosaic: first/last valid tile, or the per-pixel max/mean of all valid tiles
+CombineMode = Literal["first", "last", "max", "mean"]
+
+# Chunk layouts of Zarr stores: long time series of small areas, or full maps of single dates
+ZarrLayout = Literal["timeseries", "map"]
+
+# Resampling kernels for downsampled mosaics, names as understood by GDAL and rasterio
+Resampling = Literal["nearest", "bilinear", "cubic", "average", "mode", "min", "max"]
+
 
 class DatasetName(Enum):
     blackmarble = "blackmarble"
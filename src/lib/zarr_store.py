@@ -0,0 +1,241 @@
+import itertools
+import os
+import shutil
+from contextlib import contextmanager
+from pathlib import Path
+
+import numcodecs
+import xarray as xr
+import zarr
+from zarr.codecs import BloscCodec
+
+from lib.config import BM_ZARR_CLEVEL, BM_ZARR_LAYOUTS
+from lib.types import ZarrLayout
+
+# Files holding Zarr group/array metadata, for both Zarr format 2 and 3 stores
+ZARR_METADATA_FILES = {".zarray", ".zattrs", ".zgroup", ".zmetadata", "zarr.json"}
+# Marks a journal as completely written, journals without it are discarded
+JOURNAL_COMPLETE_FILE = "complete"
+
+
+# Encoding keys describing the storage layout of a variable, dropped when rewriting a store with a different layout
+_LAYOUT_ENCODING_KEYS = {"chunks", "preferred_chunks", "compressor", "compressors", "filters", "serializer", "shards"}
+
+
+def zarr_format_of(store: str | Path) -> int:
+    """Zarr format version of an existing store."""
+    return 2 if (Path(store) / ".zgroup").exists() else 3
+
+
+def zarr_encoding(dataset: xr.Dataset, layout: ZarrLayout, zarr_format: int | None = None) -> dict[str, dict]:
+    """Encoding for `Dataset.to_zarr` implementing a storage layout.
+
+    Data variables are chunked according to `BM_ZARR_LAYOUTS[layout]` and compressed with Blosc/Zstd with bit-shuffle,
+    which works well for float radiance values that vary slowly in space and time.
+
+    :param dataset: Dataset to write
+    :param layout: "timeseries" for reading long series of small areas, "map" for reading single dates
+    :param zarr_format: Zarr format of the store, defaults to the zarr default
+    :return: Encoding dict keyed by variable name
+    """
+    zarr_format = zarr_format or zarr.config.get("default_zarr_format")
+    if zarr_format == 2:
+        compressor = numcodecs.Blosc(cname="zstd", clevel=BM_ZARR_CLEVEL, shuffle=numcodecs.Blosc.BITSHUFFLE)
+    else:
+        compressor = BloscCodec(cname="zstd", clevel=BM_ZARR_CLEVEL, shuffle="bitshuffle")
+
+    chunk_shape = BM_ZARR_LAYOUTS[layout]
+    encoding = {}
+    for name, variable in dataset.data_vars.items():
+        if variable.ndim == 0:
+            continue
+        # Spatial extents are fixed, chunks along time may be larger than the current number of dates
+        chunks = tuple(
+            chunk_shape.get(dim, size) if dim == "time" else min(chunk_shape.get(dim, size), size)
+            for dim, size in variable.sizes.items()
+        )
+        encoding[name] = {"chunks": chunks, "compressors": (compressor,)}
+    return encoding
+
+
+def _without_layout_encoding(dataset: xr.Dataset) -> xr.Dataset:
+    # Layout of the source (e.g. another store) would otherwise be carried over
+    dataset = dataset.copy()
+    for variable in dataset.variables.values():
+        variable.encoding = {k: v for k, v in variable.encoding.items() if k not in _LAYOUT_ENCODING_KEYS}
+    return dataset
+
+
+def zarr_write(dataset: xr.Dataset, store: str | Path, layout: ZarrLayout, zarr_format: int | None = None):
+    """Write a dataset to a new Zarr store with the given layout and consolidated metadata, replacing the store if it
+    exists.
+
+    :param dataset: Dataset to write
+    :param store: Path to the Zarr store
+    :param layout: Storage layout, see `zarr_encoding`
+    :param zarr_format: Zarr format of the store, defaults to the zarr default
+    """
+    dataset = _without_layout_encoding(dataset)
+    dataset.to_zarr(
+        store,
+        mode="w",
+        encoding=zarr_encoding(dataset, layout, zarr_format),
+        consolidated=True,
+        zarr_format=zarr_format,
+    )
+
+
+def zarr_add_variables(dataset: xr.Dataset, store: str | Path, layout: ZarrLayout):
+    """Add the data variables of a dataset to an existing Zarr store on the same grid, using the given layout.
+
+    :param dataset: Dataset with new data variables, coordinates must match the store
+    :param store: Path to the Zarr store
+    :param layout: Storage layout of the new variables, see `zarr_encoding`
+    """
+    zarr_format = zarr_format_of(store)
+    dataset = _without_layout_encoding(dataset)
+    dataset.to_zarr(
+        store,
+        mode="a",
+        encoding=zarr_encoding(dataset, layout, zarr_format),
+        consolidated=True,
+        zarr_format=zarr_format,
+    )
+
+
+def zarr_rechunk(store: str | Path, layout: ZarrLayout, dest: str | Path | None = None) -> Path:
+    """Rewrite a Zarr store with another layout, see `zarr_encoding`.
+
+    The store is copied in slices of whole chunks along time, so only one slice is held in memory at a time. Dates
+    are sorted on the way, which also repairs stores whose dates were appended out of order. Without `dest`, the store
+    is replaced once the copy is complete.
+
+    :param store: Path to the Zarr store
+    :param layout: Target layout
+    :param dest: Path to write the rechunked store to, defaults to None (replace `store`)
+    :return: Path to the rechunked store
+    """
+    store = Path(store)
+    zarr_recover(store)
+    zarr_format = zarr_format_of(store)
+    target = Path(dest) if dest else store.with_name(f"{store.name}.rechunk")
+    dataset = xr.open_zarr(store)
+    if "time" in dataset.dims:
+        dataset = dataset.sortby("time")
+
+    if "time" not in dataset.dims:
+        zarr_write(dataset.load(), target, layout, zarr_format)
+    else:
+        # Whole chunks along time, at least a few dates per write
+        time_chunk = BM_ZARR_LAYOUTS[layout].get("time", dataset.sizes["time"])
+        step = time_chunk * max(1, 32 // time_chunk)
+        for start in range(0, dataset.sizes["time"], step):
+            part = dataset.isel(time=slice(start, start + step)).load()
+            if start == 0:
+                zarr_write(part, target, layout, zarr_format)
+            else:
+                part.to_zarr(target, append_dim="time", consolidated=True)
+    dataset.close()
+
+    if dest:
+        return target
+    backup = store.with_name(f"{store.name}.old")
+    os.rename(store, backup)
+    os.rename(target, store)
+    shutil.rmtree(backup)
+    return store
+
+
+def zarr_journal_path(store: str | Path) -> Path:
+    # Sibling of the store, a directory inside it could be mistaken for a child group
+    store = Path(store)
+    return store.with_name(f"{store.name}.journal")
+
+
+def _array_dimensions(array: "zarr.Array") -> tuple[str, ...]:
+    if array.metadata.zarr_format == 3:
+        return tuple(array.metadata.dimension_names or ())
+    # xarray stores dimension names as attribute in Zarr format 2
+    return tuple(array.attrs.get("_ARRAY_DIMENSIONS", ()))
+
+
+def _partial_chunk_files(store: Path, append_dim: str) -> list[Path]:
+    """Chunk files that an append along `append_dim` rewrites, i.e. the last chunks along `append_dim` if they are not
+    completely filled."""
+    files = []
+    group = zarr.open_group(store, mode="r")
+    for name, array in group.arrays():
+        dimensions = _array_dimensions(array)
+        if append_dim not in dimensions:
+            continue
+        axis = dimensions.index(append_dim)
+        if array.shape[axis] % array.chunks[axis] == 0:
+            continue
+        ranges = [range(n) for n in array.cdata_shape]
+        ranges[axis] = [array.cdata_shape[axis] - 1]
+        for chunk_coords in itertools.product(*ranges):
+            path = store / name / array.metadata.encode_chunk_key(chunk_coords)
+            if path.exists():
+                files.append(path)
+    return files
+
+
+def _copy_atomic(src: Path, dst: Path):
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    tmp = dst.with_name(f"{dst.name}.{os.getpid()}.tmp")
+    shutil.copy2(src, tmp)
+    os.replace(tmp, dst)
+
+
+def zarr_recover(store: str | Path) -> bool:
+    """Roll back an interrupted append to a Zarr store, if there is one.
+
+    Restores all files saved in the journal of the store (metadata and partially filled chunks), so the store is in
+    the state before the append. Chunks written beyond the restored array shapes are ignored by readers and overwritten
+    by the next append.
+
+    :param store: Path to the Zarr store
+    :return: True if the store was rolled back
+    """
+    store = Path(store)
+    journal = zarr_journal_path(store)
+    if not journal.exists():
+        return False
+
+    restored = False
+    if (journal / JOURNAL_COMPLETE_FILE).exists():
+        for file in journal.rglob("*"):
+            if file.is_file() and file.name != JOURNAL_COMPLETE_FILE:
+                _copy_atomic(file, store / file.relative_to(journal))
+        restored = True
+    shutil.rmtree(journal)
+    return restored
+
+
+@contextmanager
+def zarr_append_journal(store: str | Path, append_dim: str = "time"):
+    """Make an append to an existing Zarr store crash-safe.
+
+    Before the append, the metadata files of the store and the chunk files the append will rewrite are copied to a
+    journal next to the store. If the block raises, or the process dies and `zarr_recover` runs on the next open, the
+    store is rolled back to its previous state. Only one writer may append to a store at a time.
+
+    :param store: Path to an existing Zarr store
+    :param append_dim: Dimension that is appended to, defaults to "time"
+    """
+    store = Path(store)
+    journal = zarr_journal_path(store)
+    zarr_recover(store)
+
+    journal.mkdir(parents=True)
+    metadata_files = [file for file in store.rglob("*") if file.name in ZARR_METADATA_FILES]
+    for file in metadata_files + _partial_chunk_files(store, append_dim):
+        _copy_atomic(file, journal / file.relative_to(store))
+    (journal / JOURNAL_COMPLETE_FILE).touch()
+
+    try:
+        yield
+    except BaseException:
+        zarr_recover(store)
+        raise
+    shutil.rmtree(journal)
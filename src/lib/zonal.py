@@ -0,0 +1,214 @@
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import xarray as xr
+from geopandas import GeoDataFrame
+from rasterio.features import rasterize
+from shapely.geometry import box
+
+from lib.admin_areas import get_regions_intersecting
+from lib.config import ADMIN_AREA_FILE_MAPPING, BM_DATA_DIR, GEOJSON_ADMIN_KEY
+from lib.stats import RasterSketch
+from lib.types import Resolution
+
+# Label grids and per-region time series tables
+ZONAL_DIR = BM_DATA_DIR / "zonal"
+ZONAL_QUANTILES = {"p02": 0.02, "p50": 0.5, "p98": 0.98}
+ZONAL_COLUMNS = ["admin_id", "date", "count", "sum", "mean", *ZONAL_QUANTILES]
+# Parquet metadata key holding the label grid a table was computed with, see `_grid_key`
+ZONAL_GRID_METADATA_KEY = b"zonal_grid_key"
+
+_table_lock = threading.Lock()
+_table_cache: dict[Path, tuple[int, dict[str, pd.DataFrame]]] = {}
+
+
+def _grid_key(dataset: xr.Dataset, resolution: Resolution) -> str:
+    admin_file = ADMIN_AREA_FILE_MAPPING[resolution]
+    signature = {
+        "transform": list(dataset.rio.transform()),
+        "shape": [dataset.rio.height, dataset.rio.width],
+        "crs": str(dataset.rio.crs),
+        "admin_file": admin_file.name,
+        "admin_mtime_ns": admin_file.stat().st_mtime_ns,
+    }
+    return hashlib.sha1(json.dumps(signature, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _with_crs(dataset: xr.Dataset) -> xr.Dataset:
+    # Black Marble stores are in EPSG:4326, older stores were written without CRS
+    return dataset.rio.write_crs("EPSG:4326") if dataset.rio.crs is None else dataset
+
+
+def zonal_label_grid(dataset: xr.Dataset, resolution: Resolution = "10m") -> tuple[np.ndarray, list[str]]:
+    """Rasterize all admin areas onto the grid of a dataset.
+
+    The grid is computed once per dataset grid and admin area file, and cached in `ZONAL_DIR`.
+
+    :param dataset: Dataset with a georeferenced (y, x) grid, assumed EPSG:4326 if no CRS is set
+    :param resolution: Resolution of the admin area geometries, defaults to "10m"
+    :return: Tuple of (int32 label grid of shape (y, x), admin IDs). Label `i + 1` is the admin area `ids[i]`, 0 is
+        outside of all admin areas.
+    """
+    dataset = _with_crs(dataset)
+    cache_path = ZONAL_DIR / "labels" / f"{_grid_key(dataset, resolution)}.npz"
+    if cache_path.exists():
+        cached = np.load(cache_path)
+        return cached["labels"], cached["ids"].tolist()
+
+    bounds = box(*dataset.rio.transform_bounds("EPSG:4326"))
+    gdf: GeoDataFrame = get_regions_intersecting(bounds, resolution).to_crs(dataset.rio.crs)
+    ids = gdf[GEOJSON_ADMIN_KEY].tolist()
+    labels = np.zeros((dataset.rio.height, dataset.rio.width), dtype=np.int32)
+    if len(ids) > 0:
+        labels = rasterize(
+            ((geometry, i + 1) for i, geometry in enumerate(gdf.geometry)),
+            out_shape=labels.shape,
+            transform=dataset.rio.transform(),
+            fill=0,
+            dtype="int32",
+        )
+
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_path.with_name(f"{cache_path.stem}.{os.getpid()}.tmp.npz")
+    np.savez_compressed(tmp_path, labels=labels, ids=np.array(ids, dtype=str))
+    os.replace(tmp_path, cache_path)
+    return labels, ids
+
+
+def zonal_stats(data_array: xr.DataArray, labels: np.ndarray, ids: list[str]) -> pd.DataFrame:
+    """Per-region statistics of every date of a data array.
+
+    Each date is a single vectorized pass: sums and counts are `np.bincount`s over the label grid, percentiles come
+    from a 2D bincount over (label, sketch bucket), see `RasterSketch.bucket_index` for their error bound.
+
+    :param data_array: Data array on (time, y, x), on the grid of `labels`
+    :param labels: Label grid from `zonal_label_grid`
+    :param ids: Admin IDs from `zonal_label_grid`
+    :return: DataFrame with columns `ZONAL_COLUMNS`, one row per region and date with valid pixels
+    """
+    sketch = RasterSketch()
+    num_labels = len(ids) + 1
+    flat_labels = labels.ravel()
+    frames = []
+    for time in data_array["time"].values:
+        values = data_array.sel(time=time).values.ravel()
+        valid = np.isfinite(values) & (flat_labels > 0)
+        zone, values = flat_labels[valid], values[valid]
+
+        count = np.bincount(zone, minlength=num_labels)
+        total = np.bincount(zone, weights=values, minlength=num_labels)
+        buckets = np.bincount(
+            zone * sketch.num_buckets + sketch.bucket_index(values), minlength=num_labels * sketch.num_buckets
+        ).reshape(num_labels, sketch.num_buckets)
+        quantiles = sketch.quantiles_from_counts(buckets, list(ZONAL_QUANTILES.values()))
+
+        present = np.nonzero(count[1:])[0] + 1
+        frame = pd.DataFrame(
+            {
+                "admin_id": np.array(ids)[present - 1],
+                "date": np.datetime64(time, "D"),
+                "count": count[present],
+                "sum": total[present],
+                "mean": total[present] / count[present],
+            }
+        )
+        for i, name in enumerate(ZONAL_QUANTILES):
+            frame[name] = quantiles[present, i]
+        frames.append(frame)
+
+    if len(frames) == 0:
+        return pd.DataFrame(columns=ZONAL_COLUMNS)
+    return pd.concat(frames, ignore_index=True)
+
+
+def zonal_table_path(store: str | Path, variable: str) -> Path:
+    return ZONAL_DIR / f"{Path(store).stem}-{variable}.parquet"
+
+
+def _table_grid_key(table_path: Path) -> str | None:
+    metadata = pq.read_schema(table_path).metadata or {}
+    key = metadata.get(ZONAL_GRID_METADATA_KEY)
+    return key.decode("utf-8") if key is not None else None
+
+
+def zonal_compute(
+    store: str | Path, variable: str, resolution: Resolution = "10m", force: bool = False
+) -> pd.DataFrame:
+    """Compute the per-region time series of a variable in a Zarr store and store it as a Parquet table.
+
+    Only dates missing from an existing table are computed, so the table can be updated after appending to the store.
+    The table records the label grid it was computed with (store grid, admin area resolution and file version). If the
+    grid differs, e.g. for another resolution or an updated admin area file, all dates are recomputed, so a table never
+    mixes two zonings.
+
+    :param store: Path to the Zarr store
+    :param variable: Data variable to aggregate
+    :param resolution: Resolution of the admin area geometries, defaults to "10m"
+    :param force: Recompute all dates, defaults to False
+    :return: The complete table
+    """
+    table_path = zonal_table_path(store, variable)
+    dataset = _with_crs(xr.open_zarr(store))
+    labels, ids = zonal_label_grid(dataset, resolution)
+    grid_key = _grid_key(dataset, resolution)
+
+    table = None
+    data_array = dataset[variable]
+    if not force and table_path.exists() and _table_grid_key(table_path) != grid_key:
+        print(f"Zones changed since {table_path.name} was computed, recomputing all dates...")
+        force = True
+    if not force and table_path.exists():
+        table = pd.read_parquet(table_path)
+        done = np.isin(data_array["time"].values.astype("datetime64[D]"), table["date"].values.astype("datetime64[D]"))
+        data_array = data_array.isel(time=np.nonzero(~done)[0])
+
+    new_rows = zonal_stats(data_array, labels, ids)
+    table = new_rows if table is None else pd.concat([table, new_rows], ignore_index=True)
+    table["admin_id"] = table["admin_id"].astype(str).astype("category")
+    table["date"] = table["date"].astype("datetime64[s]")
+    table = table.sort_values(["admin_id", "date"], ignore_index=True)
+
+    # Written atomically, the API might be reading the table
+    table_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = table_path.with_name(f"{table_path.name}.{os.getpid()}.tmp")
+    arrow_table = pa.Table.from_pandas(table, preserve_index=False)
+    metadata = {**(arrow_table.schema.metadata or {}), ZONAL_GRID_METADATA_KEY: grid_key.encode("utf-8")}
+    pq.write_table(arrow_table.replace_schema_metadata(metadata), tmp_path)
+    os.replace(tmp_path, table_path)
+    return table
+
+
+def zonal_timeseries(store: str | Path, variable: str, admin_id: str) -> pd.DataFrame | None:
+    """Look up the precomputed time series of a region.
+
+    Tables are loaded once per process and split by region, so a lookup is a dict access. They are reloaded when the
+    file changes.
+
+    :param store: Path to the Zarr store the table was computed from
+    :param variable: Data variable
+    :param admin_id: Admin ID of the region
+    :raises FileNotFoundError: No table was computed for this store and variable
+    :return: DataFrame sorted by date, None if the region is not in the table
+    """
+    table_path = zonal_table_path(store, variable)
+    mtime = table_path.stat().st_mtime_ns
+    cached = _table_cache.get(table_path)
+    if cached is None or cached[0] != mtime:
+        with _table_lock:
+            cached = _table_cache.get(table_path)
+            if cached is None or cached[0] != mtime:
+                table = pd.read_parquet(table_path)
+                regions = {
+                    str(key): frame.drop(columns="admin_id").reset_index(drop=True)
+                    for key, frame in table.groupby("admin_id", observed=True)
+                }
+                cached = (mtime, regions)
+                _table_cache[table_path] = cached
+    return cached[1].get(admin_id)
@@ -0,0 +1,7 @@
+import os
+import tempfile
+
+# lib.config creates the data directories and requires a Blackmarble token on import. Tests never talk to the real
+# services, point it at a throwaway directory and a dummy token unless the environment sets them.
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="infrared-marble-tests-"))
+os.environ.setdefault("BLACKMARBLE_TOKEN", "test")
@@ -0,0 +1,199 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from lib.downloader import DownloadJob, DownloadScheduler, HostRateLimiter, download_file
+
+PAYLOAD = bytes(range(256)) * 1024  # 256 KiB
+
+
+class StandInServer(ThreadingHTTPServer):
+    """Local stand-in for a download host. Every path can be told to fail a number of times before it succeeds."""
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.lock = threading.Lock()
+        self.requests: list[tuple[float, str, str | None]] = []  # (time, path, Range header)
+        self.failures: dict[str, list[str]] = {}  # Path to failure modes still to serve, in order
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def fail(self, path: str, *modes: str):
+        """Make the next requests for `path` fail: "throttle" (429), "error" (503), "truncate" (connection drops
+        halfway) or "missing" (404, permanently if it is the last mode)."""
+        self.failures[path] = list(modes)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    server: StandInServer
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests.append((time.monotonic(), self.path, self.headers.get("Range")))
+            modes = self.server.failures.get(self.path, [])
+            mode = modes.pop(0) if len(modes) > 1 or (modes and modes[0] != "missing") else (modes or [None])[0]
+
+        if mode == "throttle":
+            self.send_response(429)
+            self.send_header("Retry-After", "0")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if mode in ("error", "missing"):
+            self.send_response(503 if mode == "error" else 404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        start = 0
+        range_header = self.headers.get("Range")
+        if range_header:
+            start = int(range_header.removeprefix("bytes=").split("-")[0])
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(PAYLOAD) - 1}/{len(PAYLOAD)}")
+        else:
+            self.send_response(200)
+        body = PAYLOAD[start:]
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if mode == "truncate":
+            self.wfile.write(body[: len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    server = StandInServer()
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def fast_scheduler(**kwargs) -> DownloadScheduler:
+    options = {"concurrency": 4, "rate_limiter": HostRateLimiter(0), "retries": 3, "backoff_base": 0.01}
+    return DownloadScheduler(**{**options, **kwargs})
+
+
+def test_download_file(server, tmp_path):
+    dest = download_file(f"{server.url}/tile.tar.gz", tmp_path / "tile.tar.gz", rate_limiter=HostRateLimiter(0))
+    assert dest.read_bytes() == PAYLOAD
+    assert not (tmp_path / "tile.tar.gz.part").exists()
+
+
+def test_download_file_resumes_partial_download(server, tmp_path):
+    server.fail("/tile.tar.gz", "truncate")
+    url = f"{server.url}/tile.tar.gz"
+    download = partial(download_file, url, tmp_path / "tile.tar.gz", rate_limiter=HostRateLimiter(0))
+
+    with pytest.raises(requests.RequestException):
+        download()
+    part = tmp_path / "tile.tar.gz.part"
+    assert 0 < part.stat().st_size < len(PAYLOAD)
+
+    assert download().read_bytes() == PAYLOAD
+    assert server.requests[-1][2] == f"bytes={len(PAYLOAD) // 2}-"
+
+
+def test_concurrent_downloads_of_same_file(server, tmp_path):
+    # One caller downloads while the other waits, then finds the file, bytes never interleave
+    dest = tmp_path / "tile.tar.gz"
+    download = partial(
+        download_file, f"{server.url}/tile.tar.gz", dest, chunk_size=1024, rate_limiter=HostRateLimiter(0)
+    )
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        results = list(executor.map(lambda _: download(), range(2)))
+
+    assert results == [dest, dest]
+    assert dest.read_bytes() == PAYLOAD
+    assert not (tmp_path / "tile.tar.gz.part").exists()
+    assert len(server.requests) == 1
+
+
+def test_scheduler_retries_and_reports_failures(server, tmp_path):
+    server.fail("/throttled", "throttle", "throttle")
+    server.fail("/flaky", "error", "truncate")
+    server.fail("/missing", "missing")
+    limiter = HostRateLimiter(0)
+    jobs = [
+        DownloadJob(
+            key=name,
+            host=None,
+            func=partial(download_file, f"{server.url}/{name}", tmp_path / name, rate_limiter=limiter),
+        )
+        for name in ("ok", "throttled", "flaky", "missing")
+    ]
+    progress = []
+
+    report = fast_scheduler().run_sync(jobs, progress=lambda *args: progress.append(args))
+
+    assert set(report.results) == {"ok", "throttled", "flaky"}
+    assert all((tmp_path / name).read_bytes() == PAYLOAD for name in report.results)
+    assert report.attempts == {"ok": 1, "throttled": 3, "flaky": 3, "missing": 1}
+    # Client errors are not retried
+    assert set(report.failures) == {"missing"}
+    assert report.failures["missing"].response.status_code == 404
+    assert not report.ok
+    assert [done for done, *_ in progress] == [1, 2, 3, 4]
+
+
+def test_scheduler_gives_up_after_retries(server, tmp_path):
+    server.fail("/down", *["error"] * 10)
+    func = partial(download_file, f"{server.url}/down", tmp_path / "down", rate_limiter=HostRateLimiter(0))
+    job = DownloadJob(key="down", host=None, func=func)
+
+    report = fast_scheduler(retries=2).run_sync([job])
+
+    assert report.attempts == {"down": 3}
+    with pytest.raises(RuntimeError):
+        report.raise_for_failures()
+
+
+def test_rate_limit_applies_to_every_request(server, tmp_path):
+    # A truncated download and its resume are two requests, both paced
+    rate = 20
+    limiter = HostRateLimiter(rate)
+    for name in ("a", "b"):
+        server.fail(f"/{name}", "truncate")
+    jobs = [
+        DownloadJob(
+            key=name,
+            host=None,
+            func=partial(download_file, f"{server.url}/{name}", tmp_path / name, rate_limiter=limiter),
+        )
+        for name in ("a", "b", "c")
+    ]
+
+    report = fast_scheduler(concurrency=3).run_sync(jobs)
+
+    assert report.ok
+    times = sorted(t for t, _, _ in server.requests)
+    assert len(times) == 5
+    # At most one request per interval, with some slack for timer resolution
+    assert times[-1] - times[0] >= 0.9 * (len(times) - 1) / rate
+
+
+def test_scheduler_paces_attempts_per_host(tmp_path):
+    rate = 20
+    started = []
+    jobs = [DownloadJob(key=i, host="example.com", func=lambda: started.append(time.monotonic())) for i in range(4)]
+
+    fast_scheduler(rate_limiter=HostRateLimiter(rate)).run_sync(jobs)
+
+    assert max(started) - min(started) >= 0.9 * (len(started) - 1) / rate
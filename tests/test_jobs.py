@@ -0,0 +1,94 @@
+import asyncio
+import fcntl
+import os
+import threading
+import time
+from functools import partial
+
+import pytest
+
+from lib.jobs import WorkCancelled, to_thread_cancellable
+from lib.single_flight import SingleFlight, file_lock
+
+
+def stepwise_work(steps: int, stopped: list[str], report):
+    try:
+        for step in range(steps):
+            time.sleep(0.01)
+            report("working", step / steps)
+    except WorkCancelled:
+        stopped.append("cancelled")
+        raise
+    stopped.append("done")
+    return steps
+
+
+def test_cancelled_caller_waits_for_thread_to_stop():
+    stopped = []
+
+    async def main():
+        task = asyncio.ensure_future(to_thread_cancellable(stepwise_work, 1000, stopped))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        # The thread stopped at its next report, before the cancellation reached the caller
+        assert stopped == ["cancelled"]
+
+    asyncio.run(main())
+
+
+def test_progress_is_forwarded():
+    progress = []
+    result = asyncio.run(to_thread_cancellable(stepwise_work, 3, [], report=lambda *args: progress.append(args)))
+    assert result == 3
+    assert progress == [("working", 0.0), ("working", 1 / 3), ("working", 2 / 3)]
+
+
+def test_single_flight_stops_work_of_last_cancelled_caller():
+    stopped = []
+
+    async def main():
+        flights = SingleFlight()
+        work = partial(to_thread_cancellable, stepwise_work, 1000, stopped)
+        callers = [asyncio.ensure_future(flights.run("key", work)) for _ in range(2)]
+        await asyncio.sleep(0.05)
+        callers[0].cancel()
+        await asyncio.sleep(0.05)
+        assert not stopped and "key" in flights
+
+        callers[1].cancel()
+        await asyncio.gather(*callers, return_exceptions=True)
+        assert stopped == ["cancelled"]
+        assert "key" not in flights
+
+    asyncio.run(main())
+
+
+def test_file_lock_cancelled_while_waiting(tmp_path):
+    lock_path = tmp_path / "entry.lock"
+    holder = os.open(lock_path, os.O_RDWR | os.O_CREAT)
+    fcntl.flock(holder, fcntl.LOCK_EX)
+    acquired = threading.Event()
+
+    async def wait_for_lock():
+        async with file_lock(lock_path):
+            acquired.set()
+
+    async def main():
+        task = asyncio.ensure_future(wait_for_lock())
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+        # The abandoned waiter gets the lock once it is free, and releases it right away
+        fcntl.flock(holder, fcntl.LOCK_UN)
+        async with file_lock(lock_path):
+            pass
+        assert not acquired.is_set()
+
+    try:
+        asyncio.run(main())
+    finally:
+        os.close(holder)
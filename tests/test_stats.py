@@ -0,0 +1,79 @@
+import math
+
+import numpy as np
+import pytest
+
+from lib.stats import SKETCH_MIN_VALUE, SKETCH_RELATIVE_ACCURACY, RasterSketch, merge_sketches
+
+QUANTILES = [0.0, 0.02, 0.25, 0.5, 0.75, 0.98, 1.0]
+
+
+def radiance_like(seed: int, size: int = 100_000) -> np.ndarray:
+    # Heavy-tailed like night-time radiance, with gaps (NaN), dark pixels (0) and a few negative values
+    rng = np.random.default_rng(seed)
+    data = rng.lognormal(mean=0.0, sigma=2.0, size=size).astype(np.float32)
+    data[rng.choice(size, size // 100, replace=False)] = np.nan
+    data[rng.choice(size, size // 20, replace=False)] = 0.0
+    data[rng.choice(size, size // 200, replace=False)] *= -1
+    return data
+
+
+def assert_within_bound(estimate: float, data: np.ndarray, q: float):
+    """The documented bound: within relative accuracy of the order statistics `np.nanpercentile` interpolates."""
+    finite = np.sort(data[np.isfinite(data)])
+    h = q * (len(finite) - 1)
+    lo, hi = float(finite[math.floor(h)]), float(finite[math.ceil(h)])
+    a = SKETCH_RELATIVE_ACCURACY
+    lower = min(lo * (1 - a), lo * (1 + a)) - SKETCH_MIN_VALUE
+    upper = max(hi * (1 - a), hi * (1 + a)) + SKETCH_MIN_VALUE
+    exact = np.nanpercentile(data, q * 100)
+    assert lower <= estimate <= upper, f"q={q}: estimate {estimate} not within [{lower}, {upper}] (exact {exact})"
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_quantiles_within_error_bound(seed):
+    data = radiance_like(seed)
+    sketch = RasterSketch().add(data)
+    for q, estimate in zip(QUANTILES, sketch.quantiles(QUANTILES)):
+        assert_within_bound(estimate, data, q)
+
+
+def test_merged_sketches_match_concatenated_data():
+    chunks = [radiance_like(seed, size=25_000) for seed in range(4)]
+    merged = merge_sketches([RasterSketch().add(chunk) for chunk in chunks])
+    data = np.concatenate(chunks)
+
+    assert merged.count == np.isfinite(data).sum()
+    assert merged.quantiles(QUANTILES) == RasterSketch().add(data).quantiles(QUANTILES)
+    for q, estimate in zip(QUANTILES, merged.quantiles(QUANTILES)):
+        assert_within_bound(estimate, data, q)
+
+
+def test_serialization_round_trip():
+    sketch = RasterSketch().add(radiance_like(0))
+    restored = RasterSketch.from_dict(sketch.to_dict())
+    assert restored.quantiles(QUANTILES) == sketch.quantiles(QUANTILES)
+
+
+def test_empty_sketch():
+    sketch = RasterSketch().add(np.array([np.nan, np.inf]))
+    assert sketch.count == 0
+    assert all(math.isnan(value) for value in sketch.quantiles([0.02, 0.98]))
+
+
+def test_merge_rejects_different_parameters():
+    with pytest.raises(ValueError):
+        RasterSketch().merge(RasterSketch(relative_accuracy=0.02))
+
+
+def test_quantiles_from_counts_per_zone():
+    # Per-zone sketches from bucket indices give the same result as separate sketches
+    data = radiance_like(0)
+    finite = data[np.isfinite(data)]
+    zones = np.random.default_rng(0).integers(0, 3, size=len(finite))
+    sketch = RasterSketch()
+    counts = np.zeros((3, sketch.num_buckets), dtype=np.int64)
+    np.add.at(counts, (zones, sketch.bucket_index(finite)), 1)
+    for zone in range(3):
+        expected = RasterSketch().add(finite[zones == zone]).quantiles(QUANTILES)
+        assert np.allclose(sketch.quantiles_from_counts(counts[zone], QUANTILES), expected)
@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from lib.stats import SKETCH_MIN_VALUE, SKETCH_RELATIVE_ACCURACY
+
+# Label grids are rasterized with rasterio
+zonal = pytest.importorskip("lib.zonal", exc_type=ImportError)
+
+
+def test_zonal_stats_match_groupby():
+    rng = np.random.default_rng(0)
+    ids = ["AAA", "BBB", "CCC", "DDD"]
+    # Label 0 is outside all regions, DDD has no pixels
+    labels = rng.integers(0, 4, size=(60, 80)).astype(np.int32)
+    values = rng.lognormal(mean=0.0, sigma=2.0, size=(2, 60, 80)).astype(np.float32)
+    values[rng.random(values.shape) < 0.1] = np.nan
+    times = pd.to_datetime(["2024-01-01", "2024-01-02"])
+    data_array = xr.DataArray(values, dims=("time", "y", "x"), coords={"time": times})
+
+    table = zonal.zonal_stats(data_array, labels, ids)
+
+    pixels = pd.DataFrame(
+        {
+            "date": np.repeat(times.values, labels.size),
+            "label": np.tile(labels.ravel(), len(times)),
+            "value": values.ravel(),
+        }
+    )
+    pixels = pixels[(pixels["label"] > 0) & pixels["value"].notna()]
+    pixels["admin_id"] = np.array(ids)[pixels["label"] - 1]
+    expected = pixels.groupby(["admin_id", "date"])["value"].agg(["count", "sum", "mean"]).reset_index()
+
+    table = table.sort_values(["admin_id", "date"], ignore_index=True)
+    assert list(table.columns) == zonal.ZONAL_COLUMNS
+    assert table["admin_id"].tolist() == expected["admin_id"].tolist()
+    assert (table["date"].values == expected["date"].values).all()
+    assert table["count"].tolist() == expected["count"].tolist()
+    assert np.allclose(table["sum"], expected["sum"], rtol=1e-5)
+    assert np.allclose(table["mean"], expected["mean"], rtol=1e-5)
+
+    # Percentiles within the sketch's relative accuracy of the order statistics `np.percentile` interpolates
+    a = SKETCH_RELATIVE_ACCURACY
+    for (admin_id, date), group in pixels.groupby(["admin_id", "date"]):
+        row = table[(table["admin_id"] == admin_id) & (table["date"] == date)].iloc[0]
+        for name, q in zonal.ZONAL_QUANTILES.items():
+            lower = np.percentile(group["value"], q * 100, method="lower") * (1 - a) - SKETCH_MIN_VALUE
+            upper = np.percentile(group["value"], q * 100, method="higher") * (1 + a) + SKETCH_MIN_VALUE
+            assert lower <= row[name] <= upper, f"{admin_id} {date} {name}: {row[name]} not in [{lower}, {upper}]"